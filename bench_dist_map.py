@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""Benchmark reprodutível do preparo e dos motores de distância com rasters sintéticos.
+
+Gera rasters binários "brutos" (1 = feição) com polilinhas aleatórias de estradas
+(trechos quase retos) e rios (meandros), em vários tamanhos, densidades e padrões de
+NoData, e mede `prep_binary_inputs.normalize_file`, `dist_map.process_tiles` numa
+grade de tile/borda, `process_exact` e `process_full_raster`. Cada medição roda num
+processo novo (pico de RSS isolado) e o resultado vai para um JSON com throughput
+(Mpix/s), pico de RSS, bytes lidos/gravados e o erro de cada saída em relação ao
+raster inteiro (EDT exata).
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import scipy
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+
+from dist_map import (
+    DEFAULT_EXACT_TILE_SIZE,
+    DistanceEncoding,
+    DistanceWriter,
+    distance_profile,
+    exact_band_rows,
+    iter_row_bands,
+    peak_rss_mb,
+    process_exact,
+    process_full_raster,
+    process_sparse,
+    process_tiles,
+)
+from prep_binary_inputs import normalize_file
+
+THEMES = ("roads", "rivers")
+# background: fundo NoData como em 00_inputs_tiffs. outside: fundo 0 e NoData fora de um contorno irregular.
+NODATA_PATTERNS = ("background", "outside")
+BENCHMARKS = ("prep", "tiles", "exact", "full", "kdtree")
+PIXEL_SIZE = 30.0
+OUTSIDE_NODATA = 255
+
+
+def polyline(rng: np.random.Generator, theme: str, size: int) -> list[tuple[float, float]]:
+    """Polilinha em coordenadas de pixel: estradas viram pouco, rios meandram."""
+    if theme == "roads":
+        vertices, step, turn = rng.integers(3, 8), size / 8, 0.25
+    else:
+        vertices, step, turn = rng.integers(20, 60), size / 40, 0.8
+    heading = rng.uniform(0, 2 * math.pi)
+    x, y = rng.uniform(0, size, 2)
+    points = [(x, y)]
+    for _ in range(vertices):
+        heading += rng.normal(0, turn)
+        x += step * math.cos(heading)
+        y += step * math.sin(heading)
+        points.append((x, y))
+    return points
+
+
+def outside_mask(rng: np.random.Generator, size: int) -> np.ndarray:
+    """Contorno tipo UF: "elipse" com raio perturbado; True = fora (NoData)."""
+    angles = np.linspace(0, 2 * math.pi, 64, endpoint=False)
+    radius = size * (0.42 + 0.06 * np.sin(angles * rng.integers(2, 6) + rng.uniform(0, 6)))
+    ring = [(size / 2 + r * math.cos(a), size / 2 + r * math.sin(a)) for r, a in zip(radius, angles)]
+    ring.append(ring[0])
+    inside = rasterize([{"type": "Polygon", "coordinates": [ring]}], out_shape=(size, size), dtype="uint8")
+    return inside == 0
+
+
+def synthetic_raster(path: Path, theme: str, size: int, density: float, pattern: str, seed: int) -> dict:
+    """Grava o raster bruto e devolve a densidade real de feições (fração dos pixels)."""
+    rng = np.random.default_rng(seed)
+    features = np.zeros((size, size), dtype=np.uint8)
+    target = density * size * size
+    # Lotes de polilinhas até atingir a densidade pedida (o comprimento médio varia por tema).
+    while features.sum(dtype=np.int64) < target:
+        missing = target - features.sum(dtype=np.int64)
+        batch = max(1, int(missing / size) + 1)
+        lines = [{"type": "LineString", "coordinates": polyline(rng, theme, size)} for _ in range(batch)]
+        features |= rasterize(lines, out_shape=(size, size), dtype="uint8")
+
+    profile = dict(
+        driver="GTiff",
+        height=size,
+        width=size,
+        count=1,
+        dtype="uint8",
+        crs="EPSG:31997",
+        transform=from_origin(500000.0, 7000000.0, PIXEL_SIZE, PIXEL_SIZE),
+        compress="deflate",
+    )
+    if pattern == "background":
+        profile["nodata"] = 0
+        data = features
+    else:
+        profile["nodata"] = OUTSIDE_NODATA
+        data = np.where(outside_mask(rng, size), OUTSIDE_NODATA, features).astype(np.uint8)
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    valid = data != OUTSIDE_NODATA if pattern == "outside" else np.ones_like(data, dtype=bool)
+    return {
+        "feature_density": float((data == 1).sum() / data.size),
+        "valid_fraction": float(valid.mean()),
+        "input_bytes": path.stat().st_size,
+    }
+
+
+def proc_io() -> dict[str, int]:
+    """Bytes lidos/gravados por chamadas de sistema (rchar/wchar); vazio fora do Linux."""
+    try:
+        lines = Path("/proc/self/io").read_text().splitlines()
+    except OSError:
+        return {}
+    values = dict(line.split(": ") for line in lines)
+    return {"read": int(values["rchar"]), "written": int(values["wchar"])}
+
+
+def _run_benchmark(kind: str, in_path: str, out_path: str, params: dict) -> dict:
+    """Executa uma medição (num processo novo) e devolve tempo, RSS e I/O dela."""
+    before = proc_io()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as tmp_dir:
+        if kind == "prep":
+            normalize_file(Path(in_path), Path(out_path), params["layout"], params["block_size"])
+        else:
+            with rasterio.open(in_path) as src:
+                px, py = abs(src.transform.a), abs(src.transform.e)
+                with DistanceWriter(
+                    [Path(out_path)], distance_profile(src), DistanceEncoding(), [Path(in_path).stem]
+                ) as writer:
+                    sources = [src]
+                    if kind == "tiles":
+                        process_tiles(sources, writer, params["tile_size"], params["tile_padding"], px, py)
+                    elif kind == "exact":
+                        process_exact(sources, writer, exact_band_rows(src.width, params["tile_size"]), px, py)
+                    elif kind == "kdtree":
+                        band_rows = exact_band_rows(src.width, params["tile_size"])
+                        process_sparse(sources, writer, band_rows, px, py, max_density=None)
+                    else:
+                        process_full_raster(sources, writer, Path(tmp_dir), px, py)
+    seconds = time.perf_counter() - start
+    after = proc_io()
+    result = {"seconds": seconds, "peak_rss_mb": peak_rss_mb()}
+    if before and after:
+        result["bytes_read"] = after["read"] - before["read"]
+        result["bytes_written"] = after["written"] - before["written"]
+    return result
+
+
+def measure(kind: str, in_path: Path, out_path: Path, params: dict) -> dict:
+    # spawn: cada medição começa sem a memória do processo principal (RSS comparável).
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        result = pool.submit(_run_benchmark, kind, str(in_path), str(out_path), params).result()
+    if out_path.exists():
+        result["output_bytes"] = out_path.stat().st_size
+    return result
+
+
+def accuracy(path: Path, reference: Path, band_rows: int = 1024) -> dict:
+    """Erro em relação ao raster inteiro, lido em faixas (RAM limitada)."""
+    with rasterio.open(path) as src, rasterio.open(reference) as ref:
+        half_pixel = 0.5 * min(abs(ref.transform.a), abs(ref.transform.e))
+        max_error = total_error = 0.0
+        valid_count = within_half = nodata_mismatch = 0
+        for window in iter_row_bands(ref.height, ref.width, band_rows):
+            values = src.read(1, window=window).astype(np.float64)
+            expected = ref.read(1, window=window).astype(np.float64)
+            valid = np.isfinite(values) & np.isfinite(expected)
+            nodata_mismatch += int((np.isnan(values) != np.isnan(expected)).sum())
+            error = np.abs(values[valid] - expected[valid])
+            if error.size:
+                max_error = max(max_error, float(error.max()))
+                total_error += float(error.sum())
+                within_half += int((error <= half_pixel).sum())
+                valid_count += int(error.size)
+    return {
+        "max_abs_error_m": max_error,
+        "mean_abs_error_m": total_error / max(valid_count, 1),
+        "within_half_pixel": within_half / max(valid_count, 1),
+        "nodata_mismatch": nodata_mismatch,
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_suite(args: argparse.Namespace, work_dir: Path) -> dict:
+    results = []
+    cases = [
+        (theme, size, density, pattern)
+        for theme in args.themes
+        for size in args.sizes
+        for density in args.densities
+        for pattern in args.patterns
+    ]
+    for index, (theme, size, density, pattern) in enumerate(cases):
+        case = {"theme": theme, "size": size, "density": density, "nodata_pattern": pattern, "seed": args.seed + index}
+        stem = f"{theme}_{size}_{density:g}_{pattern}"
+        in_path = work_dir / f"{stem}.tif"
+        case.update(synthetic_raster(in_path, theme, size, density, pattern, case["seed"]))
+        print(f"[{index + 1}/{len(cases)}] {stem}: {case['feature_density']:.4%} de feição")
+        pixels = size * size
+
+        runs = []
+        if "prep" in args.benchmarks:
+            runs.append(("prep", {"layout": "striped", "block_size": 256}))
+        # A referência de acurácia (raster inteiro) sempre roda.
+        runs.append(("full", {}))
+        if "exact" in args.benchmarks:
+            runs.append(("exact", {"tile_size": args.exact_tile_size}))
+        if "kdtree" in args.benchmarks:
+            runs.append(("kdtree", {"tile_size": args.exact_tile_size}))
+        if "tiles" in args.benchmarks:
+            runs += [
+                ("tiles", {"tile_size": tile_size, "tile_padding": padding})
+                for tile_size in args.tile_sizes
+                for padding in args.paddings
+            ]
+
+        reference = work_dir / f"{stem}_full.tif"
+        for kind, params in runs:
+            suffix = "_".join(str(value) for value in params.values())
+            out_path = work_dir / f"{stem}_{kind}{'_' + suffix if suffix else ''}.tif"
+            result = {**case, "benchmark": kind, "params": params, **measure(kind, in_path, out_path, params)}
+            result["mpix_per_s"] = pixels / 1e6 / result["seconds"]
+            if kind not in ("prep", "full"):
+                result["accuracy"] = accuracy(out_path, reference)
+            results.append(result)
+            label = f"{kind} {params}" if params else kind
+            summary = f"{result['mpix_per_s']:.1f} Mpix/s, RSS {result['peak_rss_mb']:.0f} MB"
+            if "accuracy" in result:
+                summary += f", erro máx. {result['accuracy']['max_abs_error_m']:.1f} m"
+            print(f"    {label}: {summary}")
+            if kind != "full" and not args.keep_rasters:
+                out_path.unlink(missing_ok=True)
+        if not args.keep_rasters:
+            reference.unlink(missing_ok=True)
+            in_path.unlink(missing_ok=True)
+    return {"environment": environment(), "settings": vars(args), "results": results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark com rasters sintéticos de prep_binary_inputs.py e dos motores do dist_map.py."
+    )
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1024, 2048], help="Lados dos rasters (px).")
+    parser.add_argument(
+        "--densities",
+        nargs="+",
+        type=float,
+        default=[0.0005, 0.005],
+        help="Fração aproximada de pixels de feição.",
+    )
+    parser.add_argument("--themes", nargs="+", choices=THEMES, default=list(THEMES), help="Tipos de polilinha.")
+    parser.add_argument(
+        "--patterns",
+        nargs="+",
+        choices=NODATA_PATTERNS,
+        default=list(NODATA_PATTERNS),
+        help="background: fundo NoData (00_inputs_tiffs). outside: NoData fora de um contorno de UF.",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=["prep", "tiles", "exact", "full"],
+        help="Medições (o raster inteiro sempre roda: é a referência de acurácia).",
+    )
+    parser.add_argument("--tile-sizes", nargs="+", type=int, default=[512, 1024], help="Grade de --tile-size.")
+    parser.add_argument("--paddings", nargs="+", type=int, default=[64, 256], help="Grade de --tile-padding.")
+    parser.add_argument(
+        "--exact-tile-size",
+        type=int,
+        default=DEFAULT_EXACT_TILE_SIZE,
+        help="Tile de referência das faixas do motor exato/kdtree.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Semente dos rasters (mesma semente = mesmos rasters).")
+    parser.add_argument("--work-dir", default=None, help="Onde gravar os rasters (padrão: diretório temporário).")
+    parser.add_argument("--keep-rasters", action="store_true", help="Mantém entradas e saídas em --work-dir.")
+    parser.add_argument(
+        "--out",
+        default=None,
+        help="JSON de resultados (padrão: benchmarks/dist_map_<data-hora>.json).",
+    )
+    args = parser.parse_args()
+
+    out_path = Path(args.out or f"benchmarks/dist_map_{datetime.now():%Y%m%d-%H%M%S}.json")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        if args.work_dir is None:
+            work_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        else:
+            work_dir = Path(args.work_dir)
+            work_dir.mkdir(parents=True, exist_ok=True)
+        report = run_suite(args, work_dir)
+    out_path.write_text(json.dumps(report, indent=2))
+    print(f"Resultados em {out_path} ({len(report['results'])} medições).")
+
+
+if __name__ == "__main__":
+    main()
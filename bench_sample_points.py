@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark do `sample_points.py`: pontos em ordem aleatória × ordenados por bloco.
+
+Sorteia pontos lon/lat uniformes dentro do raster e os amostra em lotes (como
+chegam de um modelo ou do `--serve`), cada rodada com o cache LRU frio. Em ordem
+aleatória, cada lote toca quase todos os blocos e, com um cache menor que o raster,
+os blocos são relidos lote a lote; ordenados por bloco, cada bloco é lido uma vez.
+Resultado em JSON com pontos/s, blocos lidos e acertos do cache.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
+
+from bench_dist_map import environment
+from sample_points import POINT_CRS, RasterSampler
+
+ORDERS = ("random", "sorted")
+
+
+def random_points(path: Path, count: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    with rasterio.open(path) as src:
+        west, south, east, north = transform_bounds(src.crs, POINT_CRS, *src.bounds)
+    rng = np.random.default_rng(seed)
+    return rng.uniform(west, east, count), rng.uniform(south, north, count)
+
+
+def run_case(path: Path, lon: np.ndarray, lat: np.ndarray, order: str, cache_mb: float, chunk_points: int) -> dict:
+    with RasterSampler(path, cache_mb=cache_mb) as sampler:
+        start = time.perf_counter()
+        if order == "sorted":
+            # O custo da ordenação entra na medição.
+            values = sampler.sample_sorted(lon, lat, chunk_points)
+        else:
+            values = sampler.sample_chunked(lon, lat, chunk_points)
+        seconds = time.perf_counter() - start
+        stats = sampler.cache.stats()
+    return {
+        "order": order,
+        "cache_mb": cache_mb,
+        "chunk_points": chunk_points,
+        "seconds": seconds,
+        "points_per_s": lon.size / seconds,
+        "blocks_read": stats["misses"],
+        "cache_hits": stats["hits"],
+        "valid_values": int(np.isfinite(values).sum()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compara amostragem de pontos em ordem aleatória e ordenados por bloco.")
+    parser.add_argument("--raster", type=Path, required=True, help="Raster de distância a amostrar.")
+    parser.add_argument("--points", type=int, default=1_000_000, help="Quantidade de pontos sorteados.")
+    parser.add_argument("--chunk-points", type=int, default=100_000, help="Pontos por lote.")
+    parser.add_argument("--cache-mb", nargs="+", type=float, default=[64.0, 512.0], help="Limites do cache LRU.")
+    parser.add_argument("--seed", type=int, default=0, help="Semente dos pontos.")
+    parser.add_argument(
+        "--out",
+        default=None,
+        help="JSON de resultados (padrão: benchmarks/sample_points_<data-hora>.json).",
+    )
+    args = parser.parse_args()
+
+    lon, lat = random_points(args.raster, args.points, args.seed)
+    results = []
+    for cache_mb in args.cache_mb:
+        for order in ORDERS:
+            result = run_case(args.raster, lon, lat, order, cache_mb, max(1, args.chunk_points))
+            results.append(result)
+            print(
+                f"{order:>6}, cache {cache_mb:g} MB: {result['points_per_s'] / 1e6:.2f} Mpontos/s,"
+                f" {result['blocks_read']} blocos lidos, {result['cache_hits']} acertos"
+            )
+
+    out_path = Path(args.out or f"benchmarks/sample_points_{datetime.now():%Y%m%d-%H%M%S}.json")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    report = {"environment": environment(), "settings": {**vars(args), "raster": str(args.raster)}, "results": results}
+    out_path.write_text(json.dumps(report, indent=2))
+    print(f"Resultados em {out_path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,45 @@
-"""Recorta um GeoTIFF em um bounding box especificado."""
+"""Recorta um GeoTIFF em um bounding box especificado (ou em vários, com --batch).
 
+No modo em lote a fonte é aberta uma vez, os bboxes são reprojetados numa única
+chamada e cada recorte roda numa thread. Janelas grandes são copiadas em faixas
+(RAM limitada) e, quando a janela começa alinhada aos tiles da fonte, os tiles
+comprimidos são copiados byte a byte, sem descomprimir e recomprimir.
+"""
+
+import csv
+import json
+import math
+import os
+import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
 
+import numpy as np
 import rasterio
-from rasterio.windows import from_bounds
-from rasterio.warp import transform_bounds
+from rasterio.warp import transform, transform_bounds
+from rasterio.windows import Window, from_bounds
+
+# Mesmo adensamento das bordas que o transform_bounds(..., densify_pts=21) usado antes.
+DENSIFY_PTS = 21
+# Pixels por faixa na cópia decodificada (float64 de 1 banda: ~32 MB).
+STREAM_PIXELS = 1 << 22
+# Compressões cujos tiles são independentes (sem tabelas compartilhadas como no JPEG).
+RAW_COPY_COMPRESSIONS = {None, "none", "deflate", "lzw", "zstd", "packbits", "lzma", "lerc", "lerc_deflate", "lerc_zstd"}
+# Acima disso a saída vira BigTIFF antes de receber os tiles copiados (offsets de 32 bits).
+CLASSIC_TIFF_LIMIT = 3_900_000_000
+TILE_OFFSETS, TILE_BYTE_COUNTS = 324, 325
+TIFF_VALUE_FORMATS = {3: "H", 4: "I", 16: "Q"}
+
+
+class BBox(NamedTuple):
+    min_lon: float
+    min_lat: float
+    max_lon: float
+    max_lat: float
+    name: str | None = None
 
 
 def build_output_path(input_path: Path, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> Path:
@@ -13,6 +48,297 @@ def build_output_path(input_path: Path, min_lon: float, min_lat: float, max_lon:
     return input_path.with_name(f"{base}_{suffix}.tif")
 
 
+def safe_name(name: str) -> str:
+    """Nome do bbox usável como parte do arquivo: sem separadores de diretório nem espaços."""
+    return re.sub(r"[^\w.-]+", "_", name).strip("._")
+
+
+def batch_output_path(input_path: Path, bbox: BBox, out_dir: Path | None) -> Path:
+    name = safe_name(bbox.name) if bbox.name else ""
+    if name:
+        path = input_path.with_name(f"{input_path.stem}_{name}.tif")
+    else:
+        path = build_output_path(input_path, bbox.min_lon, bbox.min_lat, bbox.max_lon, bbox.max_lat)
+    return out_dir / path.name if out_dir is not None else path
+
+
+def read_bboxes(path: Path) -> list[BBox]:
+    """CSV (min_lon,min_lat,max_lon,max_lat[,name]) ou GeoJSON (bbox de cada feição, EPSG:4326)."""
+    if path.suffix.lower() in (".geojson", ".json"):
+        collection = json.loads(path.read_text())
+        features = collection["features"] if collection.get("type") == "FeatureCollection" else [collection]
+        bboxes = []
+        for index, feature in enumerate(features):
+            properties = feature.get("properties") or {}
+            name = properties.get("name", properties.get("id", feature.get("id", index)))
+            if "bbox" in feature:
+                min_lon, min_lat, max_lon, max_lat = feature["bbox"][:4]
+            else:
+                coords = np.array(list(_iter_positions(feature["geometry"]["coordinates"])), dtype=np.float64)
+                (min_lon, min_lat), (max_lon, max_lat) = coords[:, :2].min(axis=0), coords[:, :2].max(axis=0)
+            bboxes.append(BBox(float(min_lon), float(min_lat), float(max_lon), float(max_lat), str(name)))
+        return bboxes
+
+    with path.open(newline="") as handle:
+        return [
+            BBox(
+                float(row["min_lon"]),
+                float(row["min_lat"]),
+                float(row["max_lon"]),
+                float(row["max_lat"]),
+                row.get("name") or None,
+            )
+            for row in csv.DictReader(handle)
+        ]
+
+
+def _iter_positions(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for part in coordinates:
+        yield from _iter_positions(part)
+
+
+def transform_bboxes(bboxes: list[BBox], dst_crs, densify_pts: int = DENSIFY_PTS) -> np.ndarray:
+    """Todos os bboxes (EPSG:4326) para `dst_crs` numa única chamada ao PROJ.
+
+    Cada borda é adensada como no transform_bounds e o envelope dos pontos
+    reprojetados vira (left, bottom, right, top).
+    """
+    corners = np.array([bbox[:4] for bbox in bboxes], dtype=np.float64)
+    steps = np.linspace(0.0, 1.0, densify_pts + 2)
+    min_lon, min_lat, max_lon, max_lat = (corners[:, [i]] for i in range(4))
+    # Sul, leste, norte e oeste, cada borda com densify_pts pontos intermediários.
+    lons = np.hstack(
+        [
+            min_lon + (max_lon - min_lon) * steps,
+            np.repeat(max_lon, steps.size, axis=1),
+            max_lon - (max_lon - min_lon) * steps,
+            np.repeat(min_lon, steps.size, axis=1),
+        ]
+    )
+    lats = np.hstack(
+        [
+            np.repeat(min_lat, steps.size, axis=1),
+            min_lat + (max_lat - min_lat) * steps,
+            np.repeat(max_lat, steps.size, axis=1),
+            max_lat - (max_lat - min_lat) * steps,
+        ]
+    )
+    xs, ys = transform("EPSG:4326", dst_crs, lons.ravel(), lats.ravel())
+    xs = np.asarray(xs).reshape(lons.shape)
+    ys = np.asarray(ys).reshape(lats.shape)
+    return np.column_stack([xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)])
+
+
+def base_profile(src: rasterio.io.DatasetReader) -> dict:
+    """Perfil da fonte com o preditor, que o `src.profile` não traz."""
+    profile = src.profile
+    predictor = src.tags(ns="IMAGE_STRUCTURE").get("PREDICTOR")
+    if predictor is not None:
+        profile["predictor"] = int(predictor)
+    return profile
+
+
+def supports_raw_copy(src: rasterio.io.DatasetReader) -> bool:
+    """Tiles comprimidos podem ir direto: GTiff em tiles, 1 banda e compressão sem tabelas compartilhadas."""
+    if src.driver != "GTiff" or src.count != 1 or not src.profile.get("tiled"):
+        return False
+    compress = src.compression.name.lower() if src.compression else None
+    return compress in RAW_COPY_COMPRESSIONS
+
+
+def tiff_tile_arrays(handle) -> dict[int, tuple[str, int, int]]:
+    """Formato, quantidade e posição no arquivo dos TileOffsets/TileByteCounts do 1º IFD."""
+    header = handle.read(16)
+    order = "<" if header[:2] == b"II" else ">"
+    version = struct.unpack(order + "H", header[2:4])[0]
+    if version == 43:
+        ifd = struct.unpack(order + "Q", header[8:16])[0]
+        count_format, entry_format, entry_size, inline_size = "Q", "HHQ", 20, 8
+    else:
+        ifd = struct.unpack(order + "I", header[4:8])[0]
+        count_format, entry_format, entry_size, inline_size = "H", "HHI", 12, 4
+    handle.seek(ifd)
+    count_size = struct.calcsize(count_format)
+    entries = struct.unpack(order + count_format, handle.read(count_size))[0]
+    raw_entries = handle.read(entries * entry_size)
+    arrays = {}
+    for index in range(entries):
+        entry = raw_entries[index * entry_size : (index + 1) * entry_size]
+        tag, kind, values = struct.unpack(order + entry_format, entry[: entry_size - inline_size])
+        if tag not in (TILE_OFFSETS, TILE_BYTE_COUNTS):
+            continue
+        value_format = order + TIFF_VALUE_FORMATS[kind]
+        value_field = ifd + count_size + index * entry_size + entry_size - inline_size
+        if values * struct.calcsize(value_format) <= inline_size:
+            position = value_field
+        else:
+            position = struct.unpack(order + ("Q" if version == 43 else "I"), entry[entry_size - inline_size :])[0]
+        arrays[tag] = (value_format, values, position)
+    return arrays
+
+
+class SourceRaster:
+    """Fonte aberta uma única vez e compartilhada entre as threads.
+
+    O dataset do GDAL não é seguro entre threads: perfil, grade e blocos são lidos
+    aqui, na thread que abre a fonte, e as threads de recorte só usam `read`,
+    `tile_location` (ambos sob lock) e `read_tile_bytes` (`os.pread` no mesmo
+    descritor, sem lock). A compressão das saídas roda em paralelo.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.src = rasterio.open(path)
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDONLY)
+        self.profile = base_profile(self.src)
+        self.transform = self.src.transform
+        self.block_shape = self.src.block_shapes[0]
+        self.raw_copy = supports_raw_copy(self.src)
+
+    def output_profile(self, window: Window) -> dict:
+        profile = dict(self.profile)
+        profile.update(
+            width=window.width,
+            height=window.height,
+            transform=rasterio.windows.transform(window, self.transform),
+        )
+        return profile
+
+    def can_copy_raw(self, window: Window) -> bool:
+        """Cópia crua possível e janela começando na borda de um tile da fonte."""
+        block_rows, block_cols = self.block_shape
+        return self.raw_copy and window.row_off % block_rows == 0 and window.col_off % block_cols == 0
+
+    def close(self) -> None:
+        os.close(self.fd)
+        self.src.close()
+
+    def read(self, window: Window):
+        with self.lock:
+            return self.src.read(window=window)
+
+    def tile_location(self, col: int, row: int) -> tuple[int, int]:
+        with self.lock:
+            offset = self.src.get_tag_item(f"BLOCK_OFFSET_{col}_{row}", "TIFF", bidx=1)
+            size = self.src.get_tag_item(f"BLOCK_SIZE_{col}_{row}", "TIFF", bidx=1)
+        return int(offset or 0), int(size or 0)
+
+    def read_tile_bytes(self, offset: int, size: int) -> bytes:
+        return os.pread(self.fd, size, offset)
+
+
+def copy_window_streaming(source: SourceRaster, window: Window, output_path: Path) -> None:
+    """Copia a janela em faixas alinhadas aos blocos da saída (nunca a janela inteira em RAM)."""
+    profile = source.output_profile(window)
+    with rasterio.open(output_path, "w", **profile) as dst:
+        block_rows = dst.block_shapes[0][0]
+        rows = max(block_rows, STREAM_PIXELS // max(window.width, 1) // block_rows * block_rows)
+        for row in range(0, window.height, rows):
+            part = Window(0, row, window.width, min(rows, window.height - row))
+            source_part = Window(window.col_off, window.row_off + row, part.width, part.height)
+            dst.write(source.read(source_part), window=part)
+
+
+def copy_window_raw(source: SourceRaster, window: Window, output_path: Path) -> None:
+    """Cria a saída vazia (SPARSE_OK) com o mesmo perfil e anexa os tiles comprimidos da fonte.
+
+    Os tiles de borda da fonte podem conter pixels além da janela: no TIFF, a parte
+    do tile que passa da largura/altura da imagem é ignorada pelos leitores.
+    """
+    block_rows, block_cols = source.block_shape
+    first_row, first_col = window.row_off // block_rows, window.col_off // block_cols
+    tiles_down, tiles_across = math.ceil(window.height / block_rows), math.ceil(window.width / block_cols)
+    locations = [
+        source.tile_location(first_col + col, first_row + row)
+        for row in range(tiles_down)
+        for col in range(tiles_across)
+    ]
+
+    profile = source.output_profile(window)
+    profile.update(sparse_ok=True)
+    if sum(size for _, size in locations) > CLASSIC_TIFF_LIMIT:
+        profile["bigtiff"] = "YES"
+    with rasterio.open(output_path, "w", **profile):
+        pass
+
+    with output_path.open("r+b") as handle:
+        arrays = tiff_tile_arrays(handle)
+        offsets_format, count, offsets_position = arrays[TILE_OFFSETS]
+        sizes_format, _, sizes_position = arrays[TILE_BYTE_COUNTS]
+        if count != len(locations):
+            raise ValueError(f"{output_path}: {count} tiles no IFD, {len(locations)} esperados.")
+        handle.seek(0, os.SEEK_END)
+        new_offsets, new_sizes = [], []
+        for offset, size in locations:
+            if size == 0:
+                # Tile esparso na fonte continua esparso (lido como NoData/0).
+                new_offsets.append(0)
+                new_sizes.append(0)
+                continue
+            new_offsets.append(handle.tell())
+            new_sizes.append(size)
+            handle.write(source.read_tile_bytes(offset, size))
+        handle.seek(offsets_position)
+        handle.write(struct.pack(offsets_format[0] + offsets_format[1] * count, *new_offsets))
+        handle.seek(sizes_position)
+        handle.write(struct.pack(sizes_format[0] + sizes_format[1] * count, *new_sizes))
+
+
+def clip_window(source: SourceRaster, window: Window, output_path: Path) -> str:
+    if source.can_copy_raw(window):
+        copy_window_raw(source, window, output_path)
+        return "tiles copiados"
+    copy_window_streaming(source, window, output_path)
+    return "recodificado em faixas"
+
+
+def clip_batch(file: Path, bboxes: list[BBox], out_dir: Path | None = None, workers: int = 4) -> None:
+    source = SourceRaster(file)
+    try:
+        src = source.src
+        if src.crs is None:
+            raise rasterio.errors.CRSError("Fonte sem CRS definido.")
+        # Duas linhas com a mesma saída gravariam o mesmo arquivo em threads diferentes.
+        seen: dict[Path, BBox] = {}
+        for bbox in bboxes:
+            output_path = batch_output_path(file, bbox, out_dir)
+            if output_path in seen:
+                raise SystemExit(
+                    f"Saída {output_path.name} repetida no lote ({seen[output_path].name!r} e {bbox.name!r});"
+                    " use nomes distintos."
+                )
+            seen[output_path] = bbox
+        if out_dir is not None:
+            out_dir.mkdir(parents=True, exist_ok=True)
+
+        jobs = []
+        full = Window(0, 0, src.width, src.height)
+        for bbox, bounds, output_path in zip(bboxes, transform_bboxes(bboxes, src.crs), seen):
+            window = from_bounds(*bounds, src.transform).round_offsets().round_lengths()
+            try:
+                window = window.intersection(full)
+            except rasterio.errors.WindowError:
+                print(f"Ignorado {output_path.name}: bbox fora do raster.")
+                continue
+            jobs.append((window, output_path))
+
+        def run(job: tuple[Window, Path]) -> str:
+            window, output_path = job
+            mode = clip_window(source, window, output_path)
+            return f"Gravado {output_path} ({int(window.width)}x{int(window.height)} px, {mode})"
+
+        # As mensagens saem da thread principal, na ordem do lote, sem linhas misturadas.
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for message in pool.map(run, jobs):
+                print(message)
+    finally:
+        source.close()
+
+
 def main(file: Path, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> None:
     with rasterio.open(file) as src:
         if src.crs is None:
@@ -25,21 +351,21 @@ def main(file: Path, min_lon: float, min_lat: float, max_lon: float, max_lat: fl
             min_lat,
             max_lon,
             max_lat,
-            densify_pts=21,
+            densify_pts=DENSIFY_PTS,
         )
 
         window = from_bounds(*target_bounds, src.transform)
         window = window.round_offsets().round_lengths()
-        profile = src.profile
-        profile.update(
-            width=window.width,
-            height=window.height,
-            transform=rasterio.windows.transform(window, src.transform),
-        )
+        try:
+            window = window.intersection(Window(0, 0, src.width, src.height))
+        except rasterio.errors.WindowError:
+            raise ValueError("BBox não intersecta o raster.")
 
-        output_path = build_output_path(file, min_lon, min_lat, max_lon, max_lat)
-        with rasterio.open(output_path, "w", **profile) as dst:
-            dst.write(src.read(window=window))
+    source = SourceRaster(file)
+    try:
+        clip_window(source, window, build_output_path(file, min_lon, min_lat, max_lon, max_lat))
+    finally:
+        source.close()
 
 
 if __name__ == "__main__":
@@ -47,10 +373,26 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Recorta um TIFF em um bbox dados.")
     parser.add_argument("--file", type=Path, required=True, help="Caminho do TIFF de entrada.")
-    parser.add_argument("--min_lon", type=float, required=True, help="Longitude mínima do bbox.")
-    parser.add_argument("--min_lat", type=float, required=True, help="Latitude mínima do bbox.")
-    parser.add_argument("--max_lon", type=float, required=True, help="Longitude máxima do bbox.")
-    parser.add_argument("--max_lat", type=float, required=True, help="Latitude máxima do bbox.")
+    parser.add_argument("--min_lon", type=float, help="Longitude mínima do bbox.")
+    parser.add_argument("--min_lat", type=float, help="Latitude mínima do bbox.")
+    parser.add_argument("--max_lon", type=float, help="Longitude máxima do bbox.")
+    parser.add_argument("--max_lat", type=float, help="Latitude máxima do bbox.")
+    parser.add_argument(
+        "--batch",
+        type=Path,
+        help=(
+            "CSV (min_lon,min_lat,max_lon,max_lat[,name]) ou GeoJSON em EPSG:4326 com vários bboxes;"
+            " a fonte é aberta uma única vez."
+        ),
+    )
+    parser.add_argument("--out-dir", type=Path, help="Diretório dos recortes do --batch (padrão: junto da fonte).")
+    parser.add_argument("--workers", type=int, default=4, help="Threads de recorte no --batch.")
     args = parser.parse_args()
 
-    main(args.file, args.min_lon, args.min_lat, args.max_lon, args.max_lat)
+    if args.batch is not None:
+        clip_batch(args.file, read_bboxes(args.batch), args.out_dir, args.workers)
+    else:
+        coords = (args.min_lon, args.min_lat, args.max_lon, args.max_lat)
+        if any(value is None for value in coords):
+            parser.error("Informe --min_lon/--min_lat/--max_lon/--max_lat ou --batch.")
+        main(args.file, *coords)
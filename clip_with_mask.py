@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Recorta um GeoTIFF pelo polígono de um shapefile (mesma grade, sem passar pelo warper).
+
+Substitui o `gdalwarp -cutline -crop_to_cutline -dstnodata -9999` quando raster e
+shapefile já estão no mesmo CRS: a extensão é cortada no bbox do polígono e o
+polígono é rasterizado uma única vez por grade, em células de `cell_size` pixels
+(cache `.clipmask.npz` ao lado do shapefile). Células fora do polígono nem são
+lidas, células inteiras dentro são copiadas direto e só as da borda recebem máscara.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import struct
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from scipy.ndimage import binary_dilation
+
+from prep_binary_inputs import nodata_is_nan
+from show_crs import format_crs, read_shapefile_crs
+
+# Mesmo NoData do fluxo com gdalwarp (run_clip_masks.sh / run_mosaics.sh).
+CLIP_FLOAT_NODATA = -9999.0
+DEFAULT_CELL_SIZE = 512
+CLIPMASK_SUFFIX = ".clipmask.npz"
+
+# Tipos de shape com polígonos: Polygon, PolygonZ e PolygonM.
+SHP_POLYGON_TYPES = (5, 15, 25)
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+def read_shapefile_polygons(path: Path) -> list[list[list[tuple[float, float]]]]:
+    """Lê os anéis de cada registro poligonal do .shp (sem depender de fiona/OGR)."""
+    data = path.read_bytes()
+    file_code, = struct.unpack(">i", data[:4])
+    if file_code != 9994:
+        raise ValueError(f"{path} não é um shapefile válido.")
+
+    polygons = []
+    offset = 100
+    while offset + 8 <= len(data):
+        _, content_words = struct.unpack(">2i", data[offset:offset + 8])
+        start = offset + 8
+        offset = start + content_words * 2
+        shape_type, = struct.unpack("<i", data[start:start + 4])
+        if shape_type == 0:
+            continue
+        if shape_type not in SHP_POLYGON_TYPES:
+            raise ValueError(f"{path}: tipo de geometria {shape_type} não é polígono.")
+        num_parts, num_points = struct.unpack("<2i", data[start + 36:start + 44])
+        parts_start = start + 44
+        parts = list(struct.unpack(f"<{num_parts}i", data[parts_start:parts_start + 4 * num_parts]))
+        points_start = parts_start + 4 * num_parts
+        points = np.frombuffer(data, dtype="<f8", count=2 * num_points, offset=points_start).reshape(-1, 2)
+        bounds = parts + [num_points]
+        polygons.append([[tuple(point) for point in points[a:b]] for a, b in zip(bounds[:-1], bounds[1:])])
+    return polygons
+
+
+def read_geojson_polygons(path: Path) -> list[list[list[tuple[float, float]]]]:
+    data = json.loads(path.read_text())
+    features = data.get("features", [data])
+    polygons = []
+    for feature in features:
+        geometry = feature.get("geometry", feature)
+        if geometry["type"] == "Polygon":
+            polygons.append(geometry["coordinates"])
+        elif geometry["type"] == "MultiPolygon":
+            polygons.extend(geometry["coordinates"])
+        else:
+            raise ValueError(f"{path}: geometria {geometry['type']} não é polígono.")
+    return polygons
+
+
+def read_polygons(path: Path) -> list[list[list[tuple[float, float]]]]:
+    if path.suffix.lower() == ".shp":
+        return read_shapefile_polygons(path)
+    if path.suffix.lower() in (".geojson", ".json"):
+        return read_geojson_polygons(path)
+    raise ValueError("Máscara não suportada. Use shapefile (.shp) ou GeoJSON.")
+
+
+def polygon_shapes(polygons: list) -> list[dict]:
+    # Todos os anéis de um registro num único Polygon: o GDAL preenche por par/ímpar,
+    # o que resolve furos e ilhas sem precisar saber quem é anel externo.
+    return [{"type": "Polygon", "coordinates": rings} for rings in polygons]
+
+
+def ring_shapes(polygons: list) -> list[dict]:
+    return [{"type": "LineString", "coordinates": ring} for rings in polygons for ring in rings]
+
+
+def check_shape_crs(shape_path: Path, crs: rasterio.crs.CRS | None) -> None:
+    """O recorte não reprojeta: o shapefile precisa estar no CRS do raster."""
+    if shape_path.suffix.lower() != ".shp" or not shape_path.with_suffix(".prj").exists():
+        return
+    shape_crs = read_shapefile_crs(shape_path)
+    if shape_crs is not None and crs is not None and shape_crs != crs:
+        raise ValueError(
+            f"{shape_path.name} está em {format_crs(shape_crs)} e o raster em {format_crs(crs)}; reprojete o shapefile."
+        )
+
+
+def crop_window(polygons: list, transform: Affine, height: int, width: int) -> Window:
+    """Janela (pixels inteiros) do bbox do polígono, limitada ao raster."""
+    points = np.array([point for rings in polygons for ring in rings for point in ring], dtype=np.float64)
+    cols, rows = ~transform * (points[:, 0], points[:, 1])
+    row_start = max(0, math.floor(rows.min()))
+    row_stop = min(height, math.ceil(rows.max()))
+    col_start = max(0, math.floor(cols.min()))
+    col_stop = min(width, math.ceil(cols.max()))
+    if row_stop <= row_start or col_stop <= col_start:
+        raise ValueError("O polígono não intersecta o raster.")
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def clip_nodata(dtype: str, nodata: float | int | None) -> float | int:
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        return CLIP_FLOAT_NODATA
+    if nodata is None:
+        raise ValueError("Raster inteiro sem NoData: não há valor para marcar fora do polígono.")
+    return nodata
+
+
+def clipped_profile(profile: dict, mask: "CutlineMask") -> dict:
+    """Perfil com a extensão recortada e o NoData usado fora do polígono."""
+    profile = dict(profile)
+    profile.update(
+        height=mask.crop.height,
+        width=mask.crop.width,
+        transform=mask.transform,
+        nodata=clip_nodata(profile["dtype"], profile.get("nodata")),
+    )
+    return profile
+
+
+class CutlineMask:
+    """Polígono rasterizado na grade recortada, guardado por células de `cell_size` px.
+
+    `classes` marca cada célula como fora, dentro ou borda; só as células de borda
+    guardam a máscara por pixel (em bits).
+    """
+
+    def __init__(
+        self,
+        crop: Window,
+        transform: Affine,
+        cell_size: int,
+        classes: np.ndarray,
+        boundary_cells: np.ndarray,
+        boundary_bits: np.ndarray,
+    ) -> None:
+        self.crop = crop
+        self.transform = transform
+        self.cell_size = cell_size
+        self.classes = classes
+        self.boundary_index = {int(cell): index for index, cell in enumerate(boundary_cells)}
+        self.boundary_cells = boundary_cells
+        self.boundary_bits = boundary_bits
+
+    @classmethod
+    def build(
+        cls,
+        polygons: list,
+        src_transform: Affine,
+        height: int,
+        width: int,
+        cell_size: int = DEFAULT_CELL_SIZE,
+    ) -> "CutlineMask":
+        crop = crop_window(polygons, src_transform, height, width)
+        transform = window_transform(crop, src_transform)
+        shapes = polygon_shapes(polygons)
+        grid = (math.ceil(crop.height / cell_size), math.ceil(crop.width / cell_size))
+        cell_transform = transform * Affine.scale(cell_size)
+
+        touched = rasterize(shapes, out_shape=grid, transform=cell_transform, all_touched=True, dtype="uint8")
+        crossed = rasterize(
+            ring_shapes(polygons), out_shape=grid, transform=cell_transform, all_touched=True, dtype="uint8"
+        )
+        # Uma célula de folga em volta do contorno cobre arredondamentos do all_touched.
+        boundary = binary_dilation(crossed.astype(bool), structure=np.ones((3, 3), dtype=bool)) & touched.astype(bool)
+        classes = np.where(touched.astype(bool), INSIDE, OUTSIDE).astype(np.uint8)
+        classes[boundary] = BOUNDARY
+
+        boundary_cells = np.flatnonzero(classes == BOUNDARY).astype(np.int64)
+        boundary_bits = np.zeros((boundary_cells.size, cell_size * cell_size // 8), dtype=np.uint8)
+        for index, cell in enumerate(boundary_cells):
+            window = cls._cell_window(int(cell), grid[1], cell_size, crop)
+            cell_mask = np.zeros((cell_size, cell_size), dtype=bool)
+            cell_mask[: window.height, : window.width] = rasterize(
+                shapes,
+                out_shape=(window.height, window.width),
+                transform=window_transform(window, transform),
+                dtype="uint8",
+            ).astype(bool)
+            boundary_bits[index] = np.packbits(cell_mask)
+        return cls(crop, transform, cell_size, classes, boundary_cells, boundary_bits)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        shape_path: Path,
+        src: rasterio.io.DatasetReader,
+        cell_size: int = DEFAULT_CELL_SIZE,
+    ) -> "CutlineMask":
+        """Reaproveita o cache enquanto shapefile, grade e `cell_size` não mudarem."""
+        stat = shape_path.stat()
+        key = f"{stat.st_size}:{stat.st_mtime_ns}:{src.height}x{src.width}:{tuple(src.transform)}:{cell_size}"
+        digest = hashlib.sha256(key.encode()).hexdigest()[:12]
+        cache_path = shape_path.with_name(f"{shape_path.name}.{digest}{CLIPMASK_SUFFIX}")
+        if cache_path.exists():
+            with np.load(cache_path) as cached:
+                crop = Window(*(int(value) for value in cached["crop"]))
+                return cls(
+                    crop,
+                    window_transform(crop, src.transform),
+                    cell_size,
+                    cached["classes"],
+                    cached["boundary_cells"],
+                    cached["boundary_bits"],
+                )
+
+        mask = cls.build(read_polygons(shape_path), src.transform, src.height, src.width, cell_size)
+        with cache_path.open("wb") as handle:
+            np.savez_compressed(
+                handle,
+                crop=np.array([mask.crop.col_off, mask.crop.row_off, mask.crop.width, mask.crop.height]),
+                classes=mask.classes,
+                boundary_cells=mask.boundary_cells,
+                boundary_bits=mask.boundary_bits,
+            )
+        return mask
+
+    @staticmethod
+    def _cell_window(cell: int, grid_cols: int, cell_size: int, crop: Window) -> Window:
+        row, col = divmod(cell, grid_cols)
+        row_off, col_off = row * cell_size, col * cell_size
+        return Window(
+            col_off,
+            row_off,
+            min(cell_size, crop.width - col_off),
+            min(cell_size, crop.height - row_off),
+        )
+
+    def iter_cells(self) -> list[tuple[Window, int]]:
+        """Células da grade recortada com a classe de cada uma."""
+        grid_cols = self.classes.shape[1]
+        return [
+            (self._cell_window(cell, grid_cols, self.cell_size, self.crop), int(state))
+            for cell, state in enumerate(self.classes.ravel())
+        ]
+
+    def summary(self) -> str:
+        counts = np.bincount(self.classes.ravel(), minlength=3)
+        return f"{counts[INSIDE]} células dentro, {counts[BOUNDARY]} na borda, {counts[OUTSIDE]} fora"
+
+    def window_mask(self, window: Window) -> bool | np.ndarray:
+        """True/False se a janela (grade recortada) está toda dentro/fora, senão a máscara."""
+        size = self.cell_size
+        rows = slice(window.row_off // size, (window.row_off + window.height - 1) // size + 1)
+        cols = slice(window.col_off // size, (window.col_off + window.width - 1) // size + 1)
+        classes = self.classes[rows, cols]
+        if (classes == INSIDE).all():
+            return True
+        if (classes == OUTSIDE).all():
+            return False
+
+        mask = np.zeros((window.height, window.width), dtype=bool)
+        grid_cols = self.classes.shape[1]
+        for cell_row in range(rows.start, rows.stop):
+            for cell_col in range(cols.start, cols.stop):
+                state = self.classes[cell_row, cell_col]
+                if state == OUTSIDE:
+                    continue
+                row_start = max(window.row_off, cell_row * size)
+                row_stop = min(window.row_off + window.height, (cell_row + 1) * size)
+                col_start = max(window.col_off, cell_col * size)
+                col_stop = min(window.col_off + window.width, (cell_col + 1) * size)
+                target = (
+                    slice(row_start - window.row_off, row_stop - window.row_off),
+                    slice(col_start - window.col_off, col_stop - window.col_off),
+                )
+                if state == INSIDE:
+                    mask[target] = True
+                    continue
+                bits = self.boundary_bits[self.boundary_index[cell_row * grid_cols + cell_col]]
+                cell_mask = np.unpackbits(bits, count=size * size).reshape(size, size).astype(bool)
+                mask[target] = cell_mask[
+                    row_start - cell_row * size:row_stop - cell_row * size,
+                    col_start - cell_col * size:col_stop - cell_col * size,
+                ]
+        return mask
+
+    def clip_block(
+        self,
+        block: np.ndarray,
+        window: Window,
+        nodata: float | int,
+    ) -> tuple[Window, np.ndarray] | None:
+        """Leva um bloco da grade de origem para a recortada e aplica a máscara.
+
+        Aceita blocos 2D ou (bandas, linhas, colunas). Retorna None se nada do bloco
+        cai dentro do polígono (não há o que gravar).
+        """
+        row_start = max(window.row_off, self.crop.row_off)
+        row_stop = min(window.row_off + window.height, self.crop.row_off + self.crop.height)
+        col_start = max(window.col_off, self.crop.col_off)
+        col_stop = min(window.col_off + window.width, self.crop.col_off + self.crop.width)
+        if row_stop <= row_start or col_stop <= col_start:
+            return None
+
+        out_window = Window(
+            col_start - self.crop.col_off,
+            row_start - self.crop.row_off,
+            col_stop - col_start,
+            row_stop - row_start,
+        )
+        mask = self.window_mask(out_window)
+        if mask is False:
+            return None
+
+        data = block[
+            ...,
+            row_start - window.row_off:row_stop - window.row_off,
+            col_start - window.col_off:col_stop - window.col_off,
+        ]
+        data = np.array(data, copy=True)
+        if np.issubdtype(data.dtype, np.floating):
+            data[np.isnan(data)] = nodata
+        if mask is not True:
+            data[..., ~mask] = nodata
+        return out_window, data
+
+
+def clip_raster(
+    in_path: Path,
+    shape_path: Path,
+    out_path: Path,
+    cell_size: int = DEFAULT_CELL_SIZE,
+) -> None:
+    with rasterio.open(in_path) as src:
+        check_shape_crs(shape_path, src.crs)
+        mask = CutlineMask.load_or_build(shape_path, src, cell_size)
+        profile = clipped_profile(src.profile, mask)
+        # Blocos da saída = células da máscara: cada bloco é lido, mascarado e comprimido uma vez.
+        profile.update(tiled=True, blockxsize=cell_size, blockysize=cell_size)
+        nodata = profile["nodata"]
+        src_nodata = src.nodata
+        print(f"Recortando {in_path.name} com {shape_path.name}: {mask.summary()}.")
+
+        if out_path.exists():
+            out_path.unlink()
+        with rasterio.open(out_path, "w", **profile) as dst:
+            for window, state in mask.iter_cells():
+                if state == OUTSIDE:
+                    continue
+                src_window = Window(
+                    window.col_off + mask.crop.col_off,
+                    window.row_off + mask.crop.row_off,
+                    window.width,
+                    window.height,
+                )
+                block = src.read(window=src_window, masked=False)
+                if src_nodata is not None and not nodata_is_nan(src_nodata) and src_nodata != nodata:
+                    block[block == src_nodata] = nodata
+                if np.issubdtype(block.dtype, np.floating):
+                    block[np.isnan(block)] = nodata
+                if state == BOUNDARY:
+                    block[:, ~mask.window_mask(window)] = nodata
+                dst.write(block, window=window)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Recorta um GeoTIFF pelo polígono de um shapefile na mesma grade (equivale a gdalwarp -cutline -crop_to_cutline)."
+    )
+    parser.add_argument("--in", dest="in_tif", required=True, help="GeoTIFF de entrada.")
+    parser.add_argument("--shape", required=True, help="Shapefile (.shp) ou GeoJSON com o polígono, no CRS do raster.")
+    parser.add_argument("--out", dest="out_tif", required=True, help="GeoTIFF recortado (NoData -9999 em float).")
+    parser.add_argument(
+        "--cell-size",
+        dest="cell_size",
+        type=int,
+        default=DEFAULT_CELL_SIZE,
+        help="Lado das células da máscara e dos blocos da saída (múltiplo de 16).",
+    )
+    args = parser.parse_args()
+
+    in_path = Path(args.in_tif)
+    shape_path = Path(args.shape)
+    if not in_path.exists():
+        raise SystemExit(f"Arquivo não encontrado: {in_path}")
+    if not shape_path.exists():
+        raise SystemExit(f"Máscara não encontrada: {shape_path}")
+    if args.cell_size <= 0 or args.cell_size % 16:
+        raise SystemExit("--cell-size precisa ser múltiplo de 16.")
+    Path(args.out_tif).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        clip_raster(in_path, shape_path, Path(args.out_tif), args.cell_size)
+    except ValueError as exc:
+        raise SystemExit(str(exc))
+
+
+if __name__ == "__main__":
+    main()
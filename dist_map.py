@@ -4,17 +4,38 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
 import math
+import os
+import resource
 import tempfile
+import time
+from contextlib import ExitStack
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterator, Tuple
 
 import numpy as np
 import rasterio
+import rasterio.shutil
 from rasterio.transform import Affine
 from rasterio.windows import Window
 from rasterio.crs import CRS
-from scipy.ndimage import distance_transform_edt
+from scipy.ndimage import distance_transform_cdt, distance_transform_edt
+from scipy.spatial import cKDTree
+
+from clip_with_mask import DEFAULT_CELL_SIZE, CutlineMask, check_shape_crs, clipped_profile
+from instrumentation import add_metrics_arguments, configure_from_args, metrics
+from prep_binary_inputs import to_binary_block
 
 
 def window_slices(window: Window) -> tuple[slice, slice]:
@@ -24,7 +45,197 @@ def window_slices(window: Window) -> tuple[slice, slice]:
     )
 
 
-def allocate_memmap(tmpdir: Path, name: str, dtype: np.dtype, shape: tuple[int, int]) -> np.memmap:
+def has_nodata_mask(nodata: float | int | None) -> bool:
+    """NoData ausente, 0 ou 1 não marca pixels inválidos (caso dos binários de prep_binary_inputs.py)."""
+    return not (nodata is None or nodata in (0, 1))
+
+
+def feature_mask_block(block: np.ndarray, nodata: float | int | None) -> tuple[np.ndarray, np.ndarray]:
+    """Retorna (feições, válidos) de um bloco: feição = pixel == 1 fora do NoData."""
+    if not has_nodata_mask(nodata):
+        mask = np.ones(block.shape, dtype=bool)
+    else:
+        mask = block != nodata
+    return (block == 1) & mask, mask
+
+
+class NormalizedBinaryReader:
+    """Envolve um raster bruto (00_inputs_tiffs) e entrega blocos já normalizados.
+
+    Cada `read` passa por `to_binary_block` (1 = feição, 0 = fundo, sem NoData), igual
+    ao que `prep_binary_inputs.py` gravaria em disco; o restante é delegado ao dataset.
+    """
+
+    def __init__(self, src: rasterio.io.DatasetReader) -> None:
+        self._src = src
+
+    def __getattr__(self, name: str):
+        return getattr(self._src, name)
+
+    def __enter__(self) -> "NormalizedBinaryReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._src.close()
+
+    @property
+    def nodata(self) -> None:
+        return None
+
+    @property
+    def raw_nodata(self) -> float | int | None:
+        return self._src.nodata
+
+    @property
+    def profile(self):
+        profile = self._src.profile
+        profile.update(dtype="uint8", count=1, nodata=None)
+        return profile
+
+    def read(self, indexes: int, window: Window | None = None, masked: bool = False) -> np.ndarray:
+        return to_binary_block(self._src.read(indexes, window=window, masked=False), self._src.nodata)
+
+
+# Separador de `--in` para juntar várias entradas numa camada virtual (ex.: uma por UF).
+VIRTUAL_SEPARATOR = ","
+# NoData da camada virtual: pixels fora de todas as entradas.
+VIRTUAL_NODATA = 255
+VIRTUAL_BLOCK_SIZE = 512
+
+
+class VirtualMosaic:
+    """Várias entradas alinhadas (ex.: estradas de RS, SC e PR) lidas como um só raster.
+
+    A grade é a união das extensões, no mesmo pixel. Cada `read` lê só os pedaços das
+    entradas que cruzam a janela, então a RAM continua limitada pela janela pedida.
+    Na sobreposição vale feição se for feição em qualquer entrada; fora de todas é NoData.
+    """
+
+    def __init__(self, sources: list, name: str | None = None) -> None:
+        reference = sources[0]
+        px, py = reference.transform.a, reference.transform.e
+        left = min(src.transform.c for src in sources)
+        top = max(src.transform.f for src in sources)
+        right = max(src.transform.c + src.width * px for src in sources)
+        bottom = min(src.transform.f + src.height * py for src in sources)
+
+        self.sources = sources
+        self.offsets = []
+        for src in sources:
+            if src.crs != reference.crs:
+                raise SystemExit(f"{src.name} tem CRS {format_crs(src.crs)}, diferente de {format_crs(reference.crs)}.")
+            if (src.transform.a, src.transform.e, src.transform.b, src.transform.d) != (px, py, 0.0, 0.0):
+                raise SystemExit(f"{src.name}: pixel diferente de {reference.name}; não dá para juntar sem reamostrar.")
+            col = (src.transform.c - left) / px
+            row = (src.transform.f - top) / py
+            if not np.isclose(col, round(col), atol=1e-6) or not np.isclose(row, round(row), atol=1e-6):
+                raise SystemExit(f"{src.name} está desalinhado em relação a {reference.name}.")
+            self.offsets.append((round(row), round(col)))
+
+        self.name = name or VIRTUAL_SEPARATOR.join(src.name for src in sources)
+        self.raw = any(isinstance(src, NormalizedBinaryReader) for src in sources)
+        self.crs = reference.crs
+        self.width = round((right - left) / px)
+        self.height = round((bottom - top) / py)
+        self.transform = Affine(px, 0.0, left, 0.0, py, top)
+        self.nodata = VIRTUAL_NODATA
+        self.count = 1
+        self.block_shapes = [(VIRTUAL_BLOCK_SIZE, VIRTUAL_BLOCK_SIZE)]
+
+    @classmethod
+    def open(cls, paths: list[str], raw: bool) -> "VirtualMosaic":
+        sources = []
+        try:
+            for path in paths:
+                sources.append(open_input(path, raw))
+            return cls(sources, VIRTUAL_SEPARATOR.join(paths))
+        except BaseException:
+            for src in sources:
+                src.close()
+            raise
+
+    def __enter__(self) -> "VirtualMosaic":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for src in self.sources:
+            src.close()
+
+    @property
+    def raw_nodata(self) -> float | int | None:
+        return getattr(self.sources[0], "raw_nodata", self.sources[0].nodata)
+
+    @property
+    def profile(self):
+        profile = self.sources[0].profile
+        profile.update(
+            dtype="uint8",
+            count=1,
+            nodata=VIRTUAL_NODATA,
+            height=self.height,
+            width=self.width,
+            transform=self.transform,
+        )
+        return profile
+
+    def block_windows(self, bidx: int = 1) -> Iterator[tuple[tuple[int, int], Window]]:
+        for row_off in range(0, self.height, VIRTUAL_BLOCK_SIZE):
+            for col_off in range(0, self.width, VIRTUAL_BLOCK_SIZE):
+                window = Window(
+                    col_off,
+                    row_off,
+                    min(VIRTUAL_BLOCK_SIZE, self.width - col_off),
+                    min(VIRTUAL_BLOCK_SIZE, self.height - row_off),
+                )
+                yield (row_off // VIRTUAL_BLOCK_SIZE, col_off // VIRTUAL_BLOCK_SIZE), window
+
+    def read(self, indexes: int, window: Window | None = None, masked: bool = False) -> np.ndarray:
+        """Bloco uint8 da grade virtual: 1 = feição, 0 = fundo, VIRTUAL_NODATA = sem entrada."""
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        block = np.full((height, width), VIRTUAL_NODATA, dtype=np.uint8)
+        for src, (src_row, src_col) in zip(self.sources, self.offsets):
+            row_start = max(row_off - src_row, 0)
+            row_stop = min(row_off + height - src_row, src.height)
+            col_start = max(col_off - src_col, 0)
+            col_stop = min(col_off + width - src_col, src.width)
+            if row_stop <= row_start or col_stop <= col_start:
+                continue
+            part = src.read(
+                indexes, window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start), masked=False
+            )
+            features, valid = feature_mask_block(part, src.nodata)
+            target = block[
+                row_start + src_row - row_off:row_stop + src_row - row_off,
+                col_start + src_col - col_off:col_stop + src_col - col_off,
+            ]
+            target[valid & (target == VIRTUAL_NODATA)] = 0
+            target[features] = 1
+        return block
+
+
+def open_input(in_path: str, raw: bool) -> rasterio.io.DatasetReader | NormalizedBinaryReader | VirtualMosaic:
+    """Abre uma entrada; caminhos separados por vírgula viram uma `VirtualMosaic`."""
+    if VIRTUAL_SEPARATOR in in_path:
+        return VirtualMosaic.open(in_path.split(VIRTUAL_SEPARATOR), raw)
+    src = rasterio.open(in_path)
+    return NormalizedBinaryReader(src) if raw else src
+
+
+def is_raw_input(src) -> bool:
+    return isinstance(src, NormalizedBinaryReader) or (isinstance(src, VirtualMosaic) and src.raw)
+
+
+def input_layer_name(in_path: str) -> str:
+    return "+".join(Path(path).stem for path in in_path.split(VIRTUAL_SEPARATOR))
+
+
+def allocate_memmap(tmpdir: Path, name: str, dtype: np.dtype, shape: tuple[int, ...]) -> np.memmap:
     path = tmpdir / name
     return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
 
@@ -38,6 +249,7 @@ class ProgressPrinter:
         self.current = 0
         self.mode = mode
         self.last_value = -1
+        self.started = time.perf_counter()
         self._print_status(force=True)
 
     def _print_status(self, force: bool = False) -> None:
@@ -61,6 +273,12 @@ class ProgressPrinter:
         target = self.total if self.mode == "count" else 100
         already_reported = self.last_value == target
         self._print_status(force=not already_reported)
+        metrics.event("progress", label=self.label, steps=self.total, wall_s=time.perf_counter() - self.started)
+
+
+def peak_rss_mb() -> float:
+    """Pico de memória residente do processo (ru_maxrss vem em KB no Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 
 def format_crs(crs: CRS | None) -> str:
@@ -88,43 +306,218 @@ def build_binary_arrays(
     src: rasterio.io.DatasetReader,
     tmpdir: Path,
     progress: ProgressPrinter | None = None,
-) -> tuple[np.memmap, np.memmap]:
-    """Converte o raster em duas matrizes memmap: binária (rios=0) e máscara de válidos."""
+) -> tuple[np.memmap, np.memmap | None]:
+    """Converte o raster em memmaps: binária (rios=0) e, se houver NoData, máscara de válidos."""
     shape = (src.height, src.width)
-    rivers_zero = allocate_memmap(tmpdir, "rivers.uint8", np.uint8, shape)
-    valid_mask = allocate_memmap(tmpdir, "valid.bool", np.bool_, shape)
     nodata = src.nodata
+    rivers_zero = allocate_memmap(tmpdir, "rivers.uint8", np.uint8, shape)
+    valid_mask = allocate_memmap(tmpdir, "valid.bool", np.bool_, shape) if has_nodata_mask(nodata) else None
 
-    for _, window in src.block_windows(1):
-        row_slice, col_slice = window_slices(window)
-        block = src.read(1, window=window, masked=False)
-
-        if nodata is None or nodata in (0, 1):
-            mask = np.ones(block.shape, dtype=bool)
-        else:
-            mask = block != nodata
-
-        valid_mask[row_slice, col_slice] = mask
-
-        rivers_zero[row_slice, col_slice] = np.where((block == 1) & mask, 0, 1).astype(np.uint8, copy=False)
-        if progress is not None:
-            progress.increment()
+    with metrics.hot_loop("build_binary_arrays"):
+        for index, (_, window) in enumerate(src.block_windows(1)):
+            row_slice, col_slice = window_slices(window)
+            with metrics.stage("read", block=index):
+                block = src.read(1, window=window, masked=False)
+            with metrics.stage("binarize", block=index):
+                features, mask = feature_mask_block(block, nodata)
+                if valid_mask is not None:
+                    valid_mask[row_slice, col_slice] = mask
+                rivers_zero[row_slice, col_slice] = np.where(features, 0, 1).astype(np.uint8, copy=False)
+            if progress is not None:
+                progress.increment()
 
     rivers_zero.flush()
-    valid_mask.flush()
+    if valid_mask is not None:
+        valid_mask.flush()
     if progress is not None:
         progress.finish()
     return rivers_zero, valid_mask
 
 
-def write_distance_raster(
-    src: rasterio.io.DatasetReader,
-    distance_mm: np.memmap,
-    out_path: Path,
-    progress: ProgressPrinter | None = None,
-) -> None:
-    if out_path.exists():
-        out_path.unlink()
+# Sidecar do índice de ocupação, gravado ao lado do raster de entrada.
+OCCUPANCY_SUFFIX = ".occupancy.npz"
+
+# NoData da saída quantizada (uint16); o maior valor válido é QUANTIZED_NODATA - 1.
+QUANTIZED_NODATA = 65535
+
+
+@dataclass(frozen=True)
+class DistanceEncoding:
+    """Limite de distância (metros) e codificação da saída: float32 ou uint16 quantizado.
+
+    Com `quantize_step`, cada pixel guarda round(distância / step) e o GeoTIFF declara
+    scale=step/offset=0, então leitores que aplicam scale/offset recuperam metros.
+    """
+
+    max_distance: float | None = None
+    quantize_step: float | None = None
+
+    def __post_init__(self) -> None:
+        if self.max_distance is not None and self.max_distance <= 0:
+            raise ValueError("--max-distance deve ser positivo.")
+        if self.quantize_step is None:
+            return
+        if self.quantize_step <= 0:
+            raise ValueError("--quantize-step deve ser positivo.")
+        if self.max_distance is None:
+            raise ValueError("--quantize-step exige --max-distance para caber em uint16.")
+        if round(self.max_distance / self.quantize_step) >= QUANTIZED_NODATA:
+            raise ValueError(
+                f"--max-distance {self.max_distance} / --quantize-step {self.quantize_step} excede"
+                f" {QUANTIZED_NODATA - 1} níveis de uint16; aumente o passo ou reduza o limite."
+            )
+
+    def update_profile(self, profile: dict) -> dict:
+        if self.quantize_step is not None:
+            profile.update(dtype="uint16", nodata=QUANTIZED_NODATA, predictor=2)
+        return profile
+
+    def annotate(self, dst: rasterio.io.DatasetWriter) -> None:
+        if self.quantize_step is not None:
+            dst.scales = (self.quantize_step,) * dst.count
+            dst.offsets = (0.0,) * dst.count
+        if self.max_distance is not None:
+            for band in range(1, dst.count + 1):
+                dst.update_tags(band, MAX_DISTANCE=str(self.max_distance))
+
+    def encode(self, distance: np.ndarray) -> np.ndarray:
+        """Satura no limite e, se pedido, quantiza (NaN vira QUANTIZED_NODATA)."""
+        if self.max_distance is not None:
+            distance = np.minimum(distance, np.float32(self.max_distance))
+        if self.quantize_step is None:
+            return distance
+        valid = np.isfinite(distance)
+        encoded = np.full(distance.shape, QUANTIZED_NODATA, dtype=np.uint16)
+        encoded[valid] = np.rint(distance[valid] / self.quantize_step)
+        return encoded
+
+
+NEAREST_KINDS = ("index", "offset")
+NEAREST_SUFFIX = "_nearest"
+
+
+@dataclass(frozen=True)
+class NearestEncoding:
+    """Saída opcional com a feição mais próxima de cada pixel (2 bandas por camada).
+
+    `index`: linha/coluna globais da feição (int32). `offset`: dy/dx em pixels até a
+    feição (feição = pixel + deslocamento), em int16 quando o maior deslocamento
+    possível cabe, senão int32. Pixels NoData, sem feição ou além de --max-distance
+    ficam com o NoData do tipo.
+    """
+
+    kind: str
+    dtype: str
+
+    @classmethod
+    def for_grid(cls, kind: str, height: int, width: int, max_offset: int | None = None) -> "NearestEncoding":
+        if kind == "index":
+            return cls(kind, "int32")
+        limit = max(height, width) if max_offset is None else min(max_offset, max(height, width))
+        return cls(kind, "int16" if limit <= np.iinfo(np.int16).max else "int32")
+
+    @property
+    def nodata(self) -> int:
+        return int(np.iinfo(self.dtype).min)
+
+    def band_names(self, layer_name: str) -> tuple[str, str]:
+        names = ("row", "col") if self.kind == "index" else ("dy", "dx")
+        return tuple(f"{layer_name}_{name}" for name in names)
+
+    def update_profile(self, profile: dict) -> dict:
+        profile.update(dtype=self.dtype, nodata=self.nodata, predictor=2, interleave="band")
+        return profile
+
+    def encode(
+        self,
+        nearest: np.ndarray | None,
+        distance: np.ndarray,
+        window: Window,
+        max_distance: float | None = None,
+    ) -> np.ndarray:
+        """`nearest`: (2, linhas, colunas) com linha/coluna globais da feição; `distance` em float."""
+        encoded = np.full((2, window.height, window.width), self.nodata, dtype=self.dtype)
+        if nearest is None:
+            return encoded
+        valid = np.isfinite(distance)
+        if max_distance is not None:
+            # Com limite, só vale dentro dele (o motor padded nem procura feições além).
+            valid &= distance < max_distance
+        if self.kind == "offset":
+            rows = np.arange(window.row_off, window.row_off + window.height, dtype=np.int64)[:, None]
+            cols = np.arange(window.col_off, window.col_off + window.width, dtype=np.int64)
+            encoded[0][valid] = (nearest[0] - rows)[valid]
+            encoded[1][valid] = (nearest[1] - cols)[valid]
+        else:
+            encoded[0][valid] = nearest[0][valid]
+            encoded[1][valid] = nearest[1][valid]
+        return encoded
+
+
+COMPRESSIONS = ("deflate", "zstd", "lerc")
+DEFAULT_COG_BLOCK_SIZE = 512
+
+
+@dataclass(frozen=True)
+class OutputLayout:
+    """Compressão e layout dos GeoTIFFs de saída: faixas (padrão) ou COG.
+
+    No modo COG as engines gravam um intermediário em tiles `block_size` (ZSTD rápido)
+    em `<saída>.partial.tif`; ao fechar, o driver COG do GDAL copia para o arquivo final
+    gerando as overviews internas (NEAREST) numa única leitura sequencial dele.
+    `lerc` é sem perdas (MAX_Z_ERROR=0) e dispensa preditor.
+    """
+
+    cog: bool = False
+    compress: str = "deflate"
+    block_size: int = DEFAULT_COG_BLOCK_SIZE
+
+    def __post_init__(self) -> None:
+        if self.compress not in COMPRESSIONS:
+            raise ValueError(f"--compress deve ser um de {', '.join(COMPRESSIONS)}.")
+        if self.block_size <= 0 or self.block_size % 16:
+            raise ValueError("--cog-block-size precisa ser múltiplo de 16.")
+
+    def update_profile(self, profile: dict) -> dict:
+        if self.cog:
+            profile.update(tiled=True, blockxsize=self.block_size, blockysize=self.block_size)
+            profile.update(compress="zstd", zstd_level=1, bigtiff="IF_SAFER")
+            return profile
+        profile["compress"] = self.compress
+        if self.compress == "lerc":
+            profile.pop("predictor", None)
+            profile["max_z_error"] = 0
+        return profile
+
+    def staging_path(self, out_path: Path) -> Path:
+        if not self.cog:
+            return out_path
+        return out_path.with_name(f"{out_path.stem}.partial{out_path.suffix}")
+
+    def finalize(self, staging_path: Path, out_path: Path) -> None:
+        if not self.cog:
+            return
+        options = {
+            "BLOCKSIZE": self.block_size,
+            "COMPRESS": self.compress.upper(),
+            "OVERVIEW_RESAMPLING": "NEAREST",
+            "BIGTIFF": "IF_SAFER",
+            "NUM_THREADS": "ALL_CPUS",
+        }
+        if self.compress == "lerc":
+            options["MAX_Z_ERROR"] = 0
+        else:
+            options["PREDICTOR"] = "YES"
+        rasterio.shutil.copy(staging_path, out_path, driver="COG", **options)
+        staging_path.unlink()
+
+
+def nearest_path(out_path: Path) -> Path:
+    return out_path.with_name(f"{out_path.stem}{NEAREST_SUFFIX}{out_path.suffix}")
+
+
+def distance_profile(src: rasterio.io.DatasetReader, encoding: DistanceEncoding | None = None) -> dict:
+    """Perfil float32 (NaN = NoData) usado por todas as saídas de distância."""
     profile = src.profile
     profile.update(
         dtype="float32",
@@ -137,12 +530,224 @@ def write_distance_raster(
     profile.pop("blockxsize", None)
     profile.pop("blockysize", None)
     profile["crs"] = src.crs
+    if encoding is not None:
+        encoding.update_profile(profile)
+    return profile
 
-    with rasterio.open(out_path, "w", **profile) as dst:
-        for _, window in src.block_windows(1):
+
+def distances_from_indices(
+    indices: np.ndarray,
+    window: Window,
+    px: float,
+    py: float,
+) -> np.ndarray:
+    """Distâncias (float64) de um bloco a partir da transformada de feições (linha, coluna globais).
+
+    Repete a conta do `distance_transform_edt`, então o resultado é o mesmo bit a bit.
+    """
+    rows = np.arange(window.row_off, window.row_off + window.height, dtype=np.int32)[:, None]
+    cols = np.arange(window.col_off, window.col_off + window.width, dtype=np.int32)
+    dy = (indices[0] - rows).astype(np.float64) * py
+    dx = (indices[1] - cols).astype(np.float64) * px
+    return np.sqrt(dy * dy + dx * dx)
+
+
+class DistanceWriter:
+    """Saídas de distância de uma ou mais camadas: um GeoTIFF por camada ou um multibanda.
+
+    Todas as engines escrevem por aqui (`write(camada, distância, janela)`), então a
+    codificação (limite/quantização) e o layout de saída ficam num lugar só. Com
+    `nearest`, cada saída ganha um `<saída>_nearest.tif` com 2 bandas por camada.
+    Com `update`, as saídas existentes são abertas em `r+` e só as janelas gravadas mudam.
+    """
+
+    def __init__(
+        self,
+        out_paths: list[Path],
+        profile: dict,
+        encoding: DistanceEncoding,
+        layer_names: list[str],
+        multiband: bool = False,
+        nearest: NearestEncoding | None = None,
+        layout: OutputLayout = OutputLayout(),
+        clip: CutlineMask | None = None,
+        update: bool = False,
+    ) -> None:
+        self.encoding = encoding
+        self.nearest = nearest
+        self.layout = layout
+        self.clip = clip
+        self.update = update
+        if clip is not None:
+            profile = clipped_profile(profile, clip)
+        self._datasets: list[rasterio.io.DatasetWriter] = []
+        self._finals: list[tuple[Path, Path]] = []
+        self._targets = self._open(out_paths, layout.update_profile(dict(profile)), layer_names, multiband, 1)
+        for dst in self._datasets:
+            encoding.annotate(dst)
+        self._nearest_targets = []
+        if nearest is not None:
+            nearest_profile = layout.update_profile(nearest.update_profile(dict(profile)))
+            if clip is not None:
+                nearest_profile = clipped_profile(nearest_profile, clip)
+            names = [list(nearest.band_names(name)) for name in layer_names]
+            self._nearest_targets = self._open(
+                [nearest_path(path) for path in out_paths], nearest_profile, names, multiband, 2
+            )
+
+    def _open(
+        self,
+        paths: list[Path],
+        profile: dict,
+        names: list,
+        multiband: bool,
+        bands_per_layer: int,
+    ) -> list[tuple[rasterio.io.DatasetWriter, list[int]]]:
+        """Abre as saídas e devolve, por camada, o dataset e as bandas dela."""
+        if multiband:
+            paths = paths[:1]
+        if self.update:
+            self._datasets.extend(rasterio.open(path, "r+") for path in paths)
+            if multiband:
+                return [
+                    (self._datasets[0], list(range(1 + layer * bands_per_layer, 1 + (layer + 1) * bands_per_layer)))
+                    for layer in range(len(names))
+                ]
+            return [(dst, list(range(1, bands_per_layer + 1))) for dst in self._datasets[-len(paths):]]
+        for out_path in paths:
+            if out_path.exists():
+                out_path.unlink()
+            self._finals.append((self.layout.staging_path(out_path), out_path))
+        paths = [self.layout.staging_path(path) for path in paths]
+        per_layer = [tuple(name) if isinstance(name, list) else (name,) for name in names]
+        if multiband:
+            count = len(names) * bands_per_layer
+            dst = rasterio.open(paths[0], "w", **{**profile, "count": count, "interleave": "band"})
+            dst.descriptions = tuple(desc for layer in per_layer for desc in layer)
+            self._datasets.append(dst)
+            return [
+                (dst, list(range(1 + layer * bands_per_layer, 1 + (layer + 1) * bands_per_layer)))
+                for layer in range(len(names))
+            ]
+        targets = []
+        for path, descriptions in zip(paths, per_layer):
+            dst = rasterio.open(path, "w", **{**profile, "count": bands_per_layer})
+            if bands_per_layer > 1:
+                dst.descriptions = descriptions
+            self._datasets.append(dst)
+            targets.append((dst, list(range(1, bands_per_layer + 1))))
+        return targets
+
+    @property
+    def layer_count(self) -> int:
+        return len(self._targets)
+
+    def encode_nearest(
+        self,
+        nearest: np.ndarray | None,
+        distance: np.ndarray,
+        window: Window,
+    ) -> np.ndarray | None:
+        if self.nearest is None:
+            return None
+        return self.nearest.encode(nearest, distance, window, self.encoding.max_distance)
+
+    def write(
+        self,
+        layer: int,
+        distance: np.ndarray,
+        window: Window,
+        nearest: np.ndarray | None = None,
+    ) -> None:
+        self.write_encoded(
+            layer, self.encoding.encode(distance), window, self.encode_nearest(nearest, distance, window)
+        )
+
+    def write_encoded(
+        self,
+        layer: int,
+        encoded: np.ndarray,
+        window: Window,
+        nearest_encoded: np.ndarray | None = None,
+    ) -> None:
+        self._write_target(self._targets[layer], encoded, window)
+        if nearest_encoded is not None:
+            self._write_target(self._nearest_targets[layer], nearest_encoded, window)
+
+    def _write_target(
+        self,
+        target: tuple[rasterio.io.DatasetWriter, list[int]],
+        data: np.ndarray,
+        window: Window,
+    ) -> None:
+        dst, bands = target
+        if self.clip is not None:
+            # Recorte no próprio escritor: fora do polígono nada é gravado (fica NoData).
+            clipped = self.clip.clip_block(data, window, dst.nodata)
+            if clipped is None:
+                return
+            window, data = clipped
+        dst.write(data, bands if data.ndim == 3 else bands[0], window=window)
+
+    def write_layers(self, results: list[tuple[np.ndarray, np.ndarray | None]], window: Window) -> None:
+        for layer, (distance, nearest) in enumerate(results):
+            self.write(layer, distance, window, nearest)
+
+    def block_windows(self) -> Iterator[Window]:
+        """Blocos da saída, na grade de origem (desfaz o deslocamento do recorte)."""
+        row_off = col_off = 0
+        if self.clip is not None:
+            row_off, col_off = self.clip.crop.row_off, self.clip.crop.col_off
+        return (
+            Window(window.col_off + col_off, window.row_off + row_off, window.width, window.height)
+            for _, window in self._datasets[0].block_windows(1)
+        )
+
+    def close(self, finalize: bool = True) -> None:
+        # Fechar descarrega o cache de blocos do GDAL: parte da compressão aparece aqui.
+        with metrics.stage("close"):
+            for dst in self._datasets:
+                dst.close()
+        if not self.layout.cog:
+            return
+        for staging_path, out_path in self._finals:
+            if finalize:
+                print(f"Gravando COG {out_path.name} (tiles de {self.layout.block_size}px + overviews)...")
+                with metrics.stage("cog", path=out_path.name):
+                    self.layout.finalize(staging_path, out_path)
+            elif staging_path.exists():
+                staging_path.unlink()
+
+    def __enter__(self) -> "DistanceWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        self.close(finalize=exc_type is None)
+
+
+def write_distance_raster(
+    src: rasterio.io.DatasetReader,
+    indices: np.memmap,
+    valid_mask: np.memmap | None,
+    writer: DistanceWriter,
+    layer: int,
+    px: float,
+    py: float,
+    progress: ProgressPrinter | None = None,
+) -> None:
+    """Grava a camada bloco a bloco, calculando distâncias e aplicando o NaN só no bloco."""
+    # Em COG, percorre os tiles da saída: cada um é comprimido uma única vez.
+    windows = writer.block_windows() if writer.layout.cog else (window for _, window in src.block_windows(1))
+    with metrics.hot_loop("write_distance_raster"):
+        for index, window in enumerate(windows):
             row_slice, col_slice = window_slices(window)
-            block = np.asarray(distance_mm[row_slice, col_slice], dtype=np.float32)
-            dst.write(block, 1, window=window)
+            with metrics.stage("distances", block=index, layer=layer):
+                nearest = indices[:, row_slice, col_slice]
+                block = distances_from_indices(nearest, window, px, py).astype(np.float32)
+                if valid_mask is not None:
+                    block[~valid_mask[row_slice, col_slice]] = np.nan
+            with metrics.stage("write", block=index, layer=layer):
+                writer.write(layer, block, window, nearest)
             if progress is not None:
                 progress.increment()
 
@@ -174,101 +779,1080 @@ def pad_window(window: Window, pad_rows: int, pad_cols: int, height: int, width:
     )
 
 
-def process_tiles(
-    src: rasterio.io.DatasetReader,
-    out_path: Path,
+def window_cells(window: Window, cell_size: int) -> tuple[slice, slice]:
+    """Fatias da grade de ocupação cobertas pela janela."""
+    return (
+        slice(window.row_off // cell_size, -(-(window.row_off + window.height) // cell_size)),
+        slice(window.col_off // cell_size, -(-(window.col_off + window.width) // cell_size)),
+    )
+
+
+def raster_signature(src: rasterio.io.DatasetReader) -> str:
+    """Identifica a versão do arquivo de entrada (tamanho, mtime, grade, NoData e modo de leitura).
+
+    O modo entra na assinatura porque `--raw` conta `>0` como feição e a leitura comum
+    só `==1`: a mesma entrada sem NoData dá ocupações diferentes em cada modo.
+    """
+    stat = Path(src.name).stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{src.height}x{src.width}:{src.nodata}:raw={is_raw_input(src)}"
+
+
+class OccupancyIndex:
+    """Grade grossa (células de `cell_size` px) marcando onde existe ao menos uma feição.
+
+    A partir da grade, cada célula sabe a célula ocupada mais próxima. Isso dá dois
+    limites por tile: um superior (a feição mais próxima de qualquer pixel está a no
+    máximo `reach` metros, então essa borda já é exata) e um inferior (nenhuma feição
+    a menos de `gap`, usado para preencher tiles além de --max-distance sem EDT).
+    """
+
+    def __init__(self, occupied: np.ndarray, cell_size: int) -> None:
+        self.occupied = occupied
+        self.cell_size = cell_size
+        self.has_features = bool(occupied.any())
+        if self.has_features:
+            _, indices = distance_transform_edt(~occupied, return_indices=True)
+            cell_rows, cell_cols = np.indices(occupied.shape)
+            self.offset_rows = np.abs(indices[0] - cell_rows)
+            self.offset_cols = np.abs(indices[1] - cell_cols)
+            self.gap = distance_transform_cdt(~occupied, metric="chessboard")
+        else:
+            self.offset_rows = self.offset_cols = self.gap = None
+
+    @staticmethod
+    def sidecar_path(in_path: Path) -> Path:
+        return in_path.with_name(in_path.name + OCCUPANCY_SUFFIX)
+
+    @classmethod
+    def build(cls, src: rasterio.io.DatasetReader, cell_size: int) -> "OccupancyIndex":
+        """Passada única e barata sobre `src.block_windows`, reduzindo cada bloco às células."""
+        shape = (-(-src.height // cell_size), -(-src.width // cell_size))
+        occupied = np.zeros(shape, dtype=bool)
+        nodata = src.nodata
+        progress = ProgressPrinter("Indexando ocupação", estimate_total_blocks(src))
+        for _, window in src.block_windows(1):
+            features, _ = feature_mask_block(src.read(1, window=window, masked=False), nodata)
+            rows = np.arange(window.row_off, window.row_off + window.height) // cell_size
+            cols = np.arange(window.col_off, window.col_off + window.width) // cell_size
+            row_starts = np.flatnonzero(np.diff(rows, prepend=-1))
+            col_starts = np.flatnonzero(np.diff(cols, prepend=-1))
+            reduced = np.logical_or.reduceat(np.logical_or.reduceat(features, row_starts, axis=0), col_starts, axis=1)
+            occupied[rows[row_starts][:, None], cols[col_starts]] |= reduced
+            progress.increment()
+        progress.finish()
+        return cls(occupied, cell_size)
+
+    @classmethod
+    def load_or_build(cls, src: rasterio.io.DatasetReader, cell_size: int) -> "OccupancyIndex":
+        """Reaproveita o sidecar `<entrada>.occupancy.npz` se ainda corresponder à entrada."""
+        sidecar = cls.sidecar_path(Path(src.name))
+        signature = raster_signature(src)
+        if sidecar.exists():
+            with np.load(sidecar) as cached:
+                if str(cached["signature"]) == signature and int(cached["cell_size"]) == cell_size:
+                    print(f"Índice de ocupação reaproveitado: {sidecar}")
+                    return cls(cached["occupied"], cell_size)
+
+        index = cls.build(src, cell_size)
+        np.savez_compressed(sidecar, occupied=index.occupied, cell_size=cell_size, signature=signature)
+        print(f"Índice de ocupação salvo em {sidecar}")
+        return index
+
+    def tile_padding(
+        self,
+        window: Window,
+        px: float,
+        py: float,
+        max_distance: float | None,
+        fallback: int,
+    ) -> int:
+        """Menor borda (px) que ainda garante a EDT exata (ou saturada em max_distance) no tile."""
+        if not self.has_features:
+            return fallback
+        cells = window_cells(window, self.cell_size)
+        pixel = min(px, py)
+        if max_distance is not None:
+            # Gap em células (chessboard) -> pelo menos (gap-1)*cell+1 pixels até qualquer feição.
+            gap = int(self.gap[cells].min())
+            if gap > 0 and ((gap - 1) * self.cell_size + 1) * pixel >= max_distance:
+                return 0
+        reach_rows = (self.offset_rows[cells] + 1) * self.cell_size * py
+        reach_cols = (self.offset_cols[cells] + 1) * self.cell_size * px
+        reach = float(np.sqrt(reach_rows**2 + reach_cols**2).max())
+        if max_distance is not None:
+            reach = min(reach, max_distance)
+        return math.ceil(reach / pixel)
+
+
+# Manifesto do modo --incremental, ao lado da primeira saída.
+MANIFEST_SUFFIX = ".blocks.json"
+# Lado (px) dos blocos de entrada com hash no manifesto.
+HASH_BLOCK_SIZE = 512
+
+
+def manifest_path(out_path: Path) -> Path:
+    return out_path.with_name(out_path.name + MANIFEST_SUFFIX)
+
+
+def hash_blocks(sources: list[rasterio.io.DatasetReader], block_size: int = HASH_BLOCK_SIZE) -> list[list[str]]:
+    """Hash de cada bloco de cada camada, como o motor o enxerga (já normalizado com --raw).
+
+    Lê faixas de `block_size` linhas inteiras: uma leitura sequencial barata da entrada.
+    """
+    height, width = sources[0].height, sources[0].width
+    bands = list(iter_row_bands(height, width, block_size))
+    progress = ProgressPrinter("Calculando hashes dos blocos", len(bands) * len(sources), mode="count")
+    hashes: list[list[str]] = []
+    for src in sources:
+        layer = []
+        for band in bands:
+            block = np.ascontiguousarray(src.read(1, window=band, masked=False))
+            for col_off in range(0, width, block_size):
+                tile = np.ascontiguousarray(block[:, col_off:col_off + block_size])
+                layer.append(hashlib.blake2b(tile.tobytes(), digest_size=8).hexdigest())
+            progress.increment()
+        hashes.append(layer)
+    progress.finish()
+    return hashes
+
+
+class BlockManifest:
+    """Hashes dos blocos de entrada + parâmetros que definem a saída (modo --incremental).
+
+    Se os parâmetros baterem com os da rodada anterior, só os blocos com hash diferente
+    (expandidos pelo raio de influência) precisam ser recalculados.
+    """
+
+    def __init__(self, settings: dict, hashes: list[list[str]], block_size: int = HASH_BLOCK_SIZE) -> None:
+        self.settings = settings
+        self.hashes = hashes
+        self.block_size = block_size
+
+    @classmethod
+    def load(cls, path: Path) -> "BlockManifest | None":
+        if not path.exists():
+            return None
+        try:
+            data = json.loads(path.read_text())
+            return cls(data["settings"], data["hashes"], int(data["block_size"]))
+        except (ValueError, KeyError) as exc:
+            print(f"ATENÇÃO: manifesto {path} ilegível ({exc}); ignorando.")
+            return None
+
+    def save(self, path: Path) -> None:
+        data = {"settings": self.settings, "block_size": self.block_size, "hashes": self.hashes}
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(data))
+        tmp_path.replace(path)
+
+    def matches(self, other: "BlockManifest") -> bool:
+        return (
+            self.settings == other.settings
+            and self.block_size == other.block_size
+            and [len(layer) for layer in self.hashes] == [len(layer) for layer in other.hashes]
+        )
+
+    def changed_blocks(self, other: "BlockManifest", height: int, width: int) -> np.ndarray:
+        """Grade (blocos) marcando onde qualquer camada mudou entre os dois manifestos."""
+        shape = (-(-height // self.block_size), -(-width // self.block_size))
+        changed = np.zeros(shape[0] * shape[1], dtype=bool)
+        for old, new in zip(self.hashes, other.hashes):
+            changed |= np.array(old) != np.array(new)
+        return changed.reshape(shape)
+
+
+def affected_tiles(
+    changed: np.ndarray,
+    block_size: int,
+    height: int,
+    width: int,
     tile_size: int,
+    radius: int,
+) -> list[Window]:
+    """Tiles cuja janela com borda `radius` encosta em algum bloco alterado."""
+    return [
+        window
+        for window in iter_tile_windows(height, width, tile_size)
+        if changed[window_cells(pad_window(window, radius, radius, height, width), block_size)].any()
+    ]
+
+
+def read_padded_tiles(
+    sources: list[rasterio.io.DatasetReader],
+    window: Window,
     tile_padding: int,
+) -> tuple[Window, list[np.ndarray]]:
+    """Mesma janela com borda lida em todas as camadas (grades alinhadas)."""
+    padded = pad_window(window, tile_padding, tile_padding, sources[0].height, sources[0].width)
+    return padded, [src.read(1, window=padded, masked=False) for src in sources]
+
+
+def tile_distance(
+    block: np.ndarray,
+    nodata: float | int | None,
+    window: Window,
+    padded: Window,
     px: float,
     py: float,
+    max_distance: float | None = None,
+    with_nearest: bool = False,
+) -> tuple[np.ndarray, np.ndarray | None]:
+    """Roda a EDT no tile com borda e devolve só o miolo (float32, NaN fora dos válidos).
+
+    Com `max_distance` (e borda cobrindo o limite), um tile sem feição na janela lida
+    está inteiro além do limite: é preenchido com a constante, sem rodar a EDT.
+    Com `with_nearest`, devolve também linha/coluna globais da feição mais próxima.
+    """
+    features, mask = feature_mask_block(block, nodata)
+
+    row_start = window.row_off - padded.row_off
+    col_start = window.col_off - padded.col_off
+    row_slice = slice(row_start, row_start + window.height)
+    col_slice = slice(col_start, col_start + window.width)
+
+    if max_distance is not None and not features.any():
+        distance = np.full((window.height, window.width), max_distance, dtype=np.float32)
+        distance[~mask[row_slice, col_slice]] = np.nan
+        return distance, None
+
+    binary = np.where(features, 0, 1).astype(np.uint8, copy=False)
+    if not with_nearest:
+        distance = distance_transform_edt(binary, sampling=(py, px), return_indices=False)
+        nearest = None
+    else:
+        distance, indices = distance_transform_edt(binary, sampling=(py, px), return_indices=True)
+        nearest = indices[:, row_slice, col_slice]
+        nearest[0] += padded.row_off
+        nearest[1] += padded.col_off
+    distance = distance.astype(np.float32, copy=False)
+    distance[~mask] = np.nan
+    return distance[row_slice, col_slice], nearest
+
+
+# Cada processo do pool abre as camadas de entrada uma única vez (datasets não são picklable).
+_worker_sources: list[rasterio.io.DatasetReader] = []
+
+
+def _init_tile_worker(in_paths: list[str], raw: bool, instrument: bool = False) -> None:
+    global _worker_sources
+    _worker_sources = [open_input(path, raw) for path in in_paths]
+    if instrument:
+        metrics.configure(buffer=True)
+
+
+def _read_tile(
+    sources: list[rasterio.io.DatasetReader],
+    window: Window,
+    tile_padding: int,
+    index: int,
+) -> tuple[Window, list[np.ndarray]]:
+    with metrics.stage("read", tile=index):
+        return read_padded_tiles(sources, window, tile_padding)
+
+
+def _tile_distances(
+    sources: list[rasterio.io.DatasetReader],
+    blocks: list[np.ndarray],
+    window: Window,
+    padded: Window,
+    px: float,
+    py: float,
+    max_distance: float | None,
+    with_nearest: bool,
+    index: int,
+) -> list[tuple[np.ndarray, np.ndarray | None]]:
+    with metrics.stage("edt", tile=index):
+        return [
+            tile_distance(block, src.nodata, window, padded, px, py, max_distance, with_nearest)
+            for src, block in zip(sources, blocks)
+        ]
+
+
+def _write_tile(
+    writer: DistanceWriter,
+    results: list[tuple[np.ndarray, np.ndarray | None]],
+    window: Window,
+    index: int,
 ) -> None:
-    profile = src.profile
-    profile.update(
-        dtype="float32",
-        count=1,
-        nodata=np.nan,
-        compress="deflate",
-        predictor=3,
-        tiled=False,
+    with metrics.stage("write", tile=index):
+        writer.write_layers(results, window)
+
+
+def _tile_task(
+    window: Window,
+    tile_padding: int,
+    px: float,
+    py: float,
+    encoding: DistanceEncoding,
+    nearest_encoding: NearestEncoding | None,
+    index: int = 0,
+) -> tuple[Window, list[tuple[np.ndarray, np.ndarray | None]], list[dict]]:
+    padded, blocks = _read_tile(_worker_sources, window, tile_padding, index)
+    results = _tile_distances(
+        _worker_sources, blocks, window, padded, px, py, encoding.max_distance, nearest_encoding is not None, index
     )
-    profile.pop("blockxsize", None)
-    profile.pop("blockysize", None)
-    profile["crs"] = src.crs
+    encoded = []
+    with metrics.stage("encode", tile=index):
+        for distance, nearest in results:
+            nearest_encoded = None
+            if nearest_encoding is not None:
+                nearest_encoded = nearest_encoding.encode(nearest, distance, window, encoding.max_distance)
+            encoded.append((np.ascontiguousarray(encoding.encode(distance)), nearest_encoded))
+    return window, encoded, metrics.drain()
+
+
+def _write_tiles_parallel(
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
+    tiles: Iterator[tuple[Window, int]],
+    px: float,
+    py: float,
+    workers: int,
+    progress: ProgressPrinter,
+) -> None:
+    # Poucos tiles em voo por worker: mantém a RAM limitada sem deixar o pool ocioso.
+    max_in_flight = 2 * workers
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_tile_worker,
+        initargs=([src.name for src in sources], is_raw_input(sources[0]), metrics.enabled),
+    ) as pool:
+        pending: set[Future] = set()
+        for index, (window, tile_padding) in enumerate(tiles):
+            pending.add(pool.submit(_tile_task, window, tile_padding, px, py, writer.encoding, writer.nearest, index))
+            if len(pending) < max_in_flight:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _write_task_result(writer, future, progress)
+        for future in as_completed(pending):
+            _write_task_result(writer, future, progress)
+
+
+def _write_task_result(writer: DistanceWriter, future: Future, progress: ProgressPrinter) -> None:
+    tile_window, encoded, records = future.result()
+    metrics.absorb(records)
+    with metrics.stage("write", tile=records[0]["tile"] if records else None):
+        for layer, (block, nearest_encoded) in enumerate(encoded):
+            writer.write_encoded(layer, block, tile_window, nearest_encoded)
+    progress.increment()
+
+
+def _write_tiles_pipelined(
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
+    tiles: Iterator[tuple[Window, int]],
+    px: float,
+    py: float,
+    progress: ProgressPrinter,
+) -> dict[str, float]:
+    """Lê o próximo tile e grava o anterior em threads enquanto a EDT do atual roda.
+
+    Retorna o tempo (s) que a thread principal passou em cada estágio: espera pela
+    leitura, EDT e espera pela gravação/compressão do tile anterior.
+    """
+    timings = {"espera leitura": 0.0, "EDT": 0.0, "espera gravação": 0.0}
+    max_distance = writer.encoding.max_distance
+    with_nearest = writer.nearest is not None
+    tiles = iter(tiles)
+    tile = next(tiles, None)
+    if tile is None:
+        return timings
+
+    index = 0
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as background:
+        next_read = reader.submit(_read_tile, sources, *tile, index)
+        pending_write: Future | None = None
+        while tile is not None:
+            window = tile[0]
+            start = time.perf_counter()
+            padded, blocks = next_read.result()
+            timings["espera leitura"] += time.perf_counter() - start
+
+            tile = next(tiles, None)
+            if tile is not None:
+                next_read = reader.submit(_read_tile, sources, *tile, index + 1)
+
+            start = time.perf_counter()
+            results = _tile_distances(sources, blocks, window, padded, px, py, max_distance, with_nearest, index)
+            timings["EDT"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            if pending_write is not None:
+                pending_write.result()
+            timings["espera gravação"] += time.perf_counter() - start
+            pending_write = background.submit(_write_tile, writer, results, window, index)
+            progress.increment()
+            index += 1
 
-    if out_path.exists():
-        out_path.unlink()
+        start = time.perf_counter()
+        if pending_write is not None:
+            pending_write.result()
+        timings["espera gravação"] += time.perf_counter() - start
 
-    total_rows = math.ceil(src.height / tile_size)
-    total_cols = math.ceil(src.width / tile_size)
-    total_tiles = max(total_rows * total_cols, 1)
+    return timings
+
+
+def print_stage_timings(timings: dict[str, float]) -> None:
+    total = sum(timings.values()) or 1.0
+    summary = " | ".join(f"{name}: {seconds:.1f}s ({seconds * 100 / total:.0f}%)" for name, seconds in timings.items())
+    print(f"Tempo por estágio -> {summary}")
+    print(f"Gargalo provável: {max(timings, key=timings.get)}")
+
+
+def process_tiles(
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
+    tile_size: int,
+    tile_padding: int,
+    px: float,
+    py: float,
+    workers: int = 1,
+    pipeline: bool = False,
+    occupancies: list[OccupancyIndex] | None = None,
+    windows: list[Window] | None = None,
+) -> None:
+    """Motor padded: cada tile é lido uma vez por camada e gera as N distâncias juntas.
+
+    Com `windows`, processa só esses tiles (modo --incremental).
+    """
+    height, width = sources[0].height, sources[0].width
+    max_distance = writer.encoding.max_distance
+    if windows is None:
+        total_tiles = max(math.ceil(height / tile_size) * math.ceil(width / tile_size), 1)
+        windows = iter_tile_windows(height, width, tile_size)
+    else:
+        total_tiles = max(len(windows), 1)
     progress = ProgressPrinter("Processando tiles", total_tiles, mode="count")
-    nodata = src.nodata
+    if not occupancies:
+        tiles = ((window, tile_padding) for window in windows)
+    else:
+        # Com várias camadas, a borda do tile é a maior exigida entre elas.
+        tiles = (
+            (window, max(index.tile_padding(window, px, py, max_distance, tile_padding) for index in occupancies))
+            for window in windows
+        )
+    timings: dict[str, float] | None = None
 
-    with rasterio.open(out_path, "w", **profile) as dst:
-        for window in iter_tile_windows(src.height, src.width, tile_size):
-            padded = pad_window(window, tile_padding, tile_padding, src.height, src.width)
-            block = src.read(1, window=padded, masked=False)
+    with metrics.hot_loop("process_tiles"):
+        if workers > 1:
+            _write_tiles_parallel(sources, writer, tiles, px, py, workers, progress)
+        elif pipeline:
+            timings = _write_tiles_pipelined(sources, writer, tiles, px, py, progress)
+        else:
+            with_nearest = writer.nearest is not None
+            for index, (window, padding) in enumerate(tiles):
+                padded, blocks = _read_tile(sources, window, padding, index)
+                results = _tile_distances(sources, blocks, window, padded, px, py, max_distance, with_nearest, index)
+                _write_tile(writer, results, window, index)
+                progress.increment()
 
-            if nodata is None or nodata in (0, 1):
-                mask = np.ones(block.shape, dtype=bool)
-            else:
-                mask = block != nodata
-
-            binary = np.where((block == 1) & mask, 0, 1).astype(np.uint8, copy=False)
-            distance = distance_transform_edt(
-                binary,
-                sampling=(py, px),
-                return_indices=False,
-            ).astype(np.float32, copy=False)
-            distance[~mask] = np.nan
-
-            row_start = window.row_off - padded.row_off
-            col_start = window.col_off - padded.col_off
-            row_slice = slice(row_start, row_start + window.height)
-            col_slice = slice(col_start, col_start + window.width)
-
-            dst.write(distance[row_slice, col_slice], 1, window=window)
+    progress.finish()
+    if timings is not None:
+        print_stage_timings(timings)
+
+
+ENGINES = ("padded", "exact", "kdtree", "auto")
+
+# Tile de referência do motor exato quando --tile-size não é informado.
+DEFAULT_EXACT_TILE_SIZE = 4096
+
+# Sentinela (em linhas) para colunas sem feição acima/abaixo; cabe folgado em int64.
+NO_FEATURE_ROW = 1 << 40
+
+
+def iter_row_bands(height: int, width: int, band_rows: int) -> Iterator[Window]:
+    for row_off in range(0, height, band_rows):
+        yield Window(col_off=0, row_off=row_off, width=width, height=min(band_rows, height - row_off))
+
+
+def exact_band_rows(width: int, tile_size: int) -> int:
+    """Altura das faixas do motor exato: mesma quantidade de pixels de um tile quadrado."""
+    return max(1, (tile_size * tile_size) // max(width, 1))
+
+
+def vertical_offsets(
+    features: np.ndarray,
+    row_off: int,
+    carry_above: np.ndarray,
+    carry_below: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Distância vertical (em linhas) até a feição mais próxima na mesma coluna.
+
+    `carry_above`/`carry_below` trazem a linha global da feição mais próxima acima
+    e abaixo da faixa, então o resultado vale para o raster inteiro. Retorna o
+    deslocamento (float64, inf onde a coluna não tem feição), a linha global dessa
+    feição e o novo `carry_above`.
+    """
+    rows = np.arange(row_off, row_off + features.shape[0], dtype=np.int64)[:, None]
+    above = np.maximum.accumulate(np.where(features, rows, -NO_FEATURE_ROW), axis=0)
+    np.maximum(above, carry_above, out=above)
+    below = np.minimum.accumulate(np.where(features, rows, NO_FEATURE_ROW)[::-1], axis=0)[::-1]
+    np.minimum(below, carry_below, out=below)
+
+    from_above = rows - above
+    from_below = below - rows
+    feature_rows = np.where(from_above <= from_below, above, below)
+    offsets = np.minimum(from_above, from_below).astype(np.float64)
+    offsets[offsets >= NO_FEATURE_ROW] = np.inf
+    return offsets, feature_rows, above[-1].copy()
+
+
+def row_envelope_distances(dy: np.ndarray, px: float, py: float) -> tuple[np.ndarray, np.ndarray]:
+    """Fecha a EDT exata por linha (envelope inferior de parábolas, Felzenszwalb).
+
+    Para cada linha, minimiza (dy[c']*py)^2 + ((c - c')*px)^2 sobre as colunas c'.
+    O laço percorre as colunas e vetoriza sobre as linhas da faixa. A distância
+    final é recalculada com a mesma expressão do `distance_transform_edt`, então o
+    resultado coincide bit a bit com a EDT do raster inteiro. Retorna também a
+    coluna c' escolhida para cada pixel.
+    """
+    height, width = dy.shape
+    rows = np.arange(height)
+    values = (dy * py) ** 2
+    finite = np.isfinite(values)
+    centers = np.zeros((width, height), dtype=np.int32)
+    bounds = np.empty((width + 1, height), dtype=np.float64)
+    top = np.full(height, -1, dtype=np.int64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for q in range(width):
+            sel = rows[finite[:, q]]
+            if sel.size == 0:
+                continue
+            qx = q * px
+            fq = values[sel, q] + qx * qx
+            k = top[sel]
+            while True:
+                kc = np.maximum(k, 0)
+                vk = centers[kc, sel]
+                vx = vk * px
+                s = (fq - (values[sel, vk] + vx * vx)) / (2.0 * (qx - vx))
+                pop = (k >= 0) & (s <= bounds[kc, sel])
+                if not pop.any():
+                    break
+                k[pop] -= 1
+            s[k < 0] = -np.inf
+            k += 1
+            centers[k, sel] = q
+            bounds[k, sel] = s
+            bounds[k + 1, sel] = np.inf
+            top[sel] = k
+
+    nearest = np.empty((height, width), dtype=np.int32)
+    k = np.zeros(height, dtype=np.int64)
+    for q in range(width):
+        qx = q * px
+        while True:
+            advance = (k < top) & (bounds[k + 1, rows] < qx)
+            if not advance.any():
+                break
+            k[advance] += 1
+        nearest[:, q] = centers[k, rows]
+
+    dys = dy[rows[:, None], nearest] * py
+    dxs = (nearest - np.arange(width)).astype(np.float64) * px
+    distance = np.sqrt(dys * dys + dxs * dxs)
+    distance[top < 0] = np.inf
+    return distance, nearest
+
+
+def column_first_rows(
+    src: rasterio.io.DatasetReader,
+    bands: list[Window],
+    progress: ProgressPrinter,
+) -> np.ndarray:
+    """Por faixa e coluna, a linha da feição mais próxima na própria faixa ou abaixo dela."""
+    first_rows = np.full((len(bands), src.width), NO_FEATURE_ROW, dtype=np.int64)
+    for index, window in enumerate(bands):
+        block = src.read(1, window=window, masked=False)
+        features, _ = feature_mask_block(block, src.nodata)
+        rows = np.arange(window.row_off, window.row_off + window.height, dtype=np.int64)[:, None]
+        first_rows[index] = np.where(features, rows, NO_FEATURE_ROW).min(axis=0)
+        progress.increment()
+
+    # first_rows[i] passa a ser a feição mais próxima na faixa i ou abaixo dela.
+    for index in range(len(bands) - 2, -1, -1):
+        np.minimum(first_rows[index], first_rows[index + 1], out=first_rows[index])
+    if len(bands) and first_rows[0].min() >= NO_FEATURE_ROW:
+        print(f"ATENÇÃO: nenhum pixel de feição em {Path(src.name).name}; distâncias serão infinitas.")
+    return first_rows
+
+
+def process_exact(
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
+    band_rows: int,
+    px: float,
+    py: float,
+) -> None:
+    """EDT exata em faixas de linhas, sem borda: cada pixel é lido duas vezes.
+
+    1ª passada: registra, por faixa e coluna, a primeira linha com feição.
+    2ª passada: combina esse índice com a faixa atual (distância vertical exata)
+    e resolve a direção horizontal com `row_envelope_distances`.
+    """
+    height, width = sources[0].height, sources[0].width
+    bands = list(iter_row_bands(height, width, band_rows))
+
+    progress = ProgressPrinter("Indexando feições por coluna", len(bands) * len(sources), mode="count")
+    first_rows = [column_first_rows(src, bands, progress) for src in sources]
+    progress.finish()
+
+    no_below = np.full(width, NO_FEATURE_ROW, dtype=np.int64)
+    carries_above = [np.full(width, -NO_FEATURE_ROW, dtype=np.int64) for _ in sources]
+    progress = ProgressPrinter("Calculando faixas exatas", len(bands), mode="count")
+    with metrics.hot_loop("process_exact"):
+        for index, window in enumerate(bands):
+            for layer, src in enumerate(sources):
+                with metrics.stage("read", band=index, layer=layer):
+                    block = src.read(1, window=window, masked=False)
+                with metrics.stage("edt", band=index, layer=layer):
+                    features, mask = feature_mask_block(block, src.nodata)
+                    carry_below = first_rows[layer][index + 1] if index + 1 < len(bands) else no_below
+                    dy, feature_rows, carries_above[layer] = vertical_offsets(
+                        features, window.row_off, carries_above[layer], carry_below
+                    )
+
+                    distance, nearest_cols = row_envelope_distances(dy, px, py)
+                    distance = distance.astype(np.float32, copy=False)
+                    distance[~mask] = np.nan
+                    nearest = None
+                    if writer.nearest is not None:
+                        nearest = np.stack([np.take_along_axis(feature_rows, nearest_cols, axis=1), nearest_cols])
+                with metrics.stage("write", band=index, layer=layer):
+                    writer.write(layer, distance, window, nearest)
+            progress.increment()
+
+    progress.finish()
+
+
+# Densidade de feições (fração dos pixels) abaixo da qual --engine auto usa o kdtree.
+DEFAULT_KDTREE_DENSITY = 0.001
+# Pixels por consulta ao cKDTree (coordenadas float64: ~16 MB por lote).
+KDTREE_BATCH_PIXELS = 1 << 20
+
+
+class FeaturePoints:
+    """Centros dos pixels de feição de uma camada num `cKDTree` (motor kdtree).
+
+    A distância entre centros de pixel é a mesma que a EDT mede, então o resultado
+    coincide com o motor exato; só empates podem apontar outra feição em `--nearest`.
+    """
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, px: float, py: float) -> None:
+        self.rows = rows
+        self.cols = cols
+        self.px, self.py = px, py
+        self.tree = cKDTree(np.column_stack([rows * py, cols * px])) if rows.size else None
+
+    @property
+    def count(self) -> int:
+        return int(self.rows.size)
+
+    @classmethod
+    def extract(
+        cls,
+        src: rasterio.io.DatasetReader,
+        bands: list[Window],
+        px: float,
+        py: float,
+        limit: int | None,
+        progress: ProgressPrinter,
+    ) -> "FeaturePoints | None":
+        """Lê a camada uma vez juntando linha/coluna das feições; None se passar de `limit`."""
+        rows, cols = [], []
+        total = 0
+        for window in bands:
+            features, _ = feature_mask_block(src.read(1, window=window, masked=False), src.nodata)
+            band_rows, band_cols = np.nonzero(features)
+            total += band_rows.size
+            if limit is not None and total > limit:
+                return None
+            rows.append(band_rows.astype(np.int64) + window.row_off)
+            cols.append(band_cols.astype(np.int64) + window.col_off)
             progress.increment()
+        empty = np.empty(0, dtype=np.int64)
+        return cls(np.concatenate(rows) if rows else empty, np.concatenate(cols) if cols else empty, px, py)
 
+    def query(
+        self,
+        window: Window,
+        max_distance: float | None = None,
+        workers: int = 1,
+        with_nearest: bool = False,
+    ) -> tuple[np.ndarray, np.ndarray | None]:
+        """Distância (float32) e, se pedido, linha/coluna da feição mais próxima na janela."""
+        distance = np.full((window.height, window.width), np.inf, dtype=np.float32)
+        nearest = np.zeros((2, window.height, window.width), dtype=np.int64) if with_nearest else None
+        if self.tree is None:
+            return distance, nearest
+
+        bound = np.inf if max_distance is None else max_distance
+        cols = np.arange(window.col_off, window.col_off + window.width) * self.px
+        step = max(1, KDTREE_BATCH_PIXELS // window.width)
+        for start in range(0, window.height, step):
+            stop = min(start + step, window.height)
+            rows = np.arange(window.row_off + start, window.row_off + stop) * self.py
+            points = np.column_stack([np.repeat(rows, window.width), np.tile(cols, stop - start)])
+            found, index = self.tree.query(points, distance_upper_bound=bound, workers=workers)
+            distance[start:stop] = found.reshape(stop - start, window.width)
+            if with_nearest:
+                # Sem vizinho dentro do limite o índice volta == n; o NearestEncoding ignora esses pixels.
+                index = np.minimum(index, self.count - 1).reshape(stop - start, window.width)
+                nearest[0, start:stop] = self.rows[index]
+                nearest[1, start:stop] = self.cols[index]
+        return distance, nearest
+
+
+def extract_feature_points(
+    sources: list[rasterio.io.DatasetReader],
+    bands: list[Window],
+    px: float,
+    py: float,
+    max_density: float | None,
+) -> list[FeaturePoints] | None:
+    """Pontos de todas as camadas; None assim que alguma passa de `max_density`."""
+    height, width = sources[0].height, sources[0].width
+    limit = None if max_density is None else int(max_density * height * width)
+    progress = ProgressPrinter("Extraindo feições", len(bands) * len(sources), mode="count")
+    layers = []
+    for src in sources:
+        points = FeaturePoints.extract(src, bands, px, py, limit, progress)
+        if points is None:
+            print(f"{Path(src.name).name}: mais de {max_density:.3%} dos pixels são feição.")
+            return None
+        if points.count == 0:
+            print(f"ATENÇÃO: nenhum pixel de feição em {Path(src.name).name}; distâncias serão infinitas.")
+        layers.append(points)
+    progress.finish()
+    return layers
+
+
+def process_kdtree(
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
+    bands: list[Window],
+    layers: list[FeaturePoints],
+    workers: int = 1,
+) -> None:
+    """Consulta o cKDTree de cada camada faixa a faixa; o NoData vem da própria faixa."""
+    progress = ProgressPrinter("Consultando kdtree", len(bands), mode="count")
+    for index, window in enumerate(bands):
+        for layer, (src, points) in enumerate(zip(sources, layers)):
+            with metrics.stage("query", band=index, layer=layer):
+                distance, nearest = points.query(
+                    window, writer.encoding.max_distance, workers, writer.nearest is not None
+                )
+            if has_nodata_mask(src.nodata):
+                with metrics.stage("read", band=index, layer=layer):
+                    _, mask = feature_mask_block(src.read(1, window=window, masked=False), src.nodata)
+                distance[~mask] = np.nan
+            with metrics.stage("write", band=index, layer=layer):
+                writer.write(layer, distance, window, nearest)
+        progress.increment()
     progress.finish()
 
 
+def process_sparse(
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
+    band_rows: int,
+    px: float,
+    py: float,
+    workers: int = 1,
+    max_density: float | None = DEFAULT_KDTREE_DENSITY,
+) -> None:
+    """Motor kdtree se todas as camadas forem esparsas (`max_density`), senão o exato.
+
+    Com `max_density=None` o kdtree é usado sempre.
+    """
+    bands = list(iter_row_bands(sources[0].height, sources[0].width, band_rows))
+    layers = extract_feature_points(sources, bands, px, py, max_density)
+    if layers is None:
+        print("Camadas densas: usando o motor exato.")
+        process_exact(sources, writer, band_rows, px, py)
+        return
+    counts = ", ".join(f"{points.count}" for points in layers)
+    print(f"Motor kdtree: {counts} pixels de feição; consultas com {workers} thread(s).")
+    process_kdtree(sources, writer, bands, layers, workers)
+
+
 def process_full_raster(
-    src: rasterio.io.DatasetReader,
-    out_path: Path,
+    sources: list[rasterio.io.DatasetReader],
+    writer: DistanceWriter,
     tmp_path: Path,
     px: float,
     py: float,
 ) -> None:
-    total_blocks = estimate_total_blocks(src)
-    rivers_zero, valid_mask = build_binary_arrays(
-        src, tmp_path, ProgressPrinter("Preparando raster binário", total_blocks)
-    )
+    for layer, src in enumerate(sources):
+        if len(sources) > 1:
+            print(f"Camada {layer + 1}/{len(sources)}: {Path(src.name).name}")
+        total_blocks = estimate_total_blocks(src)
+        rivers_zero, valid_mask = build_binary_arrays(
+            src, tmp_path, ProgressPrinter("Preparando raster binário", total_blocks)
+        )
 
-    distance_mm = allocate_memmap(tmp_path, "distance.float64", np.float64, (src.height, src.width))
-    print("Calculando distância (transformada EDT)...")
-    distance_transform_edt(
-        rivers_zero,
-        sampling=(py, px),
-        return_distances=True,
-        return_indices=False,
-        distances=distance_mm,
-    )
-    print("Transformada EDT concluída.")
+        # Só a transformada de feições (int32, em memmap) é calculada no raster inteiro: o
+        # distance_transform_edt com distâncias alocaria vários float64 temporários em RAM.
+        indices = allocate_memmap(tmp_path, "indices.int32", np.int32, (2, src.height, src.width))
+        print("Calculando distância (transformada EDT)...")
+        distance_transform_edt(
+            rivers_zero,
+            sampling=(py, px),
+            return_distances=False,
+            return_indices=True,
+            indices=indices,
+        )
+        del rivers_zero
+        print("Transformada EDT concluída.")
+
+        write_distance_raster(
+            src, indices, valid_mask, writer, layer, px, py, ProgressPrinter("Gravando GeoTIFF", total_blocks)
+        )
+        del indices, valid_mask
+    print(f"Pico de RSS: {peak_rss_mb():.0f} MB")
+
+
+def check_aligned_grids(sources: list[rasterio.io.DatasetReader]) -> None:
+    """Todas as camadas precisam compartilhar a mesma grade (tamanho, transform e CRS)."""
+    reference = sources[0]
+    for src in sources[1:]:
+        if (src.height, src.width) != (reference.height, reference.width) or src.transform != reference.transform:
+            raise SystemExit(f"{src.name} não está na mesma grade de {reference.name}.")
+        if src.crs != reference.crs:
+            raise SystemExit(f"{src.name} tem CRS {format_crs(src.crs)}, diferente de {format_crs(reference.crs)}.")
+
+
+# Bytes por pixel medidos (tracemalloc) nos laços de cada motor; usados pelo --memory-budget.
+# padded: pico da distance_transform_edt (transformada int32 + temporários float64) por pixel do tile com borda...
+PLAN_EDT_BYTES_PER_PIXEL = 36
+# ... mais, por camada, o bloco uint8 lido e a distância float32 retida até a gravação (+8 com --nearest).
+PLAN_LAYER_BYTES_PER_PIXEL = 5
+PLAN_NEAREST_BYTES_PER_PIXEL = 8
+# exact: deslocamentos int64, envelope e distância por pixel da faixa (kdtree fica abaixo disso).
+PLAN_EXACT_BYTES_PER_PIXEL = 84
+PLAN_EXACT_NEAREST_BYTES_PER_PIXEL = 16
+# kdtree: linha/coluna int64, coordenadas float64 e índices da árvore por pixel de feição.
+PLAN_KDTREE_BYTES_PER_FEATURE = 48
+# Interpretador + numpy/scipy/rasterio + folga para o cache de blocos do GDAL, por processo.
+PLAN_PROCESS_BYTES = 160 * 1024 * 1024
+PLAN_TILE_STEP = 256
+PLAN_MAX_PADDING = 4096
+# Sem --max-distance, a borda vem do índice de ocupação (células deste tamanho, salvo --occupancy-cell).
+PLAN_OCCUPANCY_CELL = 256
+# Amostra da varredura de densidade: faixas de linha inteira espalhadas pelo raster.
+PLAN_SCAN_BANDS = 16
+PLAN_SCAN_PIXELS = 1 << 24
+
+MEMORY_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_memory_size(text: str) -> int:
+    """'8G', '1500M', '2.5g' -> bytes (sem sufixo: MB)."""
+    value = text.strip().upper().removesuffix("B")
+    unit = MEMORY_UNITS["M"]
+    if value and value[-1] in MEMORY_UNITS:
+        unit = MEMORY_UNITS[value[-1]]
+        value = value[:-1]
+    try:
+        size = float(value) * unit
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"tamanho de memória inválido: {text!r} (ex.: 8G, 1500M).")
+    if size <= 0:
+        raise argparse.ArgumentTypeError("o orçamento de memória deve ser positivo.")
+    return int(size)
+
+
+def format_bytes(size: float) -> str:
+    return f"{size / (1 << 30):.1f} GB" if size >= 1 << 30 else f"{size / (1 << 20):.0f} MB"
+
+
+def scan_feature_density(
+    sources: list[rasterio.io.DatasetReader],
+    bands: int = PLAN_SCAN_BANDS,
+    sample_pixels: int = PLAN_SCAN_PIXELS,
+) -> list[float]:
+    """Fração de pixels válidos que são feição, por camada, a partir de faixas espaçadas.
+
+    Faixas de linha inteira custam o mesmo em TIFF em faixas ou em tiles (cada bloco
+    tocado é decodificado uma vez) e pegam toda estrada/rio que as atravesse.
+    """
+    height, width = sources[0].height, sources[0].width
+    band_rows = max(1, min(height // bands, sample_pixels // (bands * max(width, 1))))
+    starts = np.linspace(0, height - band_rows, min(bands, height // band_rows), dtype=np.int64)
+    windows = [Window(0, int(row), width, band_rows) for row in np.unique(starts)]
+    densities = []
+    for src in sources:
+        features = valid = 0
+        for window in windows:
+            feature_block, mask = feature_mask_block(src.read(1, window=window, masked=False), src.nodata)
+            features += int(feature_block.sum())
+            valid += int(mask.sum())
+        densities.append(features / max(valid, 1))
+    return densities
+
+
+@dataclass(frozen=True)
+class TilePlan:
+    """Tile, borda e processos escolhidos para caber em --memory-budget."""
+
+    tile_size: int
+    tile_padding: int
+    workers: int
+    peak_bytes: int
+    density: float
+
+    def describe(self, engine: str, budget: int) -> str:
+        if engine == "padded":
+            layout = f"tiles de {self.tile_size}px com borda de {self.tile_padding}px, {self.workers} processo(s)"
+        elif engine == "exact":
+            layout = f"faixas com a área de um tile de {self.tile_size}px"
+        else:
+            layout = f"faixas com a área de um tile de {self.tile_size}px, {self.workers} thread(s) no kdtree"
+        return (
+            f"Plano para {format_bytes(budget)}: densidade de feições {self.density:.3%}, motor {engine}, {layout};"
+            f" pico estimado {format_bytes(self.peak_bytes)}."
+        )
 
-    distance_mm[~valid_mask] = np.nan
-    distance_mm.flush()
 
-    write_distance_raster(src, distance_mm, out_path, ProgressPrinter("Gravando GeoTIFF", total_blocks))
+def padded_plan_bytes(
+    tile_size: int,
+    tile_padding: int,
+    workers: int,
+    layers: int,
+    height: int,
+    width: int,
+    with_nearest: bool = False,
+    pipeline: bool = False,
+) -> int:
+    """Pico estimado do motor padded: um tile por processo + resultados em voo no principal."""
+    padded_pixels = min(tile_size + 2 * tile_padding, height) * min(tile_size + 2 * tile_padding, width)
+    core_pixels = min(tile_size, height) * min(tile_size, width)
+    per_layer = PLAN_LAYER_BYTES_PER_PIXEL + (PLAN_NEAREST_BYTES_PER_PIXEL if with_nearest else 0)
+    tile_bytes = padded_pixels * (PLAN_EDT_BYTES_PER_PIXEL + layers * per_layer)
+    if workers == 1:
+        # O pipeline guarda o próximo tile lido e o anterior ainda em gravação.
+        extra = padded_pixels * layers * per_layer if pipeline else 0
+        return PLAN_PROCESS_BYTES + tile_bytes + extra
+    # _write_tiles_parallel mantém até 2 tiles codificados por worker à espera de gravação.
+    in_flight = 2 * workers * core_pixels * layers * (4 + (PLAN_NEAREST_BYTES_PER_PIXEL if with_nearest else 0))
+    return PLAN_PROCESS_BYTES + workers * (PLAN_PROCESS_BYTES + tile_bytes) + in_flight
+
+
+def plan_tiles(
+    sources: list[rasterio.io.DatasetReader],
+    engine: str,
+    budget: int,
+    tile_padding: int | None = None,
+    with_nearest: bool = False,
+    pipeline: bool = False,
+    kdtree_density: float = DEFAULT_KDTREE_DENSITY,
+    cpus: int | None = None,
+    occupancy_cell: int = 0,
+) -> TilePlan:
+    """Escolhe tile, borda e processos pelo orçamento de RAM e pela densidade das camadas.
+
+    `tile_padding` fixo (vindo de --max-distance) é respeitado; sem ele, a borda é o
+    alcance exato do `OccupancyIndex` (distância máxima de um pixel à feição mais
+    próxima), e o plano recusa o padded se esse alcance passar de PLAN_MAX_PADDING.
+    No padded, entre os números de processos possíveis fica o de maior vazão
+    estimada (processos úteis x fração do tile com borda que é miolo).
+    """
+    height, width = sources[0].height, sources[0].width
+    cpus = cpus or os.cpu_count() or 1
+    densities = scan_feature_density(sources)
+    density = min(densities)
+    largest = PLAN_TILE_STEP * math.ceil(max(height, width) / PLAN_TILE_STEP)
+
+    if engine != "padded":
+        available = budget - PLAN_PROCESS_BYTES
+        workers = 1
+        if engine == "kdtree" or (engine == "auto" and max(densities) < kdtree_density):
+            available -= int(sum(densities) * height * width * PLAN_KDTREE_BYTES_PER_FEATURE)
+            workers = cpus
+        per_pixel = PLAN_EXACT_BYTES_PER_PIXEL + (PLAN_EXACT_NEAREST_BYTES_PER_PIXEL if with_nearest else 0)
+        band_pixels = min(max(available, 0) // per_pixel, height * width)
+        tile_size = max(PLAN_TILE_STEP, math.isqrt(band_pixels) // PLAN_TILE_STEP * PLAN_TILE_STEP)
+        peak = budget - available + min(tile_size * tile_size, height * width) * per_pixel
+        return TilePlan(tile_size, 0, workers, peak, density)
+
+    if tile_padding is None:
+        if any(isinstance(src, VirtualMosaic) for src in sources):
+            raise SystemExit(
+                "--memory-budget no motor padded sem --max-distance precisa do índice de ocupação, que não"
+                " funciona com entradas virtuais; informe --max-distance ou use --engine exact."
+            )
+        px, py = abs(sources[0].transform.a), abs(sources[0].transform.e)
+        whole = Window(0, 0, width, height)
+        tile_padding = max(
+            OccupancyIndex.load_or_build(src, occupancy_cell or PLAN_OCCUPANCY_CELL).tile_padding(whole, px, py, None, 0)
+            for src in sources
+        )
+        if tile_padding > PLAN_MAX_PADDING:
+            raise SystemExit(
+                f"Sem --max-distance, há pixels a até {tile_padding}px da feição mais próxima: a borda exata passa"
+                f" de {PLAN_MAX_PADDING}px. Informe --max-distance ou use --engine exact (sem borda)."
+            )
+        # Múltiplo de 64 (planos estáveis entre rodadas) e nunca maior que o próprio raster.
+        tile_padding = min(-(-tile_padding // 64) * 64, max(height, width))
+
+    def fits(size: int, workers: int) -> bool:
+        peak = padded_plan_bytes(size, tile_padding, workers, len(sources), height, width, with_nearest, pipeline)
+        return peak <= budget
+
+    best = None
+    for workers in range(1, cpus + 1):
+        size = largest
+        while size > PLAN_TILE_STEP and not fits(size, workers):
+            size -= PLAN_TILE_STEP
+        if not fits(size, workers):
+            break
+        tiles = math.ceil(height / size) * math.ceil(width / size)
+        core = min(size, height) * min(size, width)
+        padded = min(size + 2 * tile_padding, height) * min(size + 2 * tile_padding, width)
+        throughput = min(workers, tiles) * core / padded
+        if best is None or throughput > best[0]:
+            best = (throughput, size, workers)
+    if best is None:
+        raise SystemExit(
+            f"--memory-budget {format_bytes(budget)} não comporta nem um tile de {PLAN_TILE_STEP}px com borda de"
+            f" {tile_padding}px; aumente o orçamento, reduza --max-distance ou use --engine exact (sem borda)."
+        )
+    _, tile_size, workers = best
+    peak = padded_plan_bytes(tile_size, tile_padding, workers, len(sources), height, width, with_nearest, pipeline)
+    return TilePlan(tile_size, tile_padding, workers, peak, density)
 
 
 def main(
-    in_tif: str,
-    out_tif: str,
+    in_tifs: list[str],
+    out_tifs: list[str],
     tile_size: int,
     tile_padding: int,
+    engine: str = "padded",
+    workers: int = 1,
+    pipeline: bool = False,
+    encoding: DistanceEncoding = DistanceEncoding(),
+    occupancy_cell: int = 0,
+    raw: bool = False,
+    multiband: bool = False,
+    nearest_kind: str | None = None,
+    layout: OutputLayout = OutputLayout(),
+    clip_shape: str | None = None,
+    clip_cell: int = DEFAULT_CELL_SIZE,
+    incremental: bool = False,
+    kdtree_density: float = DEFAULT_KDTREE_DENSITY,
+    memory_budget: int | None = None,
 ) -> None:
-    with rasterio.open(in_tif) as src, tempfile.TemporaryDirectory() as tmp_dir:
+    if multiband and len(out_tifs) != 1:
+        raise SystemExit("--multiband grava um único GeoTIFF: informe exatamente um --out.")
+    if not multiband and len(out_tifs) != len(in_tifs):
+        raise SystemExit("Informe um --out por --in (ou use --multiband).")
+
+    with ExitStack() as stack, tempfile.TemporaryDirectory() as tmp_dir:
+        sources = [stack.enter_context(open_input(path, raw)) for path in in_tifs]
+        check_aligned_grids(sources)
+        src = sources[0]
         tmp_path = Path(tmp_dir)
         transform: Affine = src.transform
         crs = src.crs
@@ -279,24 +1863,194 @@ def main(
                 "ATENÇÃO: CRS não projetado. As distâncias sairão nas unidades originais."
                 " Idealmente reprojete para um CRS métrico."
             )
+        if len(sources) > 1:
+            print(f"{len(sources)} camadas alinhadas: grade e tiles compartilhados em uma única passada.")
+        for layer_src in sources:
+            if isinstance(layer_src, VirtualMosaic):
+                print(
+                    f"Entrada virtual com {len(layer_src.sources)} arquivos: grade única de"
+                    f" {layer_src.height}x{layer_src.width} px (distâncias atravessam os limites entre eles)."
+                )
 
         px = abs(transform.a)
         py = abs(transform.e)
 
-        if tile_size > 0:
+        if raw:
+            print(f"Entrada bruta: normalizando blocos em memória (NoData={src.raw_nodata} -> 0, >0 -> 1).")
+
+        if encoding.max_distance is not None:
+            print(f"Distâncias saturadas em {encoding.max_distance} m.")
+            if encoding.quantize_step is not None:
+                print(f"Saída uint16 quantizada: scale={encoding.quantize_step}, offset=0, NoData={QUANTIZED_NODATA}.")
+            if engine == "padded":
+                # A borda só precisa cobrir o limite: além dele tudo satura na constante.
+                tile_padding = math.ceil(encoding.max_distance / min(px, py))
+
+        nearest = None
+        if nearest_kind is not None:
+            max_offset = None
+            if encoding.max_distance is not None:
+                max_offset = math.ceil(encoding.max_distance / min(px, py))
+            nearest = NearestEncoding.for_grid(nearest_kind, src.height, src.width, max_offset)
+            print(
+                f"Feição mais próxima ({nearest.kind}, {nearest.dtype}, NoData={nearest.nodata})"
+                f" em {', '.join(nearest_path(Path(path)).name for path in out_tifs)}."
+            )
+
+        if memory_budget is not None:
+            # Com --max-distance a borda do padded já está definida; o plano só escolhe tile e processos.
+            fixed_padding = tile_padding if engine == "padded" and encoding.max_distance is not None else None
+            plan = plan_tiles(
+                sources,
+                engine,
+                memory_budget,
+                fixed_padding,
+                nearest is not None,
+                pipeline,
+                kdtree_density,
+                occupancy_cell=occupancy_cell,
+            )
+            print(plan.describe(engine, memory_budget))
+            if plan.peak_bytes > memory_budget:
+                print("ATENÇÃO: a árvore do kdtree sozinha já passa do orçamento; considere --engine exact.")
+            tile_size, workers = plan.tile_size, plan.workers
+            if engine == "padded":
+                tile_padding = plan.tile_padding
+
+        clip = None
+        if clip_shape is not None:
+            try:
+                check_shape_crs(Path(clip_shape), crs)
+                clip = CutlineMask.load_or_build(Path(clip_shape), src, clip_cell)
+            except ValueError as exc:
+                raise SystemExit(str(exc))
+            print(f"Recorte por {Path(clip_shape).name} no escritor: {clip.summary()}.")
+
+        update_tiles = None
+        if incremental:
+            if layout.cog:
+                raise SystemExit("--incremental não atualiza COG no lugar (as overviews seriam regeradas inteiras).")
+            if occupancy_cell > 0:
+                raise SystemExit("--incremental não combina com --occupancy-cell (a borda mudaria com a entrada).")
+            # Raio de influência: até onde uma edição na entrada pode mudar a saída.
+            if engine == "padded" and tile_size > 0:
+                recompute_tile, radius = tile_size, tile_padding
+            elif encoding.max_distance is not None:
+                recompute_tile = tile_size or DEFAULT_EXACT_TILE_SIZE
+                radius = math.ceil(encoding.max_distance / min(px, py))
+            else:
+                raise SystemExit(
+                    "--incremental precisa de raio de influência limitado: use --max-distance"
+                    " ou o motor padded com --tile-size."
+                )
+            settings = {
+                "inputs": list(in_tifs),
+                "outputs": list(out_tifs),
+                "grid": [src.height, src.width, list(transform)[:6]],
+                # exact, kdtree, auto e raster inteiro dão o mesmo resultado.
+                "engine": "padded" if engine == "padded" and tile_size > 0 else "exact",
+                "tile": [recompute_tile, radius] if engine == "padded" and tile_size > 0 else None,
+                "max_distance": encoding.max_distance,
+                "quantize_step": encoding.quantize_step,
+                "multiband": multiband,
+                "nearest": nearest_kind,
+                "compress": layout.compress,
+                "clip": [clip_shape, clip_cell] if clip_shape is not None else None,
+            }
+            manifest = BlockManifest(settings, hash_blocks(sources))
+            previous = BlockManifest.load(manifest_path(Path(out_tifs[0])))
+            expected = [Path(path) for path in out_tifs[: 1 if multiband else None]]
+            if nearest is not None:
+                expected += [nearest_path(path) for path in expected]
+            if previous is None or not previous.matches(manifest) or not all(path.exists() for path in expected):
+                print("Sem manifesto compatível com estes parâmetros: processamento completo.")
+            else:
+                changed = previous.changed_blocks(manifest, src.height, src.width)
+                update_tiles = affected_tiles(changed, HASH_BLOCK_SIZE, src.height, src.width, recompute_tile, radius)
+                print(
+                    f"Incremental: {int(changed.sum())} de {changed.size} blocos de {HASH_BLOCK_SIZE}px mudaram;"
+                    f" {len(update_tiles)} tiles de {recompute_tile}px (raio {radius}px) serão regravados."
+                )
+
+        layer_names = [input_layer_name(path) for path in in_tifs]
+        writer = stack.enter_context(
+            DistanceWriter(
+                [Path(path) for path in out_tifs],
+                distance_profile(src, encoding),
+                encoding,
+                layer_names,
+                multiband,
+                nearest,
+                layout,
+                clip,
+                update=update_tiles is not None,
+            )
+        )
+
+        if update_tiles is not None:
+            # Tiles com borda = raio: cada pixel regravado vê toda feição que pode afetá-lo.
+            if update_tiles:
+                process_tiles(sources, writer, recompute_tile, radius, px, py, workers, pipeline, windows=update_tiles)
+        elif engine in ("exact", "kdtree", "auto"):
+            band_rows = exact_band_rows(src.width, tile_size or DEFAULT_EXACT_TILE_SIZE)
+            if layout.cog:
+                # Faixas em múltiplos do tile da saída: nenhum tile é gravado em duas vezes.
+                band_rows = max(layout.block_size, band_rows - band_rows % layout.block_size)
+            print(f"Motor {engine}: faixas de {band_rows} linhas x {src.width} colunas (sem borda extra).")
+            if engine == "exact":
+                process_exact(sources, writer, band_rows, px, py)
+            else:
+                process_sparse(sources, writer, band_rows, px, py, workers, None if engine == "kdtree" else kdtree_density)
+        elif tile_size > 0:
+            if layout.cog and tile_size % layout.block_size:
+                print(f"ATENÇÃO: --tile-size não é múltiplo de {layout.block_size}; tiles do COG serão regravados.")
             print(
                 f"Processando em tiles de {tile_size}px com borda extra de {tile_padding}px."
                 " Certifique-se de usar padding >= distância máxima que precisa preservar."
             )
-            process_tiles(src, Path(out_tif), tile_size, tile_padding, px, py)
+            occupancies = []
+            if occupancy_cell > 0 and any(isinstance(layer_src, VirtualMosaic) for layer_src in sources):
+                raise SystemExit("--occupancy-cell não funciona com entradas virtuais (sidecar por arquivo).")
+            if occupancy_cell > 0:
+                for layer_src in sources:
+                    occupancy = OccupancyIndex.load_or_build(layer_src, occupancy_cell)
+                    print(
+                        f"Ocupação: {occupancy.occupied.mean() * 100:.1f}% das células de {occupancy_cell}px com feição;"
+                        " borda ajustada por tile."
+                    )
+                    occupancies.append(occupancy)
+            if workers > 1:
+                print(f"Distribuindo tiles entre {workers} processos.")
+            elif pipeline:
+                print("Pipeline ativo: leitura e gravação em threads enquanto a EDT roda.")
+            process_tiles(sources, writer, tile_size, tile_padding, px, py, workers, pipeline, occupancies)
         else:
-            process_full_raster(src, Path(out_tif), tmp_path, px, py)
+            process_full_raster(sources, writer, tmp_path, px, py)
+
+    if incremental:
+        manifest.save(manifest_path(Path(out_tifs[0])))
+        print(f"Manifesto de blocos salvo em {manifest_path(Path(out_tifs[0]))}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Mapa de distâncias até os pixels com valor 1 (rios).")
-    parser.add_argument("--in", dest="in_tif", required=True, help="TIFF binário (1=rio, 0=terra).")
-    parser.add_argument("--out", dest="out_tif", required=True, help="TIFF de saída com distâncias em metros.")
+    parser.add_argument(
+        "--in",
+        dest="in_tifs",
+        nargs="+",
+        required=True,
+        help=(
+            "TIFF binário (1=rio, 0=terra). Várias camadas na mesma grade são processadas juntas."
+            " Arquivos separados por vírgula (ex.: um por UF) viram uma única camada na união das grades."
+        ),
+    )
+    parser.add_argument(
+        "--out",
+        dest="out_tifs",
+        nargs="+",
+        required=True,
+        help="TIFF de saída com distâncias em metros (um por --in, ou um só com --multiband).",
+    )
     parser.add_argument(
         "--tile-size",
         dest="tile_size",
@@ -311,5 +2065,169 @@ if __name__ == "__main__":
         default=512,
         help="Borda extra por tile (pixels). Deve ser >= à distância máxima que precisa ser considerada.",
     )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="padded",
+        help=(
+            "padded: tiles com borda (exato só até --tile-padding). exact: faixas sem borda, distância"
+            " euclidiana exata com RAM limitada (faixas com a mesma área de um tile de --tile-size)."
+            " kdtree: consulta os centros dos pixels de feição num cKDTree (mesmo resultado do exact,"
+            " rápido em camadas esparsas). auto: kdtree se a densidade de feições < --kdtree-density, senão exact."
+        ),
+    )
+    parser.add_argument(
+        "--kdtree-density",
+        dest="kdtree_density",
+        type=float,
+        default=DEFAULT_KDTREE_DENSITY,
+        help="Fração máxima de pixels de feição para o --engine auto escolher o kdtree (padrão: 0.001).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Processos paralelos para leitura + EDT dos tiles (motor padded) ou threads das consultas"
+            " do kdtree. Saída idêntica ao modo serial."
+        ),
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Motor padded com 1 worker: sobrepõe leitura, EDT e gravação e reporta o tempo de cada estágio.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        dest="memory_budget",
+        type=parse_memory_size,
+        default=None,
+        metavar="TAMANHO",
+        help=(
+            "RAM total disponível (ex.: 8G, 1500M). Estima o pico da EDT por tile/faixa, varre a densidade"
+            " de feições numa amostra e escolhe --tile-size, --tile-padding (padded, sem --max-distance) e"
+            " --workers, imprimindo o plano antes de rodar."
+        ),
+    )
+    parser.add_argument(
+        "--max-distance",
+        dest="max_distance",
+        type=float,
+        help=(
+            "Limite (metros): distâncias maiores saturam nesse valor. No motor padded a borda passa a"
+            " cobrir só o limite e tiles sem feição por perto são preenchidos sem rodar a EDT."
+        ),
+    )
+    parser.add_argument(
+        "--quantize-step",
+        dest="quantize_step",
+        type=float,
+        help=(
+            "Grava uint16 com scale=passo (ex.: 1 = metros, 0.1 = decímetros) e NoData=65535."
+            " Exige --max-distance e max-distance/passo < 65535."
+        ),
+    )
+    parser.add_argument(
+        "--occupancy-cell",
+        dest="occupancy_cell",
+        type=int,
+        default=0,
+        help=(
+            "Motor padded: indexa a ocupação de feições em células deste tamanho (px), escolhe a menor"
+            " borda exata por tile e pula tiles além de --max-distance. Índice salvo em <entrada>.occupancy.npz."
+        ),
+    )
+    parser.add_argument(
+        "--multiband",
+        action="store_true",
+        help="Grava todas as camadas de --in como bandas de um único GeoTIFF (descrição = nome da camada).",
+    )
+    parser.add_argument(
+        "--nearest",
+        choices=NEAREST_KINDS,
+        default=None,
+        help=(
+            "Grava também <saída>_nearest.tif com a feição mais próxima: 'index' (linha/coluna globais, int32)"
+            " ou 'offset' (dy/dx em pixels, int16 quando cabe)."
+        ),
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help=(
+            "Lê direto o TIFF bruto de 00_inputs_tiffs e normaliza cada bloco como prep_binary_inputs.py"
+            " (dispensa o TIFF intermediário em 00_inputs_binary_ready)."
+        ),
+    )
+    parser.add_argument(
+        "--cog",
+        action="store_true",
+        help="Grava Cloud-Optimized GeoTIFF em tiles com overviews internas (leituras por janela e prévias rápidas).",
+    )
+    parser.add_argument(
+        "--cog-block-size",
+        dest="cog_block_size",
+        type=int,
+        default=DEFAULT_COG_BLOCK_SIZE,
+        help="Lado dos tiles do COG em pixels (múltiplo de 16).",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSIONS,
+        default="deflate",
+        help="Compressão da saída. lerc é sem perdas (MAX_Z_ERROR=0).",
+    )
+    parser.add_argument(
+        "--clip-shape",
+        dest="clip_shape",
+        default=None,
+        help=(
+            "Shapefile/GeoJSON (mesmo CRS) para recortar já na gravação, como o run_clip_masks.sh"
+            " (bbox do polígono, NoData -9999 em float)."
+        ),
+    )
+    parser.add_argument(
+        "--clip-cell",
+        dest="clip_cell",
+        type=int,
+        default=DEFAULT_CELL_SIZE,
+        help="Lado das células da máscara de recorte em pixels.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Guarda hashes dos blocos de entrada em <saída>.blocks.json; na próxima rodada com os mesmos"
+            " parâmetros, recalcula e regrava no lugar só os tiles ao alcance dos blocos alterados"
+            " (exige motor padded com --tile-size ou --max-distance)."
+        ),
+    )
+    add_metrics_arguments(parser)
     args = parser.parse_args()
-    main(args.in_tif, args.out_tif, max(0, args.tile_size), max(0, args.tile_padding))
+    configure_from_args(args)
+    try:
+        encoding = DistanceEncoding(args.max_distance, args.quantize_step)
+        layout = OutputLayout(args.cog, args.compress, args.cog_block_size)
+    except ValueError as exc:
+        parser.error(str(exc))
+    main(
+        args.in_tifs,
+        args.out_tifs,
+        max(0, args.tile_size),
+        max(0, args.tile_padding),
+        args.engine,
+        max(1, args.workers),
+        args.pipeline,
+        encoding,
+        max(0, args.occupancy_cell),
+        args.raw,
+        args.multiband,
+        args.nearest,
+        layout,
+        args.clip_shape,
+        max(16, args.clip_cell),
+        args.incremental,
+        max(0.0, args.kdtree_density),
+        args.memory_budget,
+    )
+    metrics.close()
@@ -0,0 +1,251 @@
+"""Medições por estágio (parede, CPU, bytes lidos/gravados e RSS) dos scripts do fluxo.
+
+Desligado por padrão: `metrics.stage(...)` devolve um contexto vazio compartilhado e o
+custo fica em uma chamada de método por estágio. Ligado (`--metrics`), cada estágio de
+cada tile/bloco vira uma linha JSON (`--metrics saida.jsonl`) e, no fim, um resumo por
+estágio aponta se a rodada ficou presa em leitura, EDT ou gravação/compressão.
+`--profile saida.prof` liga o cProfile só em volta dos laços principais.
+"""
+
+from __future__ import annotations
+
+import argparse
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterator, TextIO
+
+# Contadores de I/O por thread (Linux >= 3.17); sem eles, os do processo.
+_IO_PATHS = ("/proc/thread-self/io", "/proc/self/io")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_NULL_STAGE = nullcontext()
+
+
+def _io_counters() -> tuple[int, int]:
+    """(bytes lidos, bytes gravados) por chamadas de sistema; (0, 0) fora do Linux."""
+    for path in _IO_PATHS:
+        try:
+            with open(path) as handle:
+                values = dict(line.split(": ") for line in handle.read().splitlines())
+            return int(values["rchar"]), int(values["wchar"])
+        except OSError:
+            continue
+    return 0, 0
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as handle:
+            return int(handle.read().split()[1]) * _PAGE_SIZE / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Instrumentation:
+    """Registro de estágios; uma instância global (`metrics`) por processo.
+
+    Em processos de pool (`buffer=True`) os registros ficam em memória e voltam junto
+    com o resultado da tarefa (`drain`); o processo principal os grava com `absorb`.
+    Leitura, EDT e gravação registram de threads diferentes (`--pipeline`), então
+    totais e linhas JSON só são tocados sob `_lock`.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._buffer: list[dict] | None = None
+        self._out: TextIO | None = None
+        self._totals: dict[str, dict[str, float]] = {}
+        self._start = time.perf_counter()
+        self._profiler: cProfile.Profile | None = None
+        self._profile_path: Path | None = None
+        self._profile_depth = 0
+        self._lock = threading.Lock()
+
+    def configure(
+        self,
+        enabled: bool = True,
+        jsonl_path: Path | None = None,
+        profile_path: Path | None = None,
+        buffer: bool = False,
+    ) -> None:
+        self.enabled = enabled
+        self._buffer = [] if buffer else None
+        self._start = time.perf_counter()
+        if jsonl_path is not None:
+            self._out = open(jsonl_path, "w")
+        if profile_path is not None:
+            self._profile_path = profile_path
+            self._profiler = cProfile.Profile()
+
+    def stage(self, name: str, **fields):
+        """Contexto que mede o estágio `name` (ex.: read, edt, write) na thread atual."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._measure(name, fields)
+
+    @contextmanager
+    def _measure(self, name: str, fields: dict) -> Iterator[None]:
+        read_before, written_before = _io_counters()
+        cpu_before = time.thread_time()
+        wall_before = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_before
+            cpu = time.thread_time() - cpu_before
+            read_after, written_after = _io_counters()
+            self.record(name, wall, cpu, read_after - read_before, written_after - written_before, _rss_mb(), **fields)
+
+    def record(
+        self,
+        name: str,
+        wall_s: float,
+        cpu_s: float,
+        bytes_read: int = 0,
+        bytes_written: int = 0,
+        rss_mb: float | None = None,
+        **fields,
+    ) -> None:
+        entry = {
+            "event": "stage",
+            "stage": name,
+            "t": round(time.perf_counter() - self._start, 6),
+            "pid": os.getpid(),
+            "wall_s": wall_s,
+            "cpu_s": cpu_s,
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "rss_mb": rss_mb,
+            **fields,
+        }
+        with self._lock:
+            if self._buffer is not None:
+                self._buffer.append(entry)
+                return
+            self._accumulate(entry)
+            self._emit(entry)
+
+    def event(self, kind: str, **fields) -> None:
+        """Linha avulsa no JSON (ex.: fim de uma barra de progresso)."""
+        if self.enabled and self._buffer is None:
+            entry = {"event": kind, "t": round(time.perf_counter() - self._start, 6), "pid": os.getpid(), **fields}
+            with self._lock:
+                self._emit(entry)
+
+    def drain(self) -> list[dict]:
+        """Registros acumulados no processo de pool desde a última tarefa."""
+        if self._buffer is None:
+            return []
+        with self._lock:
+            records, self._buffer = self._buffer, []
+        return records
+
+    def absorb(self, records: list[dict]) -> None:
+        with self._lock:
+            for entry in records:
+                self._accumulate(entry)
+                self._emit(entry)
+
+    def _accumulate(self, entry: dict) -> None:
+        totals = self._totals.setdefault(
+            entry["stage"],
+            {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "bytes_read": 0, "bytes_written": 0, "rss_mb": 0.0},
+        )
+        totals["count"] += 1
+        for key in ("wall_s", "cpu_s", "bytes_read", "bytes_written"):
+            totals[key] += entry[key]
+        totals["rss_mb"] = max(totals["rss_mb"], entry["rss_mb"] or 0.0)
+
+    def _emit(self, entry: dict) -> None:
+        if self._out is not None:
+            self._out.write(json.dumps(entry) + "\n")
+
+    @contextmanager
+    def hot_loop(self, name: str) -> Iterator[None]:
+        """Liga o cProfile (se pedido) só durante o laço principal `name`."""
+        if self._profiler is None:
+            yield
+            return
+        self._profile_depth += 1
+        if self._profile_depth == 1:
+            self._profiler.enable()
+        try:
+            yield
+        finally:
+            self._profile_depth -= 1
+            if self._profile_depth == 0:
+                self._profiler.disable()
+            self.event("hot_loop", name=name)
+
+    def summary_lines(self) -> list[str]:
+        if not self._totals:
+            return []
+        total_wall = sum(totals["wall_s"] for totals in self._totals.values()) or 1.0
+        lines = ["Estágio            n   parede(s)   CPU(s)  CPU/parede  lido(MB)  gravado(MB)  RSS máx(MB)"]
+        for name, totals in sorted(self._totals.items(), key=lambda item: -item[1]["wall_s"]):
+            lines.append(
+                f"{name:<14}{int(totals['count']):>7}{totals['wall_s']:>12.2f}{totals['cpu_s']:>9.2f}"
+                f"{totals['cpu_s'] / max(totals['wall_s'], 1e-9):>12.0%}"
+                f"{totals['bytes_read'] / 1e6:>10.1f}{totals['bytes_written'] / 1e6:>13.1f}{totals['rss_mb']:>13.0f}"
+            )
+        slowest = max(self._totals, key=lambda name: self._totals[name]["wall_s"])
+        share = self._totals[slowest]["wall_s"] / total_wall
+        lines.append(f"Gargalo provável: {slowest} ({share:.0%} do tempo medido)")
+        return lines
+
+    def close(self) -> None:
+        """Imprime o resumo, grava a linha final (com --metrics) e o perfil (com --profile)."""
+        if self.enabled:
+            with self._lock:
+                lines = self.summary_lines()
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                self._emit({"event": "summary", "stages": self._totals, "peak_rss_mb": peak})
+                if self._out is not None:
+                    self._out.close()
+                self._out = None
+            if lines:
+                print("\n".join(lines))
+        if self._profiler is not None and self._profile_path is not None:
+            self._profiler.dump_stats(self._profile_path)
+            print(f"Perfil cProfile salvo em {self._profile_path} (ex.: python -m pstats {self._profile_path}).")
+            self._profiler = None
+        self.enabled = False
+
+
+metrics = Instrumentation()
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--metrics",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="JSONL",
+        help=(
+            "Mede parede, CPU, bytes lidos/gravados e RSS por estágio (leitura, EDT, gravação) e imprime"
+            " um resumo no fim. Com um caminho, grava também uma linha JSON por estágio/tile."
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="PROF",
+        help="Roda o cProfile só nos laços principais e salva em PROF (abra com pstats/snakeviz).",
+    )
+
+
+def configure_from_args(args: argparse.Namespace) -> None:
+    if args.metrics is None and args.profile is None:
+        return
+    # Só --profile liga o cProfile nos laços principais, sem medir cada estágio.
+    metrics.configure(
+        enabled=args.metrics is not None,
+        jsonl_path=Path(args.metrics) if args.metrics else None,
+        profile_path=Path(args.profile) if args.profile else None,
+    )
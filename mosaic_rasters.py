@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Mosaico dos recortes por UF direto em GeoTIFF tileado, sem VRT nem gdal_translate.
+
+A grade de saída é a união das fontes (mesmo CRS, pixel e alinhamento). O mosaico é
+percorrido tile a tile: um índice de extensões diz quais fontes tocam cada tile, só
+essas são lidas e os pixels válidos são mesclados de forma vetorizada (a última fonte
+da lista prevalece, como no `gdalbuildvrt`). Cada tile recebe o preditor (3 para
+float, 2 para inteiros) e é comprimido em deflate por um pool de threads; os bytes são
+anexados a um GeoTIFF criado vazio (SPARSE_OK), como no modo de cópia crua do
+`clip_bbox.py`. Tiles sem nenhum pixel válido ficam esparsos e são lidos como NoData.
+Fontes quantizadas (uint16 do `--quantize-step`) mantêm o NoData, o scale e o offset.
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from clip_bbox import CLASSIC_TIFF_LIMIT, TILE_BYTE_COUNTS, TILE_OFFSETS, tiff_tile_arrays
+from dist_map import format_crs
+
+MOSAIC_NODATA = -9999.0
+MOSAIC_BLOCK_SIZE = 512
+DEFAULT_ZLEVEL = 6
+# Tiles em voo por thread: limita a RAM dos tiles comprimidos à espera da gravação em ordem.
+TILES_IN_FLIGHT_PER_WORKER = 4
+
+
+class UnionGrid:
+    """União das extensões das fontes numa grade única, com a janela de cada fonte nela."""
+
+    def __init__(self, sources: list[rasterio.io.DatasetReader]) -> None:
+        reference = sources[0]
+        self.crs = reference.crs
+        self.px, self.py = abs(reference.transform.a), abs(reference.transform.e)
+        self.left = min(src.bounds.left for src in sources)
+        self.top = max(src.bounds.top for src in sources)
+        right = max(src.bounds.right for src in sources)
+        bottom = min(src.bounds.bottom for src in sources)
+        self.width = round((right - self.left) / self.px)
+        self.height = round((self.top - bottom) / self.py)
+        self.transform = Affine(self.px, 0.0, self.left, 0.0, -self.py, self.top)
+
+        self.windows = []
+        for src in sources:
+            name = Path(src.name).name
+            if src.crs != self.crs:
+                raise SystemExit(f"{name}: CRS {format_crs(src.crs)} difere de {format_crs(self.crs)}.")
+            if (abs(src.transform.a), abs(src.transform.e)) != (self.px, self.py):
+                raise SystemExit(f"{name}: pixel diferente das demais fontes; não dá para mosaicar sem reamostrar.")
+            if src.transform.b or src.transform.d:
+                raise SystemExit(f"{name}: grade rotacionada não é suportada.")
+            col = (src.bounds.left - self.left) / self.px
+            row = (self.top - src.bounds.top) / self.py
+            if not np.isclose(col, round(col), atol=1e-6) or not np.isclose(row, round(row), atol=1e-6):
+                raise SystemExit(
+                    f"{name}: grade desalinhada em relação às demais fontes; rasters de 1 km antigos precisam ser"
+                    " refeitos com o regrid_1km.py atual (grade ancorada em múltiplos da resolução)."
+                )
+            self.windows.append(Window(round(col), round(row), src.width, src.height))
+
+
+class BoundsIndex:
+    """Fontes que tocam cada tile da saída, na ordem do mosaico.
+
+    Cada fonte é registrada só nos tiles cobertos pela sua janela, então consultar um
+    tile custa o número de fontes nele, não o total de fontes.
+    """
+
+    def __init__(self, windows: list[Window], block_size: int) -> None:
+        self.block_size = block_size
+        self.tiles: dict[tuple[int, int], list[int]] = {}
+        for index, window in enumerate(windows):
+            first_row, first_col = window.row_off // block_size, window.col_off // block_size
+            last_row = (window.row_off + window.height - 1) // block_size
+            last_col = (window.col_off + window.width - 1) // block_size
+            for tile_row in range(first_row, last_row + 1):
+                for tile_col in range(first_col, last_col + 1):
+                    self.tiles.setdefault((tile_row, tile_col), []).append(index)
+
+    def sources(self, tile_row: int, tile_col: int) -> list[int]:
+        return self.tiles.get((tile_row, tile_col), [])
+
+
+def apply_predictor(tile: np.ndarray) -> np.ndarray:
+    """Bytes do tile (little-endian) com o preditor TIFF aplicado linha a linha.
+
+    Float (preditor 3): os bytes de cada linha são separados em planos, do mais para o
+    menos significativo, e diferenciados byte a byte. Inteiros (preditor 2): diferença
+    horizontal entre amostras vizinhas, com estouro modular.
+    """
+    tile = np.ascontiguousarray(tile, dtype=tile.dtype.newbyteorder("<"))
+    rows, cols = tile.shape
+    if tile.dtype.kind == "f":
+        planes = tile.view(np.uint8).reshape(rows, cols, tile.itemsize)[:, :, ::-1]
+        planes = np.ascontiguousarray(planes.transpose(0, 2, 1)).reshape(rows, cols * tile.itemsize)
+        planes[:, 1:] = np.diff(planes, axis=1)
+        return planes
+    unsigned = tile.view(tile.dtype.str.replace("i", "u"))
+    diffs = unsigned.copy()
+    diffs[:, 1:] = np.diff(unsigned, axis=1)
+    return diffs
+
+
+def mosaic_nodata(dtype: np.dtype, requested: float | None, source_nodata: list[float | None]) -> float | int:
+    """NoData da saída: o pedido, ou -9999 para float e o NoData comum das fontes inteiras."""
+    if requested is None:
+        if dtype.kind == "f":
+            return MOSAIC_NODATA
+        declared = {value for value in source_nodata if value is not None}
+        if len(declared) != 1:
+            raise SystemExit("Fontes inteiras sem um NoData comum; informe --nodata.")
+        requested = declared.pop()
+    if dtype.kind == "f":
+        return requested
+    limits = np.iinfo(dtype)
+    if requested != round(requested) or not limits.min <= requested <= limits.max:
+        raise SystemExit(f"--nodata {requested:g} não cabe em {dtype.name} ({limits.min} a {limits.max}).")
+    return int(requested)
+
+
+class MosaicWriter:
+    """Lê, mescla e comprime os tiles em paralelo; a gravação segue a ordem dos tiles."""
+
+    def __init__(
+        self,
+        paths: list[Path],
+        nodata: float | None = None,
+        block_size: int = MOSAIC_BLOCK_SIZE,
+        zlevel: int = DEFAULT_ZLEVEL,
+        bigtiff: bool = False,
+    ) -> None:
+        if block_size % 16:
+            raise SystemExit("--block-size precisa ser múltiplo de 16 (exigência do TIFF).")
+        self.paths = paths
+        self.block_size = block_size
+        self.zlevel = zlevel
+        self.bigtiff = bigtiff
+        sources = [rasterio.open(path) for path in paths]
+        try:
+            self.grid = UnionGrid(sources)
+            self.dtype = np.result_type(*(src.dtypes[0] for src in sources))
+            self.source_nodata = [src.nodata for src in sources]
+            encodings = {(src.scales[0], src.offsets[0]) for src in sources}
+        finally:
+            for src in sources:
+                src.close()
+        if len(encodings) != 1:
+            raise SystemExit("Fontes com scale/offset diferentes; não dá para mosaicar sem reescalar.")
+        self.scale, self.offset = encodings.pop()
+        self.nodata = mosaic_nodata(self.dtype, nodata, self.source_nodata)
+        self.index = BoundsIndex(self.grid.windows, block_size)
+        self.tiles_across = math.ceil(self.grid.width / block_size)
+        self.tiles_down = math.ceil(self.grid.height / block_size)
+        # Datasets do GDAL não são seguros entre threads: cada thread abre os seus.
+        self.local = threading.local()
+        self.opened: list[rasterio.io.DatasetReader] = []
+        self.opened_lock = threading.Lock()
+
+    def profile(self) -> dict:
+        uncompressed = self.tiles_across * self.tiles_down * self.block_size**2 * self.dtype.itemsize
+        return {
+            "driver": "GTiff",
+            "dtype": self.dtype.name,
+            "count": 1,
+            "height": self.grid.height,
+            "width": self.grid.width,
+            "transform": self.grid.transform,
+            "crs": self.grid.crs,
+            "nodata": self.nodata,
+            "compress": "deflate",
+            "predictor": 3 if self.dtype.kind == "f" else 2,
+            "tiled": True,
+            "blockxsize": self.block_size,
+            "blockysize": self.block_size,
+            "sparse_ok": True,
+            "endianness": "little",
+            "bigtiff": "YES" if self.bigtiff or uncompressed > CLASSIC_TIFF_LIMIT else "NO",
+        }
+
+    def _sources(self) -> list[rasterio.io.DatasetReader]:
+        sources = getattr(self.local, "sources", None)
+        if sources is None:
+            sources = [rasterio.open(path) for path in self.paths]
+            self.local.sources = sources
+            with self.opened_lock:
+                self.opened.extend(sources)
+        return sources
+
+    def merge_tile(self, tile_row: int, tile_col: int) -> np.ndarray | None:
+        """Tile cheio (block_size²) com as fontes mescladas; None se ficar todo NoData."""
+        indices = self.index.sources(tile_row, tile_col)
+        if not indices:
+            return None
+        row0, col0 = tile_row * self.block_size, tile_col * self.block_size
+        tile = np.full((self.block_size, self.block_size), self.nodata, dtype=self.dtype)
+        sources = self._sources()
+        written = False
+        for index in indices:
+            window = self.grid.windows[index]
+            top, left = max(row0, window.row_off), max(col0, window.col_off)
+            bottom = min(row0 + self.block_size, window.row_off + window.height)
+            right = min(col0 + self.block_size, window.col_off + window.width)
+            data = sources[index].read(
+                1, window=Window(left - window.col_off, top - window.row_off, right - left, bottom - top)
+            )
+            valid = data != self.nodata
+            if self.source_nodata[index] is not None and not np.isnan(self.source_nodata[index]):
+                valid &= data != self.source_nodata[index]
+            if data.dtype.kind == "f":
+                valid &= ~np.isnan(data)
+            if valid.any():
+                np.copyto(tile[top - row0 : bottom - row0, left - col0 : right - col0], data, where=valid)
+                written = True
+        return tile if written else None
+
+    def encode_tile(self, position: int) -> bytes:
+        tile = self.merge_tile(*divmod(position, self.tiles_across))
+        if tile is None:
+            return b""
+        return zlib.compress(apply_predictor(tile).tobytes(), self.zlevel)
+
+    def write(self, out_path: Path, workers: int) -> dict:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        if out_path.exists():
+            out_path.unlink()
+        with rasterio.open(out_path, "w", **self.profile()) as dst:
+            if self.scale != 1.0 or self.offset != 0.0:
+                dst.scales = (self.scale,)
+                dst.offsets = (self.offset,)
+
+        count = self.tiles_across * self.tiles_down
+        offsets, sizes = [0] * count, [0] * count
+        with out_path.open("r+b") as handle:
+            arrays = tiff_tile_arrays(handle)
+            offsets_format, tile_count, offsets_position = arrays[TILE_OFFSETS]
+            sizes_format, _, sizes_position = arrays[TILE_BYTE_COUNTS]
+            if tile_count != count:
+                raise ValueError(f"{out_path}: {tile_count} tiles no IFD, {count} esperados.")
+            limit = 2**32 if offsets_format[1] == "I" else 2**64
+            handle.seek(0, os.SEEK_END)
+
+            workers = max(1, workers)
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    pending = deque()
+                    for position in range(count):
+                        pending.append((position, pool.submit(self.encode_tile, position)))
+                        if len(pending) < workers * TILES_IN_FLIGHT_PER_WORKER:
+                            continue
+                        self._append(handle, pending.popleft(), offsets, sizes, limit)
+                    while pending:
+                        self._append(handle, pending.popleft(), offsets, sizes, limit)
+            finally:
+                for src in self.opened:
+                    src.close()
+                self.opened.clear()
+
+            handle.seek(offsets_position)
+            handle.write(struct.pack(offsets_format[0] + offsets_format[1] * count, *offsets))
+            handle.seek(sizes_position)
+            handle.write(struct.pack(sizes_format[0] + sizes_format[1] * count, *sizes))
+        return {"tiles": count, "written": sum(1 for size in sizes if size), "bytes": sum(sizes)}
+
+    @staticmethod
+    def _append(handle, job, offsets: list[int], sizes: list[int], limit: int) -> None:
+        position, future = job
+        data = future.result()
+        if not data:
+            return
+        offset = handle.tell()
+        if offset + len(data) >= limit:
+            raise ValueError(f"{handle.name}: passou do limite do TIFF clássico; use --bigtiff.")
+        handle.write(data)
+        offsets[position], sizes[position] = offset, len(data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Mosaica rasters alinhados (ex.: recortes por UF) num GeoTIFF tileado com deflate + preditor."
+    )
+    parser.add_argument(
+        "--in",
+        dest="inputs",
+        nargs="+",
+        type=Path,
+        required=True,
+        help="Fontes na ordem do mosaico (a última prevalece onde houver sobreposição).",
+    )
+    parser.add_argument("--out", type=Path, required=True, help="GeoTIFF de saída.")
+    parser.add_argument(
+        "--nodata",
+        type=float,
+        default=None,
+        help=(
+            "NoData das fontes e da saída (o NoData declarado em cada fonte também é ignorado)."
+            f" Padrão: {MOSAIC_NODATA:g} para float; para inteiros, o NoData das fontes."
+        ),
+    )
+    parser.add_argument("--block-size", type=int, default=MOSAIC_BLOCK_SIZE, help="Lado do tile da saída (múltiplo de 16).")
+    parser.add_argument("--zlevel", type=int, default=DEFAULT_ZLEVEL, help="Nível do deflate (1 a 9).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Threads de leitura/compressão.")
+    parser.add_argument("--bigtiff", action="store_true", help="Força BigTIFF (padrão: só se a saída sem compressão passar de ~4 GB).")
+    args = parser.parse_args()
+
+    missing = [path for path in args.inputs if not path.exists()]
+    if missing:
+        raise SystemExit(f"Erro: arquivo {missing[0]} não encontrado.")
+    writer = MosaicWriter(args.inputs, args.nodata, args.block_size, args.zlevel, args.bigtiff)
+    grid = writer.grid
+    print(
+        f"Mosaico {grid.width}x{grid.height} px, {writer.tiles_across * writer.tiles_down} tiles de"
+        f" {args.block_size}px, {len(args.inputs)} fontes, {max(1, args.workers)} threads."
+    )
+    start = time.perf_counter()
+    result = writer.write(args.out, args.workers)
+    print(
+        f"Gravado {args.out} em {time.perf_counter() - start:.1f}s: {result['written']}/{result['tiles']} tiles"
+        f" com dados, {result['bytes'] / 1024**2:.1f} MB comprimidos."
+    )
+
+
+if __name__ == "__main__":
+    main()
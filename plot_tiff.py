@@ -1,15 +1,31 @@
-"""Visualiza rapidamente um TIFF (inteiro ou recortado) sem estourar a RAM."""
+"""Visualiza rapidamente um TIFF (inteiro ou recortado) sem estourar a RAM.
 
+A prévia é lida já na resolução da figura (`out_shape`; o GDAL usa as overviews
+internas quando existem) e o stretch vem de estatísticas calculadas bloco a bloco,
+guardadas em `<tif>.stats.json` para as próximas prévias (outro colormap, outro DPI).
+"""
+
+import json
+import math
 from pathlib import Path
 from typing import Iterable
 
 import matplotlib.pyplot as plt
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
 from rasterio.errors import CRSError
 from rasterio.windows import Window, bounds as window_bounds, from_bounds
 from rasterio.warp import transform_bounds
 
+FIGSIZE = (7, 5)
+DEFAULT_DPI = 150
+STATS_SUFFIX = ".stats.json"
+# Histograma entre min e max para os percentis: erro <= (max - min) / STATS_BINS.
+STATS_BINS = 4096
+# Pixels por faixa lida no cálculo das estatísticas (float64: ~32 MB).
+STATS_BAND_PIXELS = 1 << 22
+
 
 def build_output_path(raster_path: Path, suffix: str) -> Path:
     return raster_path.with_name(f"{raster_path.stem}_{suffix}.png")
@@ -47,6 +63,171 @@ def compute_window(src: rasterio.io.DatasetReader, bbox_wgs84: Iterable[float] |
     return window, (left, right, bottom, top)
 
 
+def preview_shape(height: int, width: int, dpi: int) -> tuple[int, int, int]:
+    """(linhas, colunas, fator) da leitura: no máximo um pixel lido por pixel da figura."""
+    max_cols, max_rows = FIGSIZE[0] * dpi, FIGSIZE[1] * dpi
+    factor = max(1, math.ceil(max(height / max_rows, width / max_cols)))
+    return math.ceil(height / factor), math.ceil(width / factor), factor
+
+
+def read_preview(
+    src: rasterio.io.DatasetReader,
+    band: int,
+    window: Window | None,
+    dpi: int,
+) -> np.ndarray:
+    """Banda (ou janela) decimada para a figura, em float32 com NaN fora dos válidos."""
+    window = window or Window(0, 0, src.width, src.height)
+    rows, cols, factor = preview_shape(int(window.height), int(window.width), dpi)
+    overviews = [level for level in src.overviews(band) if level <= factor]
+    source = f"overview 1/{max(overviews)}" if overviews else "resolução cheia"
+    print(f"Prévia {rows}x{cols} px (1 a cada {factor} px, lida da {source}).")
+    arr = src.read(band, window=window, out_shape=(rows, cols), resampling=Resampling.nearest, masked=True)
+    return arr.astype("float32").filled(np.nan)
+
+
+class BandStatistics:
+    """Min/max e histograma de uma banda (ou janela), acumulados faixa a faixa.
+
+    O histograma só serve aos percentis: sem `--percentiles` fica None e o cálculo
+    custa uma única leitura da banda.
+    """
+
+    def __init__(self, minimum: float, maximum: float, histogram: list[int] | None, count: int) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.histogram = histogram
+        self.count = count
+
+    @staticmethod
+    def iter_bands(src: rasterio.io.DatasetReader, band: int, window: Window) -> Iterable[np.ndarray]:
+        """Valores válidos (float64) de faixas alinhadas aos blocos do arquivo."""
+        block_rows = src.block_shapes[band - 1][0] or 1
+        rows = max(block_rows, STATS_BAND_PIXELS // max(int(window.width), 1) // block_rows * block_rows)
+        row_end = int(window.row_off + window.height)
+        for row_off in range(int(window.row_off), row_end, rows):
+            part = Window(window.col_off, row_off, window.width, min(rows, row_end - row_off))
+            values = src.read(band, window=part, masked=True).astype("float64").compressed()
+            yield values[np.isfinite(values)]
+
+    @classmethod
+    def compute(
+        cls,
+        src: rasterio.io.DatasetReader,
+        band: int,
+        window: Window,
+        histogram: bool = False,
+    ) -> "BandStatistics":
+        """Uma passada com RAM limitada para min/max; o histograma, se pedido, custa outra."""
+        minimum, maximum, count = math.inf, -math.inf, 0
+        for values in cls.iter_bands(src, band, window):
+            if values.size:
+                minimum = min(minimum, float(values.min()))
+                maximum = max(maximum, float(values.max()))
+                count += values.size
+        if minimum > maximum:
+            return cls(math.nan, math.nan, [], 0)
+        stats = cls(minimum, maximum, None, count)
+        return stats.with_histogram(src, band, window) if histogram else stats
+
+    def with_histogram(self, src: rasterio.io.DatasetReader, band: int, window: Window) -> "BandStatistics":
+        """Histograma entre o min/max já conhecidos (ex.: do cache), numa passada."""
+        if self.histogram is not None:
+            return self
+        histogram = np.zeros(STATS_BINS, dtype=np.int64)
+        upper = self.maximum if self.maximum > self.minimum else self.minimum + 1.0
+        for values in self.iter_bands(src, band, window):
+            histogram += np.histogram(values, bins=STATS_BINS, range=(self.minimum, upper))[0]
+        return BandStatistics(self.minimum, self.maximum, histogram.tolist(), int(histogram.sum()))
+
+    def percentile(self, q: float) -> float:
+        """Percentil interpolado dentro do bin do histograma."""
+        if q <= 0 or self.maximum == self.minimum:
+            return self.minimum
+        if q >= 100:
+            return self.maximum
+        cumulative = np.cumsum(self.histogram)
+        target = q / 100 * self.count
+        index = int(np.searchsorted(cumulative, target))
+        before = cumulative[index - 1] if index else 0
+        fraction = (target - before) / max(self.histogram[index], 1)
+        width = (self.maximum - self.minimum) / STATS_BINS
+        return self.minimum + (index + fraction) * width
+
+    def to_dict(self) -> dict:
+        return {"min": self.minimum, "max": self.maximum, "histogram": self.histogram, "count": self.count}
+
+
+def stats_path(raster_path: Path) -> Path:
+    return raster_path.with_name(raster_path.name + STATS_SUFFIX)
+
+
+def raster_signature(raster_path: Path) -> str:
+    """Muda sempre que o arquivo é regravado (tamanho + mtime)."""
+    stat = raster_path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_or_compute_stats(
+    src: rasterio.io.DatasetReader,
+    raster_path: Path,
+    band: int,
+    window: Window | None,
+    refresh: bool = False,
+    histogram: bool = False,
+) -> BandStatistics:
+    """Reaproveita `<tif>.stats.json` se o arquivo não mudou; senão calcula e grava.
+
+    Uma entrada sem histograma (prévia anterior sem percentis) ganha o histograma
+    quando ele é pedido, sem refazer o min/max.
+    """
+    window = window or Window(0, 0, src.width, src.height)
+    key = f"{band}:{int(window.col_off)},{int(window.row_off)},{int(window.width)},{int(window.height)}"
+    sidecar = stats_path(raster_path)
+    signature = raster_signature(raster_path)
+    cache = {}
+    if sidecar.exists():
+        try:
+            cache = json.loads(sidecar.read_text())
+        except ValueError:
+            cache = {}
+        if cache.get("signature") != signature:
+            cache = {}
+    entry = cache.get("bands", {}).get(key)
+    if entry is not None and not refresh:
+        stats = BandStatistics(entry["min"], entry["max"], entry.get("histogram"), entry["count"])
+        if stats.histogram is not None or not histogram:
+            print(f"Estatísticas reaproveitadas de {sidecar}")
+            return stats
+        print(f"Min/max reaproveitados de {sidecar}; calculando o histograma bloco a bloco...")
+        stats = stats.with_histogram(src, band, window)
+    else:
+        print("Calculando estatísticas bloco a bloco...")
+        stats = BandStatistics.compute(src, band, window, histogram)
+    cache = {"signature": signature, "bands": {**cache.get("bands", {}), key: stats.to_dict()}}
+    try:
+        sidecar.write_text(json.dumps(cache))
+    except OSError as exc:
+        print(f"Aviso: não foi possível salvar {sidecar}: {exc}")
+    return stats
+
+
+def stretch_limits(
+    stats: BandStatistics,
+    vmin: float | None,
+    vmax: float | None,
+    percentiles: tuple[float, float] | None,
+) -> tuple[float, float]:
+    if stats.count == 0:
+        return 0.0, 1.0
+    low_q, high_q = percentiles or (0.0, 100.0)
+    low = stats.percentile(low_q) if vmin is None else vmin
+    high = stats.percentile(high_q) if vmax is None else vmax
+    if low == high:
+        high = low + 1.0
+    return low, high
+
+
 def plot_preview(
     file: Path,
     band: int,
@@ -56,15 +237,26 @@ def plot_preview(
     out: Path | None,
     bbox: Iterable[float] | None,
     colorbar_label: str,
+    dpi: int = DEFAULT_DPI,
+    percentiles: tuple[float, float] | None = None,
+    approx_stats: bool = False,
+    refresh_stats: bool = False,
 ) -> None:
     with rasterio.open(file) as src:
         window, extent = compute_window(src, bbox)
-        arr = src.read(band, window=window, masked=True).astype("float32")
-        filled = arr.filled(np.nan)
-        auto_vmin, auto_vmax = compute_limits(filled, vmin, vmax)
+        filled = read_preview(src, band, window, dpi)
+        if (vmin is not None and vmax is not None) or (approx_stats and percentiles is None):
+            auto_vmin, auto_vmax = compute_limits(filled, vmin, vmax)
+        elif approx_stats:
+            valid = filled[np.isfinite(filled)]
+            low, high = np.percentile(valid, percentiles) if valid.size else (0.0, 1.0)
+            auto_vmin, auto_vmax = compute_limits(np.array([low, high]), vmin, vmax)
+        else:
+            stats = load_or_compute_stats(src, file, band, window, refresh_stats, percentiles is not None)
+            auto_vmin, auto_vmax = stretch_limits(stats, vmin, vmax, percentiles)
         data = np.ma.masked_invalid(filled)
 
-        fig, ax = plt.subplots(figsize=(7, 5))
+        fig, ax = plt.subplots(figsize=FIGSIZE)
         im = ax.imshow(
             data,
             cmap=cmap,
@@ -79,7 +271,7 @@ def plot_preview(
         fig.colorbar(im, ax=ax, label=colorbar_label)
 
         output_path = out or build_output_path(file, "preview")
-        fig.savefig(output_path, dpi=150, bbox_inches="tight")
+        fig.savefig(output_path, dpi=dpi, bbox_inches="tight")
         plt.close(fig)
 
 
@@ -105,6 +297,29 @@ if __name__ == "__main__":
         default="Pixel value",
         help="Texto do rótulo da barra de cores (ex.: 'Distance (m)').",
     )
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=DEFAULT_DPI,
+        help="DPI do PNG; a leitura é decimada para no máximo um pixel do raster por pixel da figura.",
+    )
+    parser.add_argument(
+        "--percentiles",
+        type=float,
+        nargs=2,
+        metavar=("LOW", "HIGH"),
+        help="Stretch pelos percentis (ex.: 2 98) em vez de min/max.",
+    )
+    parser.add_argument(
+        "--approx-stats",
+        action="store_true",
+        help="Calcula o stretch só nos pixels da prévia decimada (instantâneo, sem cache, aproximado).",
+    )
+    parser.add_argument(
+        "--refresh-stats",
+        action="store_true",
+        help=f"Recalcula as estatísticas mesmo se <tif>{STATS_SUFFIX} estiver válido.",
+    )
     args = parser.parse_args()
 
     plot_preview(
@@ -116,4 +331,8 @@ if __name__ == "__main__":
         args.out,
         args.bbox,
         args.cbar_label,
+        max(1, args.dpi),
+        tuple(args.percentiles) if args.percentiles else None,
+        args.approx_stats,
+        args.refresh_stats,
     )
@@ -4,11 +4,22 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
 import math
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
 from pathlib import Path
 
 import numpy as np
 import rasterio
+from rasterio.windows import Window
+
+from instrumentation import add_metrics_arguments, configure_from_args, metrics
+
+# Manifesto gravado no diretório de destino para pular arquivos já atualizados.
+MANIFEST_NAME = "prep_manifest.json"
+HASH_CHUNK_BYTES = 1 << 20
 
 
 def nodata_is_nan(value: float | int | None) -> bool:
@@ -25,22 +36,210 @@ def to_binary_block(block: np.ndarray, nodata: float | int | None) -> np.ndarray
     return clean
 
 
-def normalize_file(src_path: Path, dst_path: Path) -> None:
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def output_windows(height: int, width: int, layout: str, block_size: int) -> list[Window]:
+    """Blocos da saída (os mesmos de `dst.block_windows` com o `binary_profile`), em ordem."""
+    if layout == "tiled":
+        return [
+            Window(col, row, min(block_size, width - col), min(block_size, height - row))
+            for row in range(0, height, block_size)
+            for col in range(0, width, block_size)
+        ]
+    rows = min(block_size, height)
+    return [Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)]
+
+
+def block_digest(block: np.ndarray) -> bytes:
+    return hashlib.sha256(np.ascontiguousarray(block).tobytes()).digest()
+
+
+def content_sha256(src: rasterio.io.DatasetReader, digests: list[bytes]) -> str:
+    """Hash dos pixels da entrada: cabeçalho (tipo, grade, NoData) + hash de cada bloco, em ordem.
+
+    Sai dos blocos já lidos pela normalização, sem segunda leitura do arquivo.
+    """
+    digest = hashlib.sha256(f"{src.dtypes[0]}:{src.height}x{src.width}:{src.nodata}".encode())
+    for block in digests:
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def source_sha256(src_path: Path, layout: str, block_size: int) -> str:
+    """Mesmo hash do `normalize_file`, só lendo a entrada (para conferir o manifesto)."""
+    with rasterio.open(src_path) as src:
+        windows = output_windows(src.height, src.width, layout, block_size)
+        return content_sha256(src, [block_digest(src.read(1, window=window, masked=False)) for window in windows])
+
+
+def binary_profile(src: rasterio.io.DatasetReader, layout: str, block_size: int) -> dict:
+    """Perfil uint8 sem NoData com o layout de blocos pedido.
+
+    `striped`: faixas de `block_size` linhas inteiras (leitura do `dist_map.py --engine exact`
+    e do modo raster inteiro). `tiled`: blocos `block_size` x `block_size` (motor padded).
+    """
+    profile = src.profile
+    profile.update(dtype="uint8", count=1, nodata=None, compress="deflate", predictor=2)
+    profile.pop("blockxsize", None)
+    profile.pop("blockysize", None)
+    if layout == "tiled":
+        profile.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+    else:
+        profile.update(tiled=False, blockysize=min(block_size, src.height))
+    return profile
+
+
+# Cada processo do pool abre o raster de entrada uma única vez (datasets não são picklable).
+_worker_src: rasterio.io.DatasetReader | None = None
+
+
+def _init_window_worker(src_path: str, instrument: bool = False) -> None:
+    global _worker_src
+    _worker_src = rasterio.open(src_path)
+    if instrument:
+        metrics.configure(buffer=True)
+
+
+def _normalize_window(window: Window, index: int = 0) -> tuple[int, Window, np.ndarray, bytes, list[dict]]:
+    assert _worker_src is not None
+    with metrics.stage("read", block=index):
+        block = _worker_src.read(1, window=window, masked=False)
+    with metrics.stage("normalize", block=index):
+        digest = block_digest(block)
+        block = to_binary_block(block, _worker_src.nodata)
+    return index, window, block, digest, metrics.drain()
+
+
+def _write_window(dst: rasterio.io.DatasetWriter, future: Future, digests: list[bytes]) -> None:
+    index, window, block, digest, records = future.result()
+    metrics.absorb(records)
+    digests[index] = digest
+    with metrics.stage("write", block=index):
+        dst.write(block, 1, window=window)
+
+
+def normalize_file(
+    src_path: Path,
+    dst_path: Path,
+    layout: str = "striped",
+    block_size: int = 256,
+    workers: int = 1,
+) -> str:
+    """Normaliza `src_path` e devolve o hash do conteúdo da entrada (ver `content_sha256`)."""
     dst_path.parent.mkdir(parents=True, exist_ok=True)
 
     with rasterio.open(src_path) as src:
-        profile = src.profile
-        profile.update(dtype="uint8", count=1, nodata=None, compress="deflate", predictor=2)
-        profile.pop("blockxsize", None)
-        profile.pop("blockysize", None)
+        profile = binary_profile(src, layout, block_size)
 
         nodata = src.nodata
         print(f"Normalizando {src_path.name} (NoData={nodata}) -> {dst_path}")
 
-        with rasterio.open(dst_path, "w", **profile) as dst:
-            for _, window in src.block_windows(1):
-                block = src.read(1, window=window, masked=False)
-                dst.write(to_binary_block(block, nodata), 1, window=window)
+        dst = rasterio.open(dst_path, "w", **profile)
+        try:
+            # Janelas alinhadas aos blocos da saída: cada bloco é comprimido uma única vez.
+            windows = output_windows(src.height, src.width, layout, block_size)
+            digests: list[bytes] = [b""] * len(windows)
+            if workers <= 1:
+                with metrics.hot_loop("normalize_file"):
+                    for index, window in enumerate(windows):
+                        with metrics.stage("read", block=index):
+                            block = src.read(1, window=window, masked=False)
+                        with metrics.stage("normalize", block=index):
+                            digests[index] = block_digest(block)
+                            block = to_binary_block(block, nodata)
+                        with metrics.stage("write", block=index):
+                            dst.write(block, 1, window=window)
+                return content_sha256(src, digests)
+
+            max_in_flight = 2 * workers
+            with metrics.hot_loop("normalize_file"), ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_window_worker,
+                initargs=(str(src_path), metrics.enabled),
+            ) as pool:
+                pending: set[Future] = set()
+                for index, window in enumerate(windows):
+                    pending.add(pool.submit(_normalize_window, window, index))
+                    if len(pending) < max_in_flight:
+                        continue
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _write_window(dst, future, digests)
+                for future in as_completed(pending):
+                    _write_window(dst, future, digests)
+            return content_sha256(src, digests)
+        finally:
+            # Fechar descarrega os blocos pendentes (compressão final).
+            with metrics.stage("close", path=dst_path.name):
+                dst.close()
+
+
+def _normalize_task(
+    src_path: Path,
+    dst_path: Path,
+    layout: str,
+    block_size: int,
+    instrument: bool = False,
+) -> tuple[str, list[dict]]:
+    if instrument:
+        metrics.configure(buffer=True)
+    sha256 = normalize_file(src_path, dst_path, layout, block_size)
+    return sha256, metrics.drain()
+
+
+class Manifest:
+    """Registro por arquivo de tamanho, mtime e SHA-256 da entrada + layout da saída.
+
+    Tamanho/mtime iguais bastam para considerar a saída atualizada; se mudarem, o hash
+    decide (um `touch` ou uma cópia idêntica não reprocessa o arquivo). O hash é o dos
+    pixels (`content_sha256`), calculado na própria leitura da normalização; só essa
+    conferência relê a entrada.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        if path.exists():
+            try:
+                self.entries = json.loads(path.read_text())
+            except (json.JSONDecodeError, OSError) as exc:
+                print(f"Aviso: {path} ilegível ({exc}); todos os arquivos serão reprocessados.")
+
+    def is_up_to_date(self, src_path: Path, dst_path: Path, layout: str, block_size: int) -> bool:
+        entry = self.entries.get(src_path.name)
+        if entry is None or not dst_path.exists():
+            return False
+        if entry.get("layout") != layout or entry.get("block_size") != block_size:
+            return False
+        stat = src_path.stat()
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+        if entry["size"] != stat.st_size or entry["sha256"] != source_sha256(src_path, layout, block_size):
+            return False
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def record(self, src_path: Path, sha256: str, layout: str, block_size: int) -> None:
+        stat = src_path.stat()
+        self.entries[src_path.name] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+            "layout": layout,
+            "block_size": block_size,
+        }
+
+    def save(self) -> None:
+        """Grava num temporário e troca de uma vez: uma interrupção não deixa o manifesto pela metade."""
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.entries, indent=2, sort_keys=True))
+        os.replace(tmp_path, self.path)
 
 
 def main() -> None:
@@ -57,19 +256,74 @@ def main() -> None:
         default="00_inputs_binary_ready",
         help="Diretório onde os TIFFs binários limpos serão gravados.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processos paralelos: um arquivo por processo ou, se só um precisar de atualização, janelas dele.",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=("striped", "tiled"),
+        default="striped",
+        help="striped: faixas de linhas (dist_map.py --engine exact/raster inteiro). tiled: blocos quadrados (padded).",
+    )
+    parser.add_argument(
+        "--block-size",
+        dest="block_size",
+        type=int,
+        default=256,
+        help="Linhas por faixa (striped) ou lado do bloco (tiled, múltiplo de 16).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=f"Ignora o {MANIFEST_NAME} e regrava todas as saídas.",
+    )
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    configure_from_args(args)
 
     src_dir = Path(args.source_dir)
     dst_dir = Path(args.dest_dir)
     if not src_dir.exists():
         raise SystemExit(f"Diretório fonte {src_dir} não existe.")
+    if args.layout == "tiled" and args.block_size % 16:
+        raise SystemExit("--block-size precisa ser múltiplo de 16 no layout tiled.")
 
     tiffs = sorted(src_dir.glob("*.tif"))
     if not tiffs:
         raise SystemExit(f"Nenhum TIFF encontrado em {src_dir}")
 
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(dst_dir / MANIFEST_NAME)
+    pending = []
     for tif in tiffs:
-        normalize_file(tif, dst_dir / tif.name)
+        if not args.force and manifest.is_up_to_date(tif, dst_dir / tif.name, args.layout, args.block_size):
+            print(f"{tif.name} já está atualizado. Pulando...")
+        else:
+            pending.append(tif)
+
+    workers = max(1, args.workers)
+    if len(pending) <= 1 or workers == 1:
+        for tif in pending:
+            sha256 = normalize_file(tif, dst_dir / tif.name, args.layout, args.block_size, workers)
+            manifest.record(tif, sha256, args.layout, args.block_size)
+            manifest.save()
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+            futures = {
+                pool.submit(_normalize_task, tif, dst_dir / tif.name, args.layout, args.block_size, metrics.enabled): tif
+                for tif in pending
+            }
+            for future in as_completed(futures):
+                tif = futures[future]
+                sha256, records = future.result()
+                metrics.absorb(records)
+                manifest.record(tif, sha256, args.layout, args.block_size)
+                manifest.save()
+    manifest.save()
+    metrics.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""Reamostra um raster de distâncias para 1 km agregando blocos (min/média/mediana/máx).
+
+Substitui o `gdalwarp -r near -tr 1000 1000`, que amostra um único pixel por célula:
+cada pixel de origem entra na célula de destino que contém o seu centro e a célula
+recebe a estatística de todos os pixels válidos dela. O raster é lido uma vez, em
+faixas de linhas, e todas as estatísticas pedidas saem dessa mesma leitura. A grade
+de destino é ancorada em múltiplos da resolução (como o `-tap`), então as saídas de
+UFs diferentes ficam alinhadas entre si.
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import warnings
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from dist_map import ProgressPrinter
+from prep_binary_inputs import nodata_is_nan
+
+STATISTICS = ("min", "mean", "median", "max")
+DEFAULT_RESOLUTION = 1000.0
+# Mesmo NoData das etapas com gdalwarp (run_clip_masks.sh / run_mosaics_1km.sh).
+REGRID_NODATA = -9999.0
+# Pixels de origem lidos por faixa (float32), antes do agrupamento por célula.
+DEFAULT_CHUNK_PIXELS = 16 * 1024 * 1024
+
+
+def grid_anchor(transform: Affine, resolution: float) -> tuple[float, float, float, float]:
+    """Origem da grade de destino em múltiplos inteiros de `resolution` (o `-tap` do gdalwarp).
+
+    Devolve (esquerda, topo, deslocamento em x, deslocamento em y): os deslocamentos são
+    a distância, em unidades do CRS, da origem da grade de destino até a da origem.
+    Recortes de UFs diferentes caem assim na mesma grade de 1 km e podem ser mosaicados.
+    """
+    # A tolerância evita uma célula a mais quando a origem já é múltipla, a menos de arredondamento.
+    left = math.floor(transform.c / resolution + 1e-9) * resolution
+    top = math.ceil(transform.f / resolution - 1e-9) * resolution
+    return left, top, transform.c - left, top - transform.f
+
+
+def cell_ids(start: int, pixels: int, pixel_size: float, resolution: float, shift: float = 0.0) -> np.ndarray:
+    return np.floor(((np.arange(start, start + pixels) + 0.5) * pixel_size + shift) / resolution).astype(np.int64)
+
+
+def cell_groups(pixels: int, pixel_size: float, resolution: float, shift: float = 0.0) -> np.ndarray:
+    """Índices dos pixels de cada célula, completados com -1 até a maior célula.
+
+    Um pixel pertence à célula que contém o seu centro; com 30 m e 1 km as células
+    alternam entre 33 e 34 pixels, daí o preenchimento. `shift` é o deslocamento do
+    primeiro pixel em relação à grade de destino (ver `grid_anchor`).
+    """
+    cells = cell_ids(0, pixels, pixel_size, resolution, shift)
+    counts = np.bincount(cells)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    offsets = np.arange(counts.max())
+    index = starts[:, None] + offsets
+    index[offsets >= counts[:, None]] = -1
+    return index
+
+
+def regrid_profile(src: rasterio.io.DatasetReader, resolution: float, height: int, width: int) -> dict:
+    left, top, _, _ = grid_anchor(src.transform, resolution)
+    profile = src.profile
+    profile.update(
+        driver="GTiff",
+        dtype="float32",
+        count=1,
+        height=height,
+        width=width,
+        transform=Affine(resolution, 0.0, left, 0.0, -resolution, top),
+        nodata=REGRID_NODATA,
+        compress="deflate",
+        predictor=3,
+        tiled=False,
+    )
+    for key in ("blockxsize", "blockysize", "interleave", "zstd_level", "max_z_error"):
+        profile.pop(key, None)
+    profile["crs"] = src.crs
+    return profile
+
+
+def read_values(src: rasterio.io.DatasetReader, window: Window) -> np.ndarray:
+    """Faixa em float32 com NaN nos NoData e scale/offset aplicados (saída quantizada)."""
+    block = src.read(1, window=window, masked=False)
+    values = block.astype(np.float32)
+    nodata = src.nodata
+    if nodata is not None and not nodata_is_nan(nodata):
+        values[block == nodata] = np.nan
+    scale, offset = src.scales[0], src.offsets[0]
+    if scale != 1.0 or offset != 0.0:
+        values = values * np.float32(scale) + np.float32(offset)
+    return values
+
+
+def reduce_cells(cells: np.ndarray, stats: list[str]) -> dict[str, np.ndarray]:
+    """Estatísticas por célula ignorando NaN; células sem pixel válido viram NoData.
+
+    `cells` tem formato (linhas, colunas, pixels por célula).
+    """
+    valid = np.isfinite(cells)
+    count = valid.sum(axis=2)
+    empty = count == 0
+    results = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for stat in stats:
+            if stat == "mean":
+                values = np.where(valid, cells, 0).sum(axis=2, dtype=np.float64) / np.maximum(count, 1)
+            elif stat == "min":
+                values = np.nanmin(cells, axis=2)
+            elif stat == "max":
+                values = np.nanmax(cells, axis=2)
+            else:
+                values = np.nanmedian(cells, axis=2)
+            values = values.astype(np.float32)
+            values[empty] = REGRID_NODATA
+            results[stat] = values
+    return results
+
+
+# Estatísticas que dá para acumular bloco a bloco, em qualquer ordem (a mediana não dá).
+STREAMING_STATISTICS = ("min", "mean", "max")
+
+
+class CellAccumulator:
+    """Min/soma/contagem/máx por célula de `resolution`, alimentados por blocos avulsos.
+
+    Versão incremental do `regrid`: quem já tem os blocos em memória (ex.: o pipeline
+    em fluxo) agrega sem reler o raster. As células seguem a mesma regra do centro
+    do pixel, então o resultado coincide com o `regrid` do raster final.
+    """
+
+    def __init__(self, height: int, width: int, transform: Affine, resolution: float) -> None:
+        self.px, self.py, self.resolution = abs(transform.a), abs(transform.e), resolution
+        _, _, self.shift_x, self.shift_y = grid_anchor(transform, resolution)
+        self.shape = (
+            int(cell_ids(height - 1, 1, self.py, resolution, self.shift_y)[0]) + 1,
+            int(cell_ids(width - 1, 1, self.px, resolution, self.shift_x)[0]) + 1,
+        )
+        self.total = np.zeros(self.shape, dtype=np.float64)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.low = np.full(self.shape, np.inf, dtype=np.float32)
+        self.high = np.full(self.shape, -np.inf, dtype=np.float32)
+
+    def add(self, values: np.ndarray, window: Window) -> None:
+        """`values` em float (NaN = NoData) na janela `window` da grade de origem."""
+        rows = cell_ids(window.row_off, window.height, self.py, self.resolution, self.shift_y)
+        cols = cell_ids(window.col_off, window.width, self.px, self.resolution, self.shift_x)
+        # Células são faixas contíguas de pixels: reduceat nos dois eixos resolve tudo.
+        row_starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        col_starts = np.flatnonzero(np.diff(cols, prepend=-1))
+        target = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+        def reduce(ufunc: np.ufunc, array: np.ndarray) -> np.ndarray:
+            return ufunc.reduceat(ufunc.reduceat(array, row_starts, axis=0), col_starts, axis=1)
+
+        valid = np.isfinite(values)
+        self.count[target] += reduce(np.add, valid.astype(np.int64))
+        self.total[target] += reduce(np.add, np.where(valid, values, 0).astype(np.float64))
+        np.minimum(self.low[target], reduce(np.minimum, np.where(valid, values, np.inf)), out=self.low[target])
+        np.maximum(self.high[target], reduce(np.maximum, np.where(valid, values, -np.inf)), out=self.high[target])
+
+    def result(self, stat: str) -> np.ndarray:
+        if stat == "mean":
+            values = (self.total / np.maximum(self.count, 1)).astype(np.float32)
+        elif stat == "min":
+            values = self.low.copy()
+        elif stat == "max":
+            values = self.high.copy()
+        else:
+            raise ValueError(f"Estatística {stat} não pode ser acumulada em fluxo.")
+        values[self.count == 0] = REGRID_NODATA
+        return values
+
+
+def stat_output_path(out_path: Path, stat: str, stats: list[str]) -> Path:
+    if len(stats) == 1:
+        return out_path
+    return out_path.with_name(f"{out_path.stem}_{stat}{out_path.suffix}")
+
+
+def regrid(
+    in_path: Path,
+    out_path: Path,
+    stats: list[str],
+    resolution: float = DEFAULT_RESOLUTION,
+    chunk_pixels: int = DEFAULT_CHUNK_PIXELS,
+) -> None:
+    with rasterio.open(in_path) as src:
+        px, py = abs(src.transform.a), abs(src.transform.e)
+        if resolution < max(px, py):
+            raise SystemExit(f"Resolução {resolution} menor que o pixel de origem ({px} x {py}).")
+        _, _, shift_x, shift_y = grid_anchor(src.transform, resolution)
+        row_groups = cell_groups(src.height, py, resolution, shift_y)
+        col_groups = cell_groups(src.width, px, resolution, shift_x)
+        height, width = len(row_groups), len(col_groups)
+        profile = regrid_profile(src, resolution, height, width)
+
+        # Faixas com várias linhas de células: uma leitura por faixa, agrupamento vetorizado.
+        rows_per_chunk = max(1, chunk_pixels // (row_groups.shape[1] * src.width))
+        print(
+            f"{in_path.name}: {src.height}x{src.width} px -> {height}x{width} células de {resolution:g} m"
+            f" ({', '.join(stats)})."
+        )
+
+        out_paths = {stat: stat_output_path(out_path, stat, stats) for stat in stats}
+        datasets = {stat: rasterio.open(path, "w", **profile) for stat, path in out_paths.items()}
+        progress = ProgressPrinter("Agregando faixas", math.ceil(height / rows_per_chunk), mode="count")
+        try:
+            for first in range(0, height, rows_per_chunk):
+                rows = row_groups[first:first + rows_per_chunk]
+                row_start = int(rows[0, 0])
+                row_stop = int(rows.max()) + 1
+                window = Window(0, row_start, src.width, row_stop - row_start)
+
+                # Linha e coluna extras de NaN: o índice -1 do preenchimento cai nelas.
+                padded = np.full((window.height + 1, src.width + 1), np.nan, dtype=np.float32)
+                padded[:-1, :-1] = read_values(src, window)
+                local_rows = np.where(rows >= 0, rows - row_start, -1)
+                cells = padded[local_rows[:, :, None, None], col_groups[None, None, :, :]]
+                cells = cells.transpose(0, 2, 1, 3).reshape(len(rows), width, -1)
+
+                chunk_window = Window(0, first, width, len(rows))
+                for stat, values in reduce_cells(cells, stats).items():
+                    datasets[stat].write(values, 1, window=chunk_window)
+                progress.increment()
+            progress.finish()
+        finally:
+            for dst in datasets.values():
+                dst.close()
+
+    for path in out_paths.values():
+        print(f"Gravado {path}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Reamostra rasters de distância para 1 km agregando os pixels de cada célula."
+    )
+    parser.add_argument("--in", dest="in_tif", required=True, help="GeoTIFF de distâncias (ex.: 04_dist_map_masked).")
+    parser.add_argument(
+        "--out",
+        dest="out_tif",
+        required=True,
+        help="GeoTIFF de saída. Com várias --stats, cada uma vira <saída>_<estatística>.tif.",
+    )
+    parser.add_argument(
+        "--stats",
+        nargs="+",
+        choices=STATISTICS,
+        default=["mean"],
+        help="Estatísticas por célula, todas calculadas na mesma leitura (padrão: mean).",
+    )
+    parser.add_argument(
+        "--resolution",
+        type=float,
+        default=DEFAULT_RESOLUTION,
+        help="Tamanho da célula de destino em unidades do CRS (padrão: 1000 m).",
+    )
+    args = parser.parse_args()
+
+    in_path = Path(args.in_tif)
+    if not in_path.exists():
+        raise SystemExit(f"Arquivo não encontrado: {in_path}")
+    out_path = Path(args.out_tif)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    stats = list(dict.fromkeys(args.stats))
+    regrid(in_path, out_path, stats, args.resolution)
+
+
+if __name__ == "__main__":
+    main()
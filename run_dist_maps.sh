@@ -3,8 +3,10 @@ set -euo pipefail
 
 source .venv/bin/activate
 
-INPUT_DIR="00_inputs_binary_ready"
+INPUT_DIR="00_inputs_tiffs"
 OUTPUT_DIR="03_dist_map_tiles"
+# Ex.: MEMORY_BUDGET=8G bash run_dist_maps.sh deixa o dist_map.py dimensionar as faixas pela RAM disponível.
+MEMORY_BUDGET="${MEMORY_BUDGET:-}"
 mkdir -p "${OUTPUT_DIR}"
 
 run_dist() {
@@ -13,12 +15,12 @@ run_dist() {
     local output_path="${OUTPUT_DIR}/${stem}_dist.tif"
 
     if [[ ! -f "${input_path}" ]]; then
-        echo "Aviso: ${input_path} não encontrado. Execute prep_binary_inputs.py antes."
+        echo "Aviso: ${input_path} não encontrado."
         return 1
     fi
 
     python dist_map.py --in "${input_path}" --out "${output_path}" \
-        --tile-size 4096 --tile-padding 1024
+        --raw --engine exact --tile-size 4096 ${MEMORY_BUDGET:+--memory-budget "${MEMORY_BUDGET}"}
 }
 
 run_dist "estradas_rs_final"
@@ -3,12 +3,12 @@ set -euo pipefail
 
 INPUT_DIR="05_dist_map_masked_regridded_1km"
 OUTPUT_DIR="06_dist_map_mosaics"
+WORKERS="${WORKERS:-$(nproc)}"
 mkdir -p "${OUTPUT_DIR}"
 
 build_mosaic() {
     local output_stem="$1"
     shift
-    local vrt_path="${OUTPUT_DIR}/${output_stem}_1km.vrt"
     local tif_path="${OUTPUT_DIR}/${output_stem}_1km.tif"
 
     for src in "$@"; do
@@ -18,11 +18,8 @@ build_mosaic() {
         fi
     done
 
-    echo "Montando VRT ${vrt_path}"
-    gdalbuildvrt -overwrite -srcnodata -9999 -vrtnodata -9999 "${vrt_path}" "$@"
-
-    echo "Convertendo para GeoTIFF ${tif_path}"
-    gdal_translate -of GTiff -co COMPRESS=LZW -a_nodata -9999 "${vrt_path}" "${tif_path}"
+    echo "Mosaicando em ${tif_path}"
+    python mosaic_rasters.py --in "$@" --out "${tif_path}" --workers "${WORKERS}"
 }
 
 build_mosaic "estradas_dist_regiao_sul" \
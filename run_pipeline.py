@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""Executa o fluxo dos run_*.sh como um grafo de tarefas, pulando o que já está atualizado.
+
+A matriz tema × UF, os diretórios e os parâmetros de cada etapa vêm de um único
+arquivo (`pipeline.json`). Cada camada vira uma cadeia de tarefas (distância ->
+recorte -> regrid) e cada tema ganha os mosaicos; camadas independentes rodam ao
+mesmo tempo dentro de um orçamento global de CPUs e RAM (o recorte de estradas_rs
+pode correr junto com a EDT de rios_sc). Uma tarefa é pulada quando as saídas
+existem e nem os comandos nem as entradas mudaram: tamanho/mtime iguais bastam;
+se mudarem, o SHA-256 decide, como no manifesto do prep_binary_inputs.py.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from prep_binary_inputs import file_sha256
+
+STAGES = ("dist", "clip", "regrid", "mosaic", "mosaic_1km")
+STATE_FILE = ".pipeline_state.json"
+SHAPEFILE_SIDECARS = (".shp", ".shx", ".dbf")
+SHAPEFILE_OPTIONAL = (".prj", ".cpg")
+
+
+@dataclass
+class Task:
+    """Uma unidade do grafo: comandos, arquivos lidos/gravados e o quanto reserva do orçamento."""
+
+    name: str
+    stage: str
+    commands: list[list[str]]
+    inputs: list[Path]
+    outputs: list[Path]
+    deps: list[str] = field(default_factory=list)
+    optional_inputs: list[Path] = field(default_factory=list)
+    cpus: int = 1
+    memory_mb: int = 1024
+
+
+def mosaic_command(python: str, out_path: Path, sources: list[Path], stage: dict) -> list[str]:
+    """mosaic_rasters.py com uma thread de compressão por CPU reservada (a última UF prevalece)."""
+    command = [python, "mosaic_rasters.py", "--in", *map(str, sources), "--out", str(out_path)]
+    return command + ["--workers", str(int(stage.get("cpus", 1)))] + list(stage.get("args", []))
+
+
+def build_tasks(config: dict, python: str = sys.executable) -> list[Task]:
+    """Grafo completo na ordem de execução preferida (distâncias primeiro)."""
+    dirs = {key: Path(value) for key, value in config["dirs"].items()}
+    stages = config["stages"]
+
+    def reserve(stage: str) -> dict:
+        return {"cpus": int(stages[stage].get("cpus", 1)), "memory_mb": int(stages[stage].get("memory_mb", 1024))}
+
+    tasks = []
+    for theme in config["themes"]:
+        for state, shapefile in config["states"].items():
+            stem = f"{theme}_{state}_final"
+            dist = dirs["dist"] / f"{stem}_dist.tif"
+            masked = dirs["masked"] / f"{stem}_dist_masked.tif"
+            regridded = dirs["regridded"] / f"{stem}_dist_masked_1km.tif"
+            shape = dirs["masks"] / shapefile
+            shape_files = [shape.with_suffix(suffix) for suffix in SHAPEFILE_SIDECARS]
+            dist_cmd = [python, "dist_map.py", "--in", str(dirs["inputs"] / f"{stem}.tif"), "--out", str(dist)]
+            dist_cmd += list(stages["dist"].get("args", []))
+            # O planejador do dist_map.py dimensiona as faixas para a RAM reservada à tarefa.
+            dist_cmd += ["--memory-budget", f"{reserve('dist')['memory_mb']}M"]
+            tasks += [
+                Task(f"dist:{stem}", "dist", [dist_cmd], [dirs["inputs"] / f"{stem}.tif"], [dist], **reserve("dist")),
+                Task(
+                    f"clip:{stem}",
+                    "clip",
+                    [[python, "clip_with_mask.py", "--in", str(dist), "--shape", str(shape), "--out", str(masked)]
+                     + list(stages["clip"].get("args", []))],
+                    [dist, *shape_files],
+                    [masked],
+                    [f"dist:{stem}"],
+                    [shape.with_suffix(suffix) for suffix in SHAPEFILE_OPTIONAL],
+                    **reserve("clip"),
+                ),
+                Task(
+                    f"regrid:{stem}",
+                    "regrid",
+                    [[python, "regrid_1km.py", "--in", str(masked), "--out", str(regridded)]
+                     + list(stages["regrid"].get("args", []))],
+                    [masked],
+                    [regridded],
+                    [f"clip:{stem}"],
+                    **reserve("regrid"),
+                ),
+            ]
+
+        stems = [f"{theme}_{state}_final" for state in config["states"]]
+        masked = [dirs["masked"] / f"{stem}_dist_masked.tif" for stem in stems]
+        regridded = [dirs["regridded"] / f"{stem}_dist_masked_1km.tif" for stem in stems]
+        mosaic = dirs["mosaics"] / f"{theme}_dist_regiao_sul"
+        tasks += [
+            Task(
+                f"mosaic:{theme}",
+                "mosaic",
+                [mosaic_command(python, mosaic.with_suffix(".tif"), masked, stages["mosaic"])],
+                masked,
+                [mosaic.with_suffix(".tif")],
+                [f"clip:{stem}" for stem in stems],
+                **reserve("mosaic"),
+            ),
+            Task(
+                f"mosaic_1km:{theme}",
+                "mosaic_1km",
+                [mosaic_command(python, mosaic.with_name(mosaic.name + "_1km.tif"), regridded, stages["mosaic_1km"])],
+                regridded,
+                [mosaic.with_name(mosaic.name + "_1km.tif")],
+                [f"regrid:{stem}" for stem in stems],
+                **reserve("mosaic_1km"),
+            ),
+        ]
+    return sorted(tasks, key=lambda task: STAGES.index(task.stage))
+
+
+class PipelineState:
+    """Hashes das entradas e assinatura de cada tarefa concluída (`.pipeline_state.json`)."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        data = json.loads(path.read_text()) if path.exists() else {}
+        self.files: dict[str, dict] = data.get("files", {})
+        self.tasks: dict[str, dict] = data.get("tasks", {})
+
+    def file_hash(self, path: Path) -> str:
+        """SHA-256 reaproveitado enquanto tamanho e mtime não mudarem."""
+        stat = path.stat()
+        entry = self.files.get(str(path))
+        if entry is not None and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            return entry["sha256"]
+        digest = file_sha256(path)
+        self.files[str(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def fingerprint(self, task: Task) -> str:
+        paths = task.inputs + [path for path in task.optional_inputs if path.exists()]
+        inputs = [[str(path), self.file_hash(path)] for path in paths]
+        payload = json.dumps({"commands": task.commands, "inputs": inputs}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def output_stamps(task: Task) -> dict[str, list[int]]:
+        return {str(path): [path.stat().st_size, path.stat().st_mtime_ns] for path in task.outputs}
+
+    def is_up_to_date(self, task: Task, fingerprint: str) -> bool:
+        entry = self.tasks.get(task.name)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return False
+        if not all(path.exists() for path in task.outputs):
+            return False
+        # Saída regravada/apagada por fora também invalida a tarefa.
+        return entry["outputs"] == self.output_stamps(task)
+
+    def record(self, task: Task, fingerprint: str) -> None:
+        self.tasks[task.name] = {"fingerprint": fingerprint, "outputs": self.output_stamps(task)}
+
+    def save(self) -> None:
+        self.path.write_text(json.dumps({"files": self.files, "tasks": self.tasks}, indent=2, sort_keys=True))
+
+
+def run_task(task: Task, log_path: Path) -> tuple[bool, float]:
+    """Roda os comandos da tarefa em sequência, com a saída num log próprio."""
+    start = time.perf_counter()
+    for path in task.outputs:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    with log_path.open("w") as log:
+        for command in task.commands:
+            log.write(f"$ {' '.join(command)}\n")
+            log.flush()
+            try:
+                result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=False)
+            except OSError as exc:
+                log.write(f"Erro ao executar {command[0]}: {exc}\n")
+                return False, time.perf_counter() - start
+            if result.returncode != 0:
+                log.write(f"Saída com código {result.returncode}\n")
+                return False, time.perf_counter() - start
+    return True, time.perf_counter() - start
+
+
+def log_tail(log_path: Path, lines: int = 5) -> str:
+    return "\n".join("    " + line for line in log_path.read_text().splitlines()[-lines:])
+
+
+class Scheduler:
+    """Dispara tarefas prontas enquanto couberem no orçamento de CPUs/RAM.
+
+    Uma tarefa maior que o orçamento inteiro roda sozinha. Falha ou entrada ausente
+    bloqueia só as tarefas que dependem dela; o resto do grafo continua.
+    """
+
+    def __init__(
+        self, tasks: list[Task], state: PipelineState, log_dir: Path, cpus: int, memory_mb: int, force: bool = False
+    ) -> None:
+        self.tasks = {task.name: task for task in tasks}
+        self.state = state
+        self.log_dir = log_dir
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.force = force
+        self.status: dict[str, str] = {}
+        self.seconds: dict[str, float] = {}
+        self.fingerprints: dict[str, str] = {}
+
+    def _deps(self, task: Task) -> list[str]:
+        # Dependências de etapas fora de --stages viram entradas que precisam existir.
+        return [dep for dep in task.deps if dep in self.tasks]
+
+    def _missing(self, task: Task) -> list[Path]:
+        return [path for path in task.inputs if not path.exists()]
+
+    def _check(self, task: Task) -> str | None:
+        """None se a tarefa precisa rodar; senão o status final (atualizado/faltando)."""
+        missing = self._missing(task)
+        if missing:
+            print(f"[{task.name}] entrada ausente: {', '.join(map(str, missing))}")
+            return "faltando"
+        self.fingerprints[task.name] = self.state.fingerprint(task)
+        if not self.force and self.state.is_up_to_date(task, self.fingerprints[task.name]):
+            return "atualizado"
+        return None
+
+    def plan(self) -> None:
+        """--dry-run: marca o que rodaria sem executar nada."""
+        for name, task in self.tasks.items():
+            deps = [self.status[dep] for dep in self._deps(task)]
+            if any(status in ("faltando", "bloqueado") for status in deps):
+                self.status[name] = "bloqueado"
+            elif "rodaria" in deps:
+                # Entradas ainda por produzir: a assinatura só se conhece depois.
+                self.status[name] = "rodaria"
+            else:
+                self.status[name] = self._check(task) or "rodaria"
+            print(f"[{name}] {self.status[name]}")
+
+    def run(self) -> bool:
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        pending = list(self.tasks)
+        running: dict[Future, Task] = {}
+        used_cpus = used_memory = 0
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as pool:
+            while pending or running:
+                progressed = False
+                for name in list(pending):
+                    task = self.tasks[name]
+                    deps = [self.status.get(dep) for dep in self._deps(task)]
+                    if any(status in ("falhou", "faltando", "bloqueado") for status in deps):
+                        self.status[name] = "bloqueado"
+                        pending.remove(name)
+                        print(f"[{name}] bloqueado")
+                        progressed = True
+                        continue
+                    if not all(status in ("ok", "atualizado") for status in deps):
+                        continue
+                    fits = used_cpus + task.cpus <= self.cpus and used_memory + task.memory_mb <= self.memory_mb
+                    if running and not fits:
+                        continue
+                    pending.remove(name)
+                    progressed = True
+                    outcome = self._check(task)
+                    if outcome is not None:
+                        self.status[name] = outcome
+                        if outcome == "atualizado":
+                            print(f"[{name}] atualizado, pulando")
+                        continue
+                    print(f"[{name}] iniciando ({task.cpus} CPU, {task.memory_mb} MB)")
+                    running[pool.submit(run_task, task, self.log_path(task))] = task
+                    used_cpus += task.cpus
+                    used_memory += task.memory_mb
+                if progressed:
+                    continue
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    used_cpus -= task.cpus
+                    used_memory -= task.memory_mb
+                    ok, self.seconds[task.name] = future.result()
+                    if ok:
+                        self.status[task.name] = "ok"
+                        self.state.record(task, self.fingerprints[task.name])
+                        self.state.save()
+                        print(f"[{task.name}] ok em {self.seconds[task.name]:.1f}s")
+                    else:
+                        self.status[task.name] = "falhou"
+                        print(
+                            f"[{task.name}] FALHOU em {self.seconds[task.name]:.1f}s (log: {self.log_path(task)})\n"
+                            f"{log_tail(self.log_path(task))}"
+                        )
+        self.state.save()
+        return all(status in ("ok", "atualizado") for status in self.status.values())
+
+    def log_path(self, task: Task) -> Path:
+        return self.log_dir / f"{task.name.replace(':', '_')}.log"
+
+    def summary_lines(self, wall_seconds: float) -> list[str]:
+        lines = [f"{'tarefa':<36}{'status':<12}{'tempo(s)':>10}"]
+        for name in self.tasks:
+            seconds = self.seconds.get(name)
+            lines.append(f"{name:<36}{self.status.get(name, '-'):<12}{'' if seconds is None else f'{seconds:>10.1f}'}")
+        lines.append(f"{'etapa':<15}{'tarefas':>8}{'rodadas':>9}{'soma(s)':>10}{'maior(s)':>10}")
+        for stage in STAGES:
+            names = [name for name, task in self.tasks.items() if task.stage == stage]
+            if not names:
+                continue
+            times = [self.seconds[name] for name in names if name in self.seconds]
+            lines.append(f"{stage:<15}{len(names):>8}{len(times):>9}{sum(times):>10.1f}{max(times, default=0.0):>10.1f}")
+        total = sum(self.seconds.values())
+        lines.append(
+            f"Tempo de parede: {wall_seconds:.1f}s; soma das tarefas: {total:.1f}s"
+            f" (paralelismo {total / max(wall_seconds, 1e-9):.1f}x)."
+        )
+        return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Roda distância -> recorte -> regrid -> mosaicos em paralelo, pulando saídas atualizadas."
+    )
+    parser.add_argument("--config", type=Path, default=Path("pipeline.json"), help="Matriz tema × UF e parâmetros.")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=list(STAGES),
+        help="Etapas a rodar; as saídas das etapas de fora viram entradas que precisam existir.",
+    )
+    parser.add_argument("--cpus", type=int, default=None, help="Orçamento de CPUs (padrão: config ou os.cpu_count()).")
+    parser.add_argument("--memory-mb", type=int, default=None, help="Orçamento de RAM em MB (padrão: config).")
+    parser.add_argument("--force", action="store_true", help="Roda tudo mesmo que pareça atualizado.")
+    parser.add_argument("--dry-run", action="store_true", help="Só mostra o que rodaria.")
+    args = parser.parse_args()
+
+    config = json.loads(args.config.read_text())
+    tasks = [task for task in build_tasks(config) if task.stage in args.stages]
+    budget = config.get("budget", {})
+    cpus = args.cpus or budget.get("cpus") or os.cpu_count() or 1
+    memory_mb = args.memory_mb or budget.get("memory_mb") or 8192
+    print(f"{len(tasks)} tarefas; orçamento: {cpus} CPUs, {memory_mb} MB.")
+
+    state = PipelineState(args.config.parent / STATE_FILE)
+    scheduler = Scheduler(tasks, state, Path(config["dirs"].get("logs", "pipeline_logs")), cpus, memory_mb, args.force)
+    if args.dry_run:
+        scheduler.plan()
+        return
+    start = time.perf_counter()
+    ok = scheduler.run()
+    print("\n".join(scheduler.summary_lines(time.perf_counter() - start)))
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
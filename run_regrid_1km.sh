@@ -16,11 +16,7 @@ resample_to_1km() {
     fi
 
     echo "Reamostrando ${input_path} -> ${output_path}"
-    gdalwarp -overwrite -of GTiff \
-        --config GDAL_CACHEMAX 1024 -wm 1024 \
-        -multi -r near \
-        -tr 1000 1000 \
-        "${input_path}" "${output_path}"
+    python regrid_1km.py --in "${input_path}" --out "${output_path}" --stats mean
 }
 
 resample_to_1km "estradas_rs_final"
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""Amostra rasters de distância (ex.: `*_dist_regiao_sul.tif`) em milhões de pontos lon/lat.
+
+Os pontos são reprojetados numa única chamada, agrupados pelo bloco do GeoTIFF em
+que caem e cada bloco necessário é lido uma vez, passando por um cache LRU com
+limite de bytes (lotes seguidos, ou requisições do modo `--serve`, reaproveitam os
+blocos quentes). Resultado em arrays NumPy (`RasterSampler.sample`), CSV ou Parquet.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform
+from rasterio.windows import Window
+
+DEFAULT_CACHE_MB = 512
+DEFAULT_CHUNK_POINTS = 1 << 20
+POINT_CRS = "EPSG:4326"
+
+
+class BlockCache:
+    """Blocos (float, NaN no NoData) de uma banda, do menos para o mais recente."""
+
+    def __init__(self, src: rasterio.io.DatasetReader, band: int, max_bytes: int) -> None:
+        self.src = src
+        self.band = band
+        self.max_bytes = max_bytes
+        self.block_rows, self.block_cols = src.block_shapes[band - 1]
+        self.blocks: OrderedDict[tuple[int, int], np.ndarray] = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        nodata = src.nodatavals[band - 1]
+        self.nodata = None if nodata is None or np.isnan(nodata) else nodata
+        self.dtype = np.result_type(src.dtypes[band - 1], np.float32)
+        # Saídas quantizadas (uint16 + scale) voltam em metros.
+        self.scale, self.offset = src.scales[band - 1], src.offsets[band - 1]
+
+    def get(self, block_row: int, block_col: int) -> np.ndarray:
+        key = (block_row, block_col)
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+        self.misses += 1
+        window = Window(
+            block_col * self.block_cols,
+            block_row * self.block_rows,
+            min(self.block_cols, self.src.width - block_col * self.block_cols),
+            min(self.block_rows, self.src.height - block_row * self.block_rows),
+        )
+        block = self.src.read(self.band, window=window).astype(self.dtype, copy=False)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        if (self.scale, self.offset) != (1.0, 0.0):
+            block = block * self.dtype.type(self.scale) + self.dtype.type(self.offset)
+        self.blocks[key] = block
+        self.bytes += block.nbytes
+        while self.bytes > self.max_bytes and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.bytes -= evicted.nbytes
+        return block
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached_blocks": len(self.blocks), "cached_bytes": self.bytes}
+
+
+class RasterSampler:
+    """Valores de uma banda nos pontos pedidos; seguro entre threads (um lock por raster)."""
+
+    def __init__(self, path: Path, band: int = 1, cache_mb: float = DEFAULT_CACHE_MB) -> None:
+        self.path = path
+        self.name = path.stem
+        self.src = rasterio.open(path)
+        if self.src.crs is None:
+            raise SystemExit(f"{path}: raster sem CRS.")
+        self.cache = BlockCache(self.src, band, int(cache_mb * 1024 * 1024))
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        self.src.close()
+
+    def __enter__(self) -> "RasterSampler":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def pixel_indices(self, lon: np.ndarray, lat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """(linha, coluna) de cada ponto; reprojeção vetorizada numa só chamada."""
+        xs, ys = transform(POINT_CRS, self.src.crs, np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        cols, rows = ~self.src.transform * (np.asarray(xs), np.asarray(ys))
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        return rows, cols
+
+    def block_keys(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Número do bloco (linha a linha de blocos) de cada pixel."""
+        blocks_across = self.src.width // self.cache.block_cols + 1
+        return (rows // self.cache.block_rows) * blocks_across + cols // self.cache.block_cols
+
+    def sample_pixels(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Valor em cada linha/coluna (NaN fora do raster ou em NoData), lendo cada bloco uma vez."""
+        values = np.full(rows.shape, np.nan, dtype=self.cache.dtype)
+        inside = (rows >= 0) & (rows < self.src.height) & (cols >= 0) & (cols < self.src.width)
+        index = np.flatnonzero(inside)
+        if not index.size:
+            return values
+
+        keys = self.block_keys(rows[index], cols[index])
+        order = np.argsort(keys, kind="stable")
+        index, keys = index[order], keys[order]
+        starts = np.flatnonzero(np.diff(keys, prepend=-1))
+        ends = np.append(starts[1:], keys.size)
+        block_rows, block_cols = self.cache.block_rows, self.cache.block_cols
+        with self.lock:
+            for start, end in zip(starts, ends):
+                points = index[start:end]
+                block_row, block_col = rows[points[0]] // block_rows, cols[points[0]] // block_cols
+                block = self.cache.get(int(block_row), int(block_col))
+                values[points] = block[rows[points] - block_row * block_rows, cols[points] - block_col * block_cols]
+        return values
+
+    def sample(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """Valor do pixel sob cada ponto lon/lat (NaN fora do raster ou em NoData)."""
+        rows, cols = self.pixel_indices(lon, lat)
+        return self.sample_pixels(rows, cols)
+
+    def sample_chunked(self, lon: np.ndarray, lat: np.ndarray, chunk_points: int = DEFAULT_CHUNK_POINTS) -> np.ndarray:
+        """Lotes na ordem recebida: com pontos espalhados, cada lote toca quase todos os blocos."""
+        values = np.empty(len(lon), dtype=self.cache.dtype)
+        for start in range(0, len(lon), chunk_points):
+            stop = start + chunk_points
+            values[start:stop] = self.sample(lon[start:stop], lat[start:stop])
+        return values
+
+    def sample_sorted(self, lon: np.ndarray, lat: np.ndarray, chunk_points: int = DEFAULT_CHUNK_POINTS) -> np.ndarray:
+        """Ordena os pontos por bloco antes dos lotes (cada bloco lido ~1 vez) e devolve na ordem original."""
+        rows, cols = self.pixel_indices(lon, lat)
+        order = np.argsort(self.block_keys(rows, cols), kind="stable")
+        values = np.empty(len(lon), dtype=self.cache.dtype)
+        for start in range(0, len(lon), chunk_points):
+            chunk = order[start : start + chunk_points]
+            values[chunk] = self.sample_pixels(rows[chunk], cols[chunk])
+        return values
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet exige o pacote pyarrow (pip install pyarrow); use CSV ou instale-o.")
+    return pyarrow
+
+
+def read_points(path: Path, lon_col: str, lat_col: str) -> tuple[dict[str, np.ndarray], np.ndarray, np.ndarray]:
+    """Colunas do arquivo de pontos (CSV ou Parquet) + lon/lat em float64."""
+    if path.suffix.lower() == ".parquet":
+        pyarrow = _require_pyarrow()
+        table = pyarrow.parquet.read_table(path)
+        columns = {name: table.column(name).to_numpy() for name in table.column_names}
+    else:
+        with path.open(newline="") as handle:
+            reader = csv.reader(handle)
+            header = next(reader)
+            rows = list(reader)
+        columns = {name: np.array([row[i] for row in rows], dtype=object) for i, name in enumerate(header)}
+    missing = [name for name in (lon_col, lat_col) if name not in columns]
+    if missing:
+        raise SystemExit(f"{path}: colunas ausentes: {', '.join(missing)}.")
+    return columns, columns[lon_col].astype(np.float64), columns[lat_col].astype(np.float64)
+
+
+def write_points(path: Path, columns: dict[str, np.ndarray]) -> None:
+    if path.suffix.lower() == ".parquet":
+        pyarrow = _require_pyarrow()
+        pyarrow.parquet.write_table(pyarrow.table({name: np.asarray(values) for name, values in columns.items()}), path)
+        return
+    with path.open("w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(columns)
+        writer.writerows(zip(*columns.values()))
+
+
+def sample_file(
+    samplers: list[RasterSampler],
+    points_path: Path,
+    out_path: Path,
+    lon_col: str = "lon",
+    lat_col: str = "lat",
+    chunk_points: int = DEFAULT_CHUNK_POINTS,
+) -> None:
+    columns, lon, lat = read_points(points_path, lon_col, lat_col)
+    for sampler in samplers:
+        columns[sampler.name] = sampler.sample_sorted(lon, lat, chunk_points)
+        stats = sampler.cache.stats()
+        print(f"{sampler.name}: {stats['misses']} blocos lidos, {stats['hits']} acertos no cache.")
+    write_points(out_path, columns)
+    print(f"Gravado {out_path} ({lon.size} pontos).")
+
+
+def serve(samplers: list[RasterSampler], host: str, port: int) -> None:
+    """POST /sample {"lon": [...], "lat": [...]} ou GET /sample?lon=..&lat=.. -> {raster: [valores]}."""
+
+    class SampleHandler(BaseHTTPRequestHandler):
+        def _respond(self, lon: list, lat: list) -> None:
+            lon_array = np.asarray(lon, dtype=np.float64)
+            lat_array = np.asarray(lat, dtype=np.float64)
+            if lon_array.shape != lat_array.shape:
+                self.send_error(400, "lon e lat com tamanhos diferentes")
+                return
+            result = {}
+            for sampler in samplers:
+                values = sampler.sample(lon_array, lat_array)
+                result[sampler.name] = [None if np.isnan(value) else float(value) for value in values]
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            if url.path != "/sample":
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            try:
+                self._respond([float(v) for v in query.get("lon", [])], [float(v) for v in query.get("lat", [])])
+            except ValueError:
+                self.send_error(400, "lon/lat inválidos")
+
+        def do_POST(self) -> None:
+            if urlparse(self.path).path != "/sample":
+                self.send_error(404)
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                self._respond(payload["lon"], payload["lat"])
+            except (ValueError, KeyError, TypeError):
+                self.send_error(400, 'esperado JSON {"lon": [...], "lat": [...]}')
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), SampleHandler)
+    names = ", ".join(sampler.name for sampler in samplers)
+    print(f"Servindo {names} em http://{host}:{server.server_port}/sample (Ctrl+C para parar).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Amostra rasters de distância em pontos lon/lat (EPSG:4326).")
+    parser.add_argument("--raster", nargs="+", type=Path, required=True, help="Rasters (uma coluna de saída por raster).")
+    parser.add_argument("--points", type=Path, help="CSV ou Parquet com as colunas de lon/lat.")
+    parser.add_argument("--out", type=Path, help="CSV ou Parquet de saída (colunas de entrada + uma por raster).")
+    parser.add_argument("--lon-col", default="lon", help="Coluna de longitude.")
+    parser.add_argument("--lat-col", default="lat", help="Coluna de latitude.")
+    parser.add_argument("--band", type=int, default=1, help="Banda amostrada.")
+    parser.add_argument(
+        "--cache-mb",
+        type=float,
+        default=DEFAULT_CACHE_MB,
+        help="Limite do cache LRU de blocos por raster (MB).",
+    )
+    parser.add_argument(
+        "--chunk-points",
+        type=int,
+        default=DEFAULT_CHUNK_POINTS,
+        help="Pontos por lote (limita a RAM das coordenadas intermediárias).",
+    )
+    parser.add_argument("--serve", type=int, metavar="PORTA", help="Sobe um endpoint HTTP local em vez de ler --points.")
+    parser.add_argument("--host", default="127.0.0.1", help="Endereço do --serve.")
+    args = parser.parse_args()
+
+    if args.serve is None and (args.points is None or args.out is None):
+        parser.error("Informe --points e --out, ou --serve PORTA.")
+    samplers = [RasterSampler(path, args.band, args.cache_mb) for path in args.raster]
+    try:
+        if args.serve is not None:
+            serve(samplers, args.host, args.serve)
+        else:
+            sample_file(samplers, args.points, args.out, args.lon_col, args.lat_col, max(1, args.chunk_points))
+    finally:
+        for sampler in samplers:
+            sampler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""Pipeline em um único processo: TIFFs brutos -> mosaicos regionais (resolução cheia e 1 km).
+
+Junta num fluxo só o que hoje são cinco etapas com arquivos intermediários
+(`prep_binary_inputs.py`, `run_dist_maps.sh`, `run_clip_masks.sh`,
+`run_regrid_1km.sh` e `run_mosaics*.sh`). Para cada UF, estradas e rios são lidos
+juntos do `00_inputs_tiffs` (normalização em memória), a distância sai por faixa/tile,
+é recortada pela máscara da UF no próprio escritor e gravada direto na grade regional
+de `06_dist_map_mosaics`, enquanto as células de 1 km são acumuladas na mesma passada.
+Intermediários (`04_dist_map_masked`) só são gravados com `--keep-intermediates`.
+
+Com `--regional`, as entradas das UFs viram uma única camada virtual por tema e a
+distância é calculada uma vez na união: perto das divisas, a feição mais próxima do
+outro estado passa a contar. Recorte e mosaico continuam sendo cópias de janelas.
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from clip_with_mask import CLIP_FLOAT_NODATA, CutlineMask, check_shape_crs
+from dist_map import (
+    DEFAULT_EXACT_TILE_SIZE,
+    DEFAULT_KDTREE_DENSITY,
+    ENGINES,
+    DistanceEncoding,
+    DistanceWriter,
+    OutputLayout,
+    VirtualMosaic,
+    check_aligned_grids,
+    distance_profile,
+    exact_band_rows,
+    format_crs,
+    open_input,
+    process_exact,
+    process_sparse,
+    process_tiles,
+)
+from regrid_1km import (
+    DEFAULT_RESOLUTION,
+    STATISTICS,
+    STREAMING_STATISTICS,
+    CellAccumulator,
+    regrid,
+    regrid_profile,
+    stat_output_path,
+)
+
+# Mesmas camadas, UFs e máscaras dos scripts run_*.sh; a ordem das UFs é a do mosaico
+# (a última gravada prevalece onde houver sobreposição, como no gdalbuildvrt).
+THEMES = ("estradas", "rios")
+STATES = {
+    "rs": "RS_UF_2024_epsg31997.shp",
+    "sc": "SC_UF_2024_epsg31997.shp",
+    "parana": "PR_UF_2024_epsg31997.shp",
+}
+MOSAIC_NODATA = CLIP_FLOAT_NODATA
+MOSAIC_BLOCK_SIZE = 512
+
+
+class StateLayers:
+    """Camadas de uma UF (uma por tema), já abertas, com a máscara de recorte da UF."""
+
+    def __init__(self, name: str, sources: list, clip: CutlineMask) -> None:
+        self.name = name
+        self.sources = sources
+        self.clip = clip
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float]:
+        transform = self.clip.transform
+        left, top = transform.c, transform.f
+        return left, top - self.clip.crop.height * abs(transform.e), left + self.clip.crop.width * transform.a, top
+
+
+class RegionalGrid:
+    """União dos recortes das UFs numa grade única (mesmo pixel e alinhamento)."""
+
+    def __init__(self, states: list[StateLayers]) -> None:
+        reference = states[0].sources[0]
+        self.crs = reference.crs
+        self.px, self.py = abs(reference.transform.a), abs(reference.transform.e)
+        bounds = [state.bounds for state in states]
+        self.left = min(bound[0] for bound in bounds)
+        self.top = max(bound[3] for bound in bounds)
+        right = max(bound[2] for bound in bounds)
+        bottom = min(bound[1] for bound in bounds)
+        self.width = round((right - self.left) / self.px)
+        self.height = round((self.top - bottom) / self.py)
+        self.transform = Affine(self.px, 0.0, self.left, 0.0, -self.py, self.top)
+
+        for state in states:
+            src = state.sources[0]
+            if src.crs != self.crs:
+                raise SystemExit(f"{state.name}: CRS {format_crs(src.crs)} difere de {format_crs(self.crs)}.")
+            if (abs(src.transform.a), abs(src.transform.e)) != (self.px, self.py):
+                raise SystemExit(f"{state.name}: pixel diferente das demais UFs; não dá para mosaicar sem reamostrar.")
+            col, row = self.offset(state)
+            if not np.isclose(col, round(col), atol=1e-6) or not np.isclose(row, round(row), atol=1e-6):
+                raise SystemExit(f"{state.name}: grade desalinhada em relação às demais UFs.")
+
+    def offset(self, state: StateLayers) -> tuple[float, float]:
+        left, _, _, top = state.bounds
+        return (left - self.left) / self.px, (self.top - top) / self.py
+
+    def profile(self, base: dict) -> dict:
+        profile = dict(base)
+        profile.update(
+            driver="GTiff",
+            dtype="float32",
+            count=1,
+            height=self.height,
+            width=self.width,
+            transform=self.transform,
+            crs=self.crs,
+            nodata=MOSAIC_NODATA,
+            compress="deflate",
+            predictor=3,
+            tiled=True,
+            blockxsize=MOSAIC_BLOCK_SIZE,
+            blockysize=MOSAIC_BLOCK_SIZE,
+            bigtiff="IF_SAFER",
+        )
+        return profile
+
+
+class RegionalMosaic:
+    """Mosaico regional de um tema em construção + acumulador das células de 1 km."""
+
+    def __init__(self, path: Path, profile: dict, grid: RegionalGrid, resolution: float) -> None:
+        self.path = path
+        if path.exists():
+            path.unlink()
+        self.dst = rasterio.open(path, "w+", **profile)
+        self.cells = CellAccumulator(grid.height, grid.width, grid.transform, resolution)
+
+    def merge(self, data: np.ndarray, window: Window) -> None:
+        """Grava os pixels válidos do bloco que ainda estão vazios no mosaico.
+
+        O primeiro valor gravado prevalece (as UFs são processadas na ordem inversa
+        do mosaico), então cada pixel entra uma única vez nas células de 1 km.
+        """
+        existing = self.dst.read(1, window=window)
+        new = (data != MOSAIC_NODATA) & (existing == MOSAIC_NODATA)
+        if not new.any():
+            return
+        self.dst.write(np.where(new, data, existing), 1, window=window)
+        self.cells.add(np.where(new, data, np.nan), window)
+
+
+class MosaicLayerWriter(DistanceWriter):
+    """Escritor das engines do `dist_map.py` que manda cada camada para o mosaico do tema.
+
+    Cada alvo é uma máscara de UF e o deslocamento do recorte dela na grade regional:
+    o bloco é recortado e copiado para lá. Com `tees`, os mesmos blocos também vão para
+    `DistanceWriter`s comuns (intermediários em disco).
+    """
+
+    def __init__(
+        self,
+        mosaics: list[RegionalMosaic],
+        encoding: DistanceEncoding,
+        targets: list[tuple[CutlineMask, tuple[int, int]]],
+        tees: list[DistanceWriter] = (),
+    ) -> None:
+        self.encoding = encoding
+        self.nearest = None
+        self.layout = OutputLayout()
+        self.clip = None
+        self.mosaics = mosaics
+        self.targets = targets
+        self.tees = list(tees)
+
+    @property
+    def layer_count(self) -> int:
+        return len(self.mosaics)
+
+    def write_encoded(
+        self,
+        layer: int,
+        encoded: np.ndarray,
+        window: Window,
+        nearest_encoded: np.ndarray | None = None,
+    ) -> None:
+        for tee in self.tees:
+            tee.write_encoded(layer, encoded, window)
+        for clip, (col_off, row_off) in self.targets:
+            clipped = clip.clip_block(encoded, window, MOSAIC_NODATA)
+            if clipped is None:
+                continue
+            out_window, data = clipped
+            region_window = Window(
+                out_window.col_off + col_off,
+                out_window.row_off + row_off,
+                out_window.width,
+                out_window.height,
+            )
+            self.mosaics[layer].merge(data, region_window)
+
+    def close(self, finalize: bool = True) -> None:
+        for tee in self.tees:
+            tee.close(finalize)
+
+
+def intermediate_writer(
+    keep_dir: Path,
+    state: StateLayers,
+    src: rasterio.io.DatasetReader | VirtualMosaic,
+    encoding: DistanceEncoding,
+) -> DistanceWriter:
+    """Recortes por UF em `keep_dir`, com os mesmos nomes do run_clip_masks.sh."""
+    out_paths = [keep_dir / f"{theme}_{state.name}_final_dist_masked.tif" for theme in THEMES]
+    return DistanceWriter(out_paths, distance_profile(src, encoding), encoding, list(THEMES), clip=state.clip)
+
+
+def write_cells(mosaic: RegionalMosaic, out_path: Path, stats: tuple[str, ...], resolution: float) -> None:
+    """Grava os produtos de 1 km acumulados; a mediana exige reler o mosaico final."""
+    height, width = mosaic.cells.shape
+    profile = regrid_profile(mosaic.dst, resolution, height, width)
+    for stat in stats:
+        path = stat_output_path(out_path, stat, stats)
+        if stat not in STREAMING_STATISTICS:
+            continue
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write(mosaic.cells.result(stat), 1)
+        print(f"Gravado {path}")
+
+
+def run(
+    input_dir: Path,
+    mask_dir: Path,
+    output_dir: Path,
+    engine: str = "exact",
+    tile_size: int = DEFAULT_EXACT_TILE_SIZE,
+    workers: int = 1,
+    encoding: DistanceEncoding = DistanceEncoding(),
+    stats: tuple[str, ...] = ("mean",),
+    resolution: float = DEFAULT_RESOLUTION,
+    keep_dir: Path | None = None,
+    regional: bool = False,
+) -> None:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if keep_dir is not None:
+        keep_dir.mkdir(parents=True, exist_ok=True)
+
+    with ExitStack() as stack:
+        state_sources = {}
+        for state in STATES:
+            paths = [input_dir / f"{theme}_{state}_final.tif" for theme in THEMES]
+            missing = [str(path) for path in paths if not path.exists()]
+            if missing:
+                raise SystemExit(f"Entradas não encontradas: {', '.join(missing)}")
+            state_sources[state] = [stack.enter_context(open_input(str(path), raw=True)) for path in paths]
+            check_aligned_grids(state_sources[state])
+
+        region = None
+        if regional:
+            # Uma camada virtual por tema, juntando as UFs; as máscaras passam a ser da grade regional.
+            region = [
+                VirtualMosaic([sources[layer] for sources in state_sources.values()])
+                for layer in range(len(THEMES))
+            ]
+            check_aligned_grids(region)
+            print(f"Entrada regional virtual: {region[0].height}x{region[0].width} px.")
+
+        states = []
+        for state, shapefile in STATES.items():
+            sources = state_sources[state]
+            grid_src = region[0] if regional else sources[0]
+            shape_path = mask_dir / shapefile
+            try:
+                check_shape_crs(shape_path, grid_src.crs)
+                clip = CutlineMask.load_or_build(shape_path, grid_src)
+            except ValueError as exc:
+                raise SystemExit(str(exc))
+            states.append(StateLayers(state, sources, clip))
+            print(f"{state}: {sources[0].height}x{sources[0].width} px, recorte {clip.summary()}.")
+
+        grid = RegionalGrid(states)
+        print(f"Grade regional: {grid.height}x{grid.width} px ({format_crs(grid.crs)}).")
+        profile = grid.profile(distance_profile(states[0].sources[0]))
+        mosaics = [
+            RegionalMosaic(output_dir / f"{theme}_dist_regiao_sul.tif", profile, grid, resolution) for theme in THEMES
+        ]
+        for mosaic in mosaics:
+            stack.callback(mosaic.dst.close)
+
+        px, py = grid.px, grid.py
+        # Ordem inversa + "primeiro vence" no merge = "último vence" do gdalbuildvrt.
+        ordered = list(reversed(states))
+
+        def target(state: StateLayers) -> tuple[CutlineMask, tuple[int, int]]:
+            col, row = grid.offset(state)
+            return state.clip, (round(col), round(row))
+
+        if regional:
+            jobs = [("região (todas as UFs)", region, ordered)]
+        else:
+            jobs = [(state.name, state.sources, [state]) for state in ordered]
+
+        for label, sources, job_states in jobs:
+            tees = []
+            if keep_dir is not None:
+                tees = [intermediate_writer(keep_dir, state, sources[0], encoding) for state in job_states]
+            print(f"Processando {label} ({', '.join(THEMES)}) direto nos mosaicos...")
+            with MosaicLayerWriter(mosaics, encoding, [target(state) for state in job_states], tees) as writer:
+                band_rows = exact_band_rows(sources[0].width, tile_size)
+                if engine == "exact":
+                    process_exact(sources, writer, band_rows, px, py)
+                elif engine in ("kdtree", "auto"):
+                    density = None if engine == "kdtree" else DEFAULT_KDTREE_DENSITY
+                    process_sparse(sources, writer, band_rows, px, py, workers, density)
+                else:
+                    padding = 512 if encoding.max_distance is None else math.ceil(encoding.max_distance / min(px, py))
+                    process_tiles(sources, writer, tile_size, padding, px, py, workers)
+
+        for theme, mosaic in zip(THEMES, mosaics):
+            out_1km = output_dir / f"{theme}_dist_regiao_sul_1km.tif"
+            write_cells(mosaic, out_1km, stats, resolution)
+            mosaic.dst.close()
+            print(f"Gravado {mosaic.path}")
+            for stat in stats:
+                if stat not in STREAMING_STATISTICS:
+                    regrid(mosaic.path, stat_output_path(out_1km, stat, stats), [stat], resolution)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Gera os mosaicos de distância da região Sul (cheio e 1 km) em uma única passada."
+    )
+    parser.add_argument("--input-dir", default="00_inputs_tiffs", help="TIFFs brutos (1 = feição, NoData = fundo).")
+    parser.add_argument("--mask-dir", default="02_shapefiles_epsg31997", help="Shapefiles das UFs em EPSG:31997.")
+    parser.add_argument("--output-dir", default="06_dist_map_mosaics", help="Destino dos mosaicos regionais.")
+    parser.add_argument("--engine", choices=ENGINES, default="exact", help="Motor do dist_map.py.")
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=DEFAULT_EXACT_TILE_SIZE,
+        help="Tile do motor padded ou tile de referência das faixas do exato.",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Processos do motor padded (threads no kdtree).")
+    parser.add_argument("--max-distance", type=float, default=None, help="Satura as distâncias neste valor (m).")
+    parser.add_argument(
+        "--stats",
+        nargs="+",
+        choices=STATISTICS,
+        default=["mean"],
+        help="Estatísticas do mosaico de 1 km. min/mean/max saem da mesma passada; median relê o mosaico final.",
+    )
+    parser.add_argument("--resolution", type=float, default=DEFAULT_RESOLUTION, help="Célula do mosaico agregado.")
+    parser.add_argument(
+        "--keep-intermediates",
+        nargs="?",
+        const="04_dist_map_masked",
+        default=None,
+        metavar="DIR",
+        help="Também grava os rasters recortados por UF (padrão: 04_dist_map_masked).",
+    )
+    parser.add_argument(
+        "--regional",
+        action="store_true",
+        help=(
+            "Calcula a distância uma única vez na união das UFs (entrada virtual), corrigindo os pixels"
+            " perto das divisas cuja feição mais próxima está no estado vizinho."
+        ),
+    )
+    args = parser.parse_args()
+
+    try:
+        encoding = DistanceEncoding(args.max_distance)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    with rasterio.Env(GDAL_CACHEMAX=1024):
+        run(
+            Path(args.input_dir),
+            Path(args.mask_dir),
+            Path(args.output_dir),
+            args.engine,
+            max(16, args.tile_size),
+            max(1, args.workers),
+            encoding,
+            tuple(dict.fromkeys(args.stats)),
+            args.resolution,
+            Path(args.keep_intermediates) if args.keep_intermediates else None,
+            args.regional,
+        )
+
+
+if __name__ == "__main__":
+    main()